@@ -1,130 +1,284 @@
 from tqdm import tqdm
-import requests
+import json
+import time
+import bisect
+import threading
+import uuid
+from collections import OrderedDict
+from io import BytesIO
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from urllib.parse import unquote
 from datetime import datetime
 from datetime import timedelta
 from pymarc import *
-from permissive import PermissiveMARCReader
+from permissive import PermissiveMARCReader, PermissiveMARCScanner, PermissiveMARCXMLReader
+from bib_store import MarcRecordStore
+from authority_index import AuthorityIndex, calculate_check_digit
+from marc_serializers import (record_to_marcxml, record_to_jsonl, marcxml_to_ascii, escape_text, COLLECTION_START_TAG,
+                              COLLECTION_END_TAG)
 from indexer_config import FIELDS_TO_CHECK, AUTHORITY_INDEX_FIELDS
 from base_url_config import BASE_URL
+from data_bn_client import data_bn_client
+from bib_listing import get_numeric_id, get_listed_range
+from change_journal import DELETE as JOURNAL_DELETE
+from metrics import registry, tracer, StageTimer
+from single_flight import SingleFlight, SingleFlightTimeout
+
+# metrics (see metrics.py)
+
+CHUNK_STAGE_SECONDS = registry.histogram('marc_api_chunk_stage_seconds',
+                                         'Time of /get_bibs page stages (per page and output format).', ['stage'])
+CHUNK_RECORDS = registry.histogram('marc_api_chunk_records',
+                                   'Records of /get_bibs page: listed by data.bn and found in local bib index.',
+                                   ['source'], buckets=(0, 1, 5, 10, 25, 50, 75, 100, 200))
+BIB_LISTINGS = registry.counter('marc_api_bib_listings_total',
+                                'Listings of /get_bibs pages: by local listing index or by data.bn.', ['source'])
+LOCAL_INDEX_MISSES = registry.counter('marc_api_local_index_misses_total',
+                                      'Records listed by data.bn for /get_bibs page missing in local bib index.')
+MARC_READER_FAILED = registry.counter('marc_api_marc_reader_failed_total',
+                                      'Records which could not be read by PermissiveMARCReader.', ['source'])
+UPDATE_JOB_SECONDS = registry.histogram('marc_api_update_job_seconds', 'Duration of index update jobs.',
+                                        ['index', 'state'])
+UPDATED_RECORDS = registry.counter('marc_api_updated_records_total',
+                                   'Records deleted, updated, found unchanged and missing at data.bn (listed as updated, '
+                                   'but not returned) by index update jobs.',
+                                   ['index', 'operation'])
+
+# period of changes at data.bn.org.pl listed again by full index updates (before the last update);
+# incremental updates (see IndexSyncLoop) start from the last update with overlap of INDEX_SYNC_OVERLAP
+FULL_UPDATE_OVERLAP = timedelta(days=3)
+
+# stages of /get_bibs page done while output is rendered (the other ones are done when page is created)
+CHUNK_RENDERING_STAGES = ('parse', 'enrich', 'render')
+
+# max time (seconds) request waits for output of /get_bibs page rendered for concurrent request of the same page
+CHUNK_OUTPUT_WAIT_TIMEOUT = 60
 
 # indexers for authorities and bibliographic records
 
 def create_authority_index(data):
     """
-    Creates authority records index in form of dictionary.
+    Creates authority records index in form of AuthorityIndex.
     Structure:
-    record id (string): heading (string)
+    record id (packed): heading (string)
     and
-    heading (string): record ids (list).
+    heading (string): record id (packed) or record ids (list, only for headings shared by several records).
 
     Available requests: by authority id and authority heading.
     """
-    authority_index = {}
+    authority_index = AuthorityIndex()
 
     with open(data, 'rb') as fp:
-        rdr = PermissiveMARCReader(fp, to_unicode=True, force_utf8=True, utf8_handling='ignore')
+        rdr = PermissiveMARCScanner(fp, ['001'] + AUTHORITY_INDEX_FIELDS, utf8_handling='ignore')
         for rcd in tqdm(rdr):
             try:
-                record_id = rcd.get_fields('001')[0].value()
+                record_id = rcd.value('001')
                 logging.debug('Indeksuję: {}'.format(record_id))
-            except IndexError:
+            except KeyError:
                 continue
             for fld in AUTHORITY_INDEX_FIELDS:
                 if fld in rcd:
-                    fld_value = get_rid_of_punctuation(rcd.get_fields(fld)[0].value())
-                    authority_index.setdefault(fld_value, []).append(record_id)
-                    authority_index[record_id] = fld_value
+                    fld_value = get_rid_of_punctuation(rcd.value(fld))
+                    authority_index.index_record(record_id, fld_value)
 
     return authority_index
 
 def create_local_bib_index(data):
     """
-    Creates bibliographic records index in form of dictionary.
+    Creates bibliographic records index in form of dictionary-like MarcRecordStore.
     Structure:
-    record id (string): record (bytes) [thanks to bytes ('ISO transmission format') all bibs can be easily loaded to memory]
+    record id (string): location of record (offset, length) in memory-mapped MARC dump
+    [records are sliced from the map as memoryview, so the dump itself is never loaded to memory]
 
     Available requests: by bibliographic record id.
     """
-    l_b_index = {}
+    l_b_index = MarcRecordStore(data)
 
     with open(data, 'rb') as fp:
-        rdr = PermissiveMARCReader(fp, to_unicode=True, force_utf8=True, utf8_handling='ignore')
+        rdr = PermissiveMARCScanner(fp, ['001'], utf8_handling='ignore')
         for rcd in tqdm(rdr):
             try:
-                record_id = rcd.get_fields('001')[0].value()
+                record_id = rcd.value('001')
                 logging.debug('Indeksuję: {}'.format(record_id))
-            except IndexError:
+            except KeyError:
                 continue
-            l_b_index[record_id] = rcd.as_marc()
+            l_b_index.add_base_record(record_id, rcd.offset, len(rcd.raw))
 
     return l_b_index
 
 # helper functions
 
+PUNCTUATION_TRANSLATION_TABLE = str.maketrans('', '', ',.')
+
+
 def get_rid_of_punctuation(string):
-    return ''.join(char.replace(',', '').replace('.', '') for char in string)
+    return string.translate(PUNCTUATION_TRANSLATION_TABLE)
 
 
 def read_marc_from_binary(data_chunk):
-    marc_rdr = PermissiveMARCReader(data_chunk, to_unicode=True, force_utf8=True, utf8_handling='ignore')
+    # records of local bib index are memoryviews of the dump (data.bn chunks are bytearrays)
+    marc_rdr = PermissiveMARCReader(BytesIO(data_chunk), to_unicode=True, force_utf8=True, utf8_handling='ignore')
     for rcd in marc_rdr:
         return rcd
 
-def calculate_check_digit(record_id):
-    char_sum = 0
-    i = 2
-    for character in record_id[::-1]:
-        char_sum += int(character) * i
-        i += 1
-    remainder = char_sum % 11
-    check_digit = str(remainder) if remainder != 10 else 'x'
-    return record_id + check_digit
-
 def get_marc_authority_data_from_data_bn(records_ids):
-    records_ids_length = len(records_ids)
+    if len(records_ids) <= 100:
+        return data_bn_client.get_marc('authorities', records_ids)
 
-    if records_ids_length <= 100:
-        ids_for_query = '%2C'.join(record_id for record_id in records_ids)
-        query = 'http://data.bn.org.pl/api/authorities.marc?id={}&limit=100'.format(ids_for_query)
+def get_marc_bibliographic_data_from_data_bn(records_ids):
+    if len(records_ids) <= 100:
+        return data_bn_client.get_marc('bibs', records_ids)
 
-        result = bytearray(requests.get(query).content)
-        #logging.debug("Pobieram: {}".format(query))
-        return result
+# api core function
 
-def get_marc_bibliographic_data_from_data_bn(records_ids):
-    records_ids_length = len(records_ids)
+class RecordEnricher(object):
+    """
+    Matcher for adding authority identifiers to bibliographic records, compiled once from FIELDS_TO_CHECK.
+    Record fields are checked in one pass with dispatch by tag; the result is the same as applying
+    FIELDS_TO_CHECK entry by entry (each matched field gets $0 and is moved behind other fields with the same tag).
+    Terms not found in index can be matched by fallback_matcher (function: term -> heading or None).
+    """
+    def __init__(self, fields_to_check, fallback_matcher=None):
+        self.tags_order = {fld: position for position, (fld, subflds) in enumerate(fields_to_check)}
+        self.tags_subfields = {fld: frozenset(subflds) for fld, subflds in fields_to_check}
+        self.fallback_matcher = fallback_matcher
 
-    if records_ids_length <= 100:
-        ids_for_query = '%2C'.join(record_id for record_id in records_ids)
-        query = 'http://data.bn.org.pl/api/bibs.marc?id={}&limit=100'.format(ids_for_query)
+    def get_term_to_search(self, raw_fld, subflds):
+        return self.get_term_from_subfields(raw_fld.subfields, subflds)
 
-        result = bytearray(requests.get(query).content)
-        #logging.debug("Pobieram: {}".format(query))
-        return result
+    @staticmethod
+    def get_term_from_subfields(subfields, subflds):
+        return ' '.join(subfields[i + 1] for i in range(0, len(subfields), 2)
+                        if subfields[i] in subflds).translate(PUNCTUATION_TRANSLATION_TABLE)
+
+    def get_terms_of_scanned_record(self, scanned_record):
+        """
+        Returns set of terms which are searched in authority index for record scanned by PermissiveMARCScanner
+        (with tags from FIELDS_TO_CHECK).
+        """
+        terms = set()
+        for tag, subflds in self.tags_subfields.items():
+            for subfields in scanned_record.get_subfields(tag):
+                terms.add(self.get_term_from_subfields(subfields, subflds))
+        terms.discard('')
+        return terms
+
+    def find_matches(self, marc_record, lookup):
+        """
+        Returns list of tuples: matched field, authority identifier - in FIELDS_TO_CHECK order.
+        """
+        matches = []
+
+        for raw_fld in marc_record.fields:
+            subflds = self.tags_subfields.get(raw_fld.tag)
+            if subflds is None:
+                continue
+            term_to_search = self.get_term_to_search(raw_fld, subflds)
+            identifier_001 = lookup(term_to_search)
+            if not identifier_001 and self.fallback_matcher is not None:
+                heading = self.fallback_matcher(term_to_search)
+                identifier_001 = lookup(heading) if heading else None
+            if identifier_001:
+                matches.append((self.tags_order[raw_fld.tag], raw_fld, identifier_001))
+
+        matches.sort(key=lambda match: match[0])
+        return [(raw_fld, identifier_001) for position, raw_fld, identifier_001 in matches]
+
+    @staticmethod
+    def has_ordered_fields(marc_record):
+        last_tag = -1
+        for raw_fld in marc_record.fields:
+            if not raw_fld.tag.isdigit() or int(raw_fld.tag) < last_tag:
+                return False
+            last_tag = int(raw_fld.tag)
+        return True
+
+    def enrich(self, marc_record, lookup):
+        matches = self.find_matches(marc_record, lookup)
+        if not matches:
+            return marc_record
+
+        for raw_fld, identifier_001 in matches:
+            raw_fld.add_subfield('0', identifier_001)
+
+        if self.has_ordered_fields(marc_record):
+            # fields sorted by tag: moving matched field with add_ordered_field puts it at the end of its tag group,
+            # so stable sort by (tag, matched) gives the same order in one go
+            matched = {id(raw_fld) for raw_fld, identifier_001 in matches}
+            marc_record.fields.sort(key=lambda raw_fld: (int(raw_fld.tag), id(raw_fld) in matched))
+        else:
+            for raw_fld, identifier_001 in matches:
+                marc_record.remove_field(raw_fld)
+                marc_record.add_ordered_field(raw_fld)
+
+        return marc_record
+
+    def enrich_batch(self, marc_records, auth_index, stats=None):
+        """
+        Enriches list of records; lookups of the same term are shared by all records in batch.
+        Number of linked fields is added to stats['linked'], if stats dict is given.
+        """
+        found = {}
+
+        def lookup(term_to_search):
+            if term_to_search not in found:
+                found[term_to_search] = auth_index.get_first_id(term_to_search)
+            if stats is not None and found[term_to_search]:
+                stats['linked'] += 1
+            return found[term_to_search]
+
+        return [self.enrich(marc_record, lookup) for marc_record in marc_records]
+
+
+record_enricher = RecordEnricher(FIELDS_TO_CHECK)
 
-# api core function
 
 def process_record(marc_record, auth_index):
     """
     Main processing loop for adding authority identifiers to bibliographic record.
     """
+    return record_enricher.enrich(marc_record, auth_index.get_first_id)
+
+
+def process_records(marc_records, auth_index, stats=None):
+    """
+    Adds authority identifiers to list of bibliographic records (with lookups shared by whole batch).
+    """
+    return record_enricher.enrich_batch(marc_records, auth_index, stats)
 
-    for marc_field_and_subfields in FIELDS_TO_CHECK:
-        fld, subflds = marc_field_and_subfields[0], marc_field_and_subfields[1]
 
-        if fld in marc_record:
-            raw_objects_flds_list = marc_record.get_fields(fld)
+# renderers of enriched records (one record of /get_bibs output, without wrapping element)
 
-            for raw_fld in raw_objects_flds_list:
-                term_to_search = get_rid_of_punctuation(' '.join(subfld for subfld in raw_fld.get_subfields(*subflds)))
+ENRICHED_RECORD_RENDERERS = {'xml': lambda rcd: record_to_marcxml(rcd, namespace=True),
+                             'jsonl': record_to_jsonl}
 
-                if term_to_search in auth_index:
-                    identifier_001 = auth_index[term_to_search][0]
-                    marc_record.remove_field(raw_fld)
-                    raw_fld.add_subfield('0', identifier_001)
-                    marc_record.add_ordered_field(raw_fld)
 
-    return marc_record
+def read_enriched_record(raw_record, lookup, timer=None):
+    """
+    Returns bibliographic record (ISO 2709) read and enriched, None if record can't be read.
+    Time of stages (parse, enrich) is added to timer (StageTimer), if given.
+    """
+    timer = timer if timer is not None else StageTimer()
+    with timer.stage('parse'):
+        rcd = read_marc_from_binary(raw_record)
+    if rcd is None:
+        return None
+    with timer.stage('enrich'):
+        return record_enricher.enrich(rcd, lookup)
+
+
+def render_enriched_record(raw_record, output_format, lookup, timer=None):
+    """
+    Returns bibliographic record (ISO 2709) enriched and rendered in given format, None if record can't be read.
+    Time of stages (parse, enrich, render) is added to timer (StageTimer), if given.
+    """
+    timer = timer if timer is not None else StageTimer()
+    rcd = read_enriched_record(raw_record, lookup, timer)
+    if rcd is None:
+        return None
+    with timer.stage('render'):
+        return ENRICHED_RECORD_RENDERERS[output_format](rcd)
 
 # models for API
 
@@ -135,222 +289,469 @@ class UpdaterStatus(object):
         self.last_bib_update = date_now
         self.last_auth_update = date_now
 
+class IndexVersion(object):
+    """
+    Consistent set of indexes served to readers; never modified after it is published.
+    """
+    def __init__(self, bib_index, auth_index, version):
+        self.bib_index = bib_index
+        self.auth_index = auth_index
+        self.version = version
+
+
+class Indexes(object):
+    """
+    Holder of the current index version. Readers take `current` once per request;
+    updates build new index (copy) and publish it with swap (atomic reference replacement).
+    """
+    def __init__(self, bib_index, auth_index):
+        self.current = IndexVersion(bib_index, auth_index, 1)
+        self.swap_lock = threading.Lock()
+
+    def swap(self, bib_index=None, auth_index=None):
+        with self.swap_lock:
+            current = self.current
+            self.current = IndexVersion(bib_index if bib_index is not None else current.bib_index,
+                                        auth_index if auth_index is not None else current.auth_index,
+                                        current.version + 1)
+            logging.info('Opublikowano wersję indeksów: {}'.format(self.current.version))
+            return self.current
+
+
+class UpdateJob(object):
+    def __init__(self, index, incremental=False):
+        self.job_id = uuid.uuid4().hex
+        self.index = index
+        self.incremental = incremental
+        self.state = 'queued'
+        self.progress = {}
+        self.error = None
+        self.created = datetime.utcnow()
+        self.started = None
+        self.finished = None
+        # authority records changed by job: tuples of record id, old heading, new heading (None - no heading)
+        self.authority_changes = []
+
+    def as_dict(self):
+        return {'job_id': self.job_id, 'index': self.index, 'incremental': self.incremental, 'state': self.state, 'progress': dict(self.progress),
+                'error': self.error, 'authority_changes': len(self.authority_changes),
+                'created': self.created.isoformat(timespec='seconds') + 'Z',
+                'started': self.started.isoformat(timespec='seconds') + 'Z' if self.started else None,
+                'finished': self.finished.isoformat(timespec='seconds') + 'Z' if self.finished else None}
+
+
+class UpdateJobsRunner(object):
+    """
+    Runs index update jobs one by one in background thread (run_job(job) does the update).
+    Submitting update of index which is already queued or running returns existing job.
+    """
+    def __init__(self, run_job, max_finished_jobs=50):
+        self.run_job = run_job
+        self.max_finished_jobs = max_finished_jobs
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='updater')
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+
+    def submit(self, index, incremental=False):
+        with self.lock:
+            for job in self.jobs.values():
+                if job.index == index and job.state in ('queued', 'running'):
+                    return job
+
+            job = UpdateJob(index, incremental)
+            self.jobs[job.job_id] = job
+            while len(self.jobs) > self.max_finished_jobs and self.jobs[next(iter(self.jobs))].state in ('done', 'failed'):
+                self.jobs.popitem(last=False)
+
+        self.executor.submit(self.run, job)
+        return job
+
+    def run(self, job):
+        job.state = 'running'
+        job.started = datetime.utcnow()
+        try:
+            self.run_job(job)
+            job.state = 'done'
+        except Exception as e:
+            logging.exception('Błąd aktualizacji indeksu: {}'.format(job.index))
+            job.error = repr(e)
+            job.state = 'failed'
+        job.finished = datetime.utcnow()
+        self.observe(job)
+
+    @staticmethod
+    def observe(job):
+        duration = (job.finished - job.started).total_seconds()
+        UPDATE_JOB_SECONDS.observe(duration, index=job.index, state=job.state)
+        for operation in ('deleted', 'updated', 'unchanged', 'missing'):
+            UPDATED_RECORDS.inc(job.progress.get(operation, 0), index=job.index, operation=operation)
+        tracer.record('update', job.index, {'update': duration}, state=job.state, progress=dict(job.progress))
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def is_update_in_progress(self):
+        return any(job.state == 'running' for job in list(self.jobs.values()))
+
+    def get_jobs(self):
+        return [job.as_dict() for job in list(self.jobs.values())]
+
+
+class IndexSyncLoop(object):
+    """
+    Continuous sync of indexes with data.bn.org.pl: submits incremental update jobs of indexes (see UpdateJobsRunner)
+    at start and then every interval seconds, in background thread.
+    """
+    def __init__(self, jobs_runner, interval, indexes=('authorities', 'bibs')):
+        self.jobs_runner = jobs_runner
+        self.interval = interval
+        self.indexes = indexes
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='index-sync', daemon=True)
+        self.thread.start()
+        logging.info('Uruchomiono synchronizację indeksów z data.bn.org.pl (co {} s)'.format(self.interval))
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while True:
+            for index in self.indexes:
+                self.jobs_runner.submit(index, incremental=True)
+            if self.stop_event.wait(self.interval):
+                return
+
+
 class Updater(object):
-    def __init__(self):
-        pass
+    def __init__(self, client=None):
+        self.client = client or data_bn_client
+
+    def get_changes(self, records_type, last_update, overlap=FULL_UPDATE_OVERLAP, listed=False):
+        """
+        Returns tuple: ids of records (records_type: 'bibs' or 'authorities') deleted at data.bn.org.pl since
+        last_update - overlap (list), ids of updated records (generator paging listing of data.bn.org.pl,
+        list if listed), date of the query (new watermark).
+        """
+        date_from = last_update - overlap
+        date_to = datetime.utcnow()
+        dates = '{}%2C{}'.format(date_from.isoformat(timespec='seconds') + 'Z',
+                                 date_to.isoformat(timespec='seconds') + 'Z')
+
+        deleted_query = self.client.get_api_url('{}.json?updatedDate={}&deleted=true&limit=100'.format(
+            records_type, dates))
+        deleted_records_ids = list(self.iter_records_ids_from_data_bn(deleted_query, records_type))
+
+        updated_query = self.client.get_api_url('{}.json?updatedDate={}&limit=100'.format(records_type, dates))
+        updated_records_ids = self.iter_records_ids_from_data_bn(updated_query, records_type)
+
+        return deleted_records_ids, list(updated_records_ids) if listed else updated_records_ids, date_to
+
+    def update_bibliographic_index(self, bib_index, updater_status, progress=None, journal=None, changes=None):
+        """
+        Progress of update (phase, deleted, updated, unchanged and missing records count) is reported in progress dict.
+        Deleted and updated records are written to journal transaction (see change_journal), if given.
+        Changes can be listed in advance (see get_changes), otherwise they are listed since the last update
+        with overlap of FULL_UPDATE_OVERLAP. Returns ids of changed records.
+        """
+        progress = {} if progress is None else progress
 
-    def update_bibliographic_index(self, bib_index, updater_status):
         # set update status
         updater_status.update_in_progress = True
         logging.info("Status: {}".format(updater_status.update_in_progress))
 
-        # create dates for queries
-        date_from = updater_status.last_bib_update - timedelta(days=3)
-        date_from_in_iso_with_z = date_from.isoformat(timespec='seconds') + 'Z'
-        date_to = datetime.utcnow()
-        date_to_in_iso_with_z = date_to.isoformat(timespec='seconds') + 'Z'
-
-        # get deleted bib records ids from data.bn.org.pl
-        deleted_query = 'http://data.bn.org.pl/api/bibs.json?updatedDate={}%2C{}&deleted=true&limit=100'.format(
-            date_from_in_iso_with_z, date_to_in_iso_with_z)
+        # get deleted and updated bib records ids from data.bn.org.pl
+        if changes is None:
+            changes = self.get_changes('bibs', updater_status.last_bib_update)
+        deleted_records_ids, updated_records_ids, date_to = changes
 
-        deleted_records_ids = self.get_records_ids_from_data_bn_for_bibliographic_index_update(deleted_query)
+        # delete bib records from bib index by record id (records which are not in index are skipped)
+        progress.update(phase='deleting', deleted=0, updated=0, unchanged=0, missing=0)
+        deleted_records_ids = self.remove_deleted_records_from_bibliographic_index(deleted_records_ids, bib_index,
+                                                                                   journal)
         logging.info("Rekordów usuniętych: {}".format(len(deleted_records_ids)))
+        progress.update(phase='updating', deleted=len(deleted_records_ids))
 
-        # get updated bib records ids from data.bn.org.pl
-        updated_query = 'http://data.bn.org.pl/api/bibs.json?updatedDate={}%2C{}&limit=100'.format(
-            date_from_in_iso_with_z, date_to_in_iso_with_z)
+        # update bib records in bib index by record id (records equal to indexed ones are skipped)
+        # (pipelined: ids are paged, records are downloaded concurrently and indexed as they come)
+        updated_records_ids = self.update_updated_records_in_bibliographic_index(updated_records_ids, bib_index,
+                                                                                 progress, journal)
+        logging.info("Rekordów zmodyfikowanych: {} (bez zmian: {}, brak w data.bn: {})".format(
+            len(updated_records_ids), progress['unchanged'], progress['missing']))
 
-        updated_records_ids = self.get_records_ids_from_data_bn_for_bibliographic_index_update(updated_query)
-        logging.info("Rekordów zmodyfikowanych: {}".format(len(updated_records_ids)))
-
-        # delete authority records from authority index by record id (deletes entries by record id and heading)
-        self.remove_deleted_records_from_bibliographic_index(deleted_records_ids, bib_index)
-
-        # update authority records in authority index by record id (updates entries by record id and heading)
-        self.update_updated_records_in_bibliographic_index(updated_records_ids, bib_index)
+        # merge overlay segment (updated records) into base file if it grew too big
+        if bib_index.needs_compaction():
+            progress['phase'] = 'compacting'
+            bib_index.compact()
 
         # set update status
         updater_status.update_in_progress = False
         updater_status.last_bib_update = date_to
         logging.info("Status: {}".format(updater_status.update_in_progress))
 
-    def update_authority_index(self, authority_index, updater_status):
+        return deleted_records_ids + updated_records_ids
+
+    def update_authority_index(self, authority_index, updater_status, progress=None, journal=None, changes=None):
+        """
+        Progress of update (phase, deleted, updated, unchanged and missing records count) is reported in progress dict.
+        Deleted and updated records are written to journal transaction (see change_journal), if given.
+        Changes can be listed in advance (see get_changes), otherwise they are listed since the last update
+        with overlap of FULL_UPDATE_OVERLAP. Returns ids of changed records.
+        """
+        progress = {} if progress is None else progress
+
         # set update status
         updater_status.update_in_progress = True
         logging.info("Status indeksera wzorców: {}".format(updater_status.update_in_progress))
 
-        # create dates for queries
-        date_from = updater_status.last_auth_update - timedelta(days=3)
-        date_from_in_iso_with_z = date_from.isoformat(timespec='seconds') + 'Z'
-        date_to = datetime.utcnow()
-        date_to_in_iso_with_z = date_to.isoformat(timespec='seconds') + 'Z'
-
-        # get deleted authority records ids from data.bn.org.pl
-        deleted_query = 'http://data.bn.org.pl/api/authorities.json?updatedDate={}%2C{}&deleted=true&limit=100'.format(
-                                                                        date_from_in_iso_with_z, date_to_in_iso_with_z)
-
-        deleted_records_ids = self.get_records_ids_from_data_bn_for_authority_index_update(deleted_query)
-        logging.info("Rekordów usuniętych: {}".format(len(deleted_records_ids)))
-
-        # get updated authority records ids from data.bn.org.pl
-        updated_query = 'http://data.bn.org.pl/api/authorities.json?updatedDate={}%2C{}&limit=100'.format(
-                                                            date_from_in_iso_with_z, date_to_in_iso_with_z)
-        updated_records_ids = self.get_records_ids_from_data_bn_for_authority_index_update(updated_query)
-        logging.info("Rekordów zmodyfikowanych: {}".format(len(updated_records_ids)))
+        # get deleted and updated authority records ids from data.bn.org.pl
+        if changes is None:
+            changes = self.get_changes('authorities', updater_status.last_auth_update)
+        deleted_records_ids, updated_records_ids, date_to = changes
 
         # delete authority records from authority index by record id (deletes entries by record id and heading)
-        self.remove_deleted_records_from_authority_index(deleted_records_ids, authority_index)
+        progress.update(phase='deleting', deleted=0, updated=0, unchanged=0, missing=0)
+        deleted_records_ids = self.remove_deleted_records_from_authority_index(deleted_records_ids, authority_index,
+                                                                               journal)
+        logging.info("Rekordów usuniętych: {}".format(len(deleted_records_ids)))
+        progress.update(phase='updating', deleted=len(deleted_records_ids))
 
-        # update authority records in authority index by record id (updates entries by record id and heading)
-        self.update_updated_records_in_authority_index(updated_records_ids, authority_index)
+        # update authority records in authority index by record id (updates entries by record id and heading;
+        # records with unchanged heading are skipped; pipelined like bib records update)
+        updated_records_ids = self.update_updated_records_in_authority_index(updated_records_ids, authority_index,
+                                                                             progress, journal)
+        logging.info("Rekordów zmodyfikowanych: {} (bez zmian: {}, brak w data.bn: {})".format(
+            len(updated_records_ids), progress['unchanged'], progress['missing']))
 
         # set update status
         updater_status.update_in_progress = False
         updater_status.last_auth_update = date_to
         logging.info("Status indeksera wzorców: {}".format(updater_status.update_in_progress))
 
-    @staticmethod
-    def update_updated_records_in_authority_index(updated_records_ids, authority_index):
-        chunk_max_size = 100
-        chunks = [updated_records_ids[i:i + chunk_max_size] for i in range(0, len(updated_records_ids), chunk_max_size)]
+        return deleted_records_ids + updated_records_ids
 
-        for chunk in chunks:
-            data = get_marc_authority_data_from_data_bn(chunk)
+    def update_updated_records_in_authority_index(self, updated_records_ids, authority_index, progress=None,
+                                                  journal=None):
+        """
+        Downloads updated records (updated_records_ids may be a generator) and updates them in authority index.
+        Returns list of ids of records with changed heading (unchanged ones and ones not returned by data.bn
+        are counted in progress).
+        """
+        changed_records_ids = []
+        unchanged_count = 0
+        missing_count = 0
 
-            rdr = PermissiveMARCReader(data, to_unicode=True, force_utf8=True, utf8_handling='ignore')
+        for chunk, data in self.client.iter_marc_chunks('authorities', updated_records_ids):
+            chunk_changed_records_ids, chunk_records_ids = self.index_updated_authority_records(
+                data, authority_index, journal, skip_unchanged=True)
+            changed_records_ids.extend(chunk_changed_records_ids)
+            unchanged_count += len(chunk_records_ids) - len(chunk_changed_records_ids)
+            missing_count += len(set(chunk).difference(chunk_records_ids))
+            if progress is not None:
+                progress.update(updated=len(changed_records_ids), unchanged=unchanged_count, missing=missing_count)
 
-            for rcd in rdr:
-                try:
-                    record_id = rcd.get_fields('001')[0].value()
-                    logging.debug(record_id)
-                except IndexError:
-                    continue
-                for fld in AUTHORITY_INDEX_FIELDS:
-                    if fld in rcd:
-                        heading = get_rid_of_punctuation(rcd.get_fields(fld)[0].value())
-                        logging.debug('New heading {}'.format(heading))
-                        if record_id in authority_index:
-                            old_heading = authority_index[record_id]
-                            logging.debug('Old heading from {} {}'.format(record_id, old_heading))
-                            if old_heading == heading:
-                                break
-                            else:
-                                authority_index[record_id] = heading
-                                old_heading_ids = authority_index[old_heading]
-                                logging.debug(old_heading_ids)
-                                if len(old_heading_ids) > 1:
-                                    old_heading_ids.remove(record_id)
-                                    logging.debug('Old heading ids after delete {}'.format(authority_index[old_heading]))
-                                    authority_index.setdefault(heading, []).append(record_id)
-                                    break
-                                else:
-                                    del authority_index[old_heading]
-                                    authority_index.setdefault(heading, []).append(record_id)
-                                    break
-                        else:
-                            authority_index[record_id] = heading
-                            authority_index.setdefault(heading, []).append(record_id)
-                            break
+        return changed_records_ids
 
     @staticmethod
-    def update_updated_records_in_bibliographic_index(updated_records_ids, bib_index):
-        chunk_max_size = 100
-        chunks = [updated_records_ids[i:i + chunk_max_size] for i in range(0, len(updated_records_ids), chunk_max_size)]
+    def index_updated_authority_records(data, authority_index, journal=None, skip_unchanged=False):
+        """
+        Updates authority records from ISO 2709 data in authority index (and writes them to journal, if given).
+        Records which don't change index (already indexed with the same heading or without heading) are skipped,
+        if skip_unchanged. Returns tuple: ids of updated records, ids of all records in data.
+        """
+        rdr = PermissiveMARCScanner(data, ['001'] + AUTHORITY_INDEX_FIELDS, utf8_handling='ignore')
+        updated_records_ids = []
+        records_ids = []
+
+        for rcd in rdr:
+            try:
+                record_id = rcd.value('001')
+                logging.debug(record_id)
+            except KeyError:
+                continue
+            records_ids.append(record_id)
+            heading = None
+            for fld in AUTHORITY_INDEX_FIELDS:
+                if fld in rcd:
+                    heading = get_rid_of_punctuation(rcd.value(fld))
+                    break
+            if skip_unchanged and (heading is None or authority_index.get_heading(record_id) == heading):
+                continue
+            if heading is not None:
+                logging.debug('New heading {}'.format(heading))
+                authority_index.update_record(record_id, heading)
+            updated_records_ids.append(record_id)
+            if journal is not None:
+                journal.upsert(record_id, rcd.raw)
 
-        for chunk in chunks:
-            data = get_marc_bibliographic_data_from_data_bn(chunk)
+        return updated_records_ids, records_ids
 
-            rdr = PermissiveMARCReader(data, to_unicode=True, force_utf8=True, utf8_handling='ignore')
+    def update_updated_records_in_bibliographic_index(self, updated_records_ids, bib_index, progress=None,
+                                                      journal=None):
+        """
+        Downloads updated records (updated_records_ids may be a generator) and updates them in bib index.
+        Returns list of ids of changed records (records equal to indexed ones and ones not returned by data.bn
+        are counted in progress).
+        """
+        changed_records_ids = []
+        unchanged_count = 0
+        missing_count = 0
+
+        for chunk, data in self.client.iter_marc_chunks('bibs', updated_records_ids):
+            rdr = PermissiveMARCScanner(data, ['001'], utf8_handling='ignore')
+            missing_records_ids = set(chunk)
 
             for rcd in rdr:
                 try:
-                    record_id = rcd.get_fields('001')[0].value()
-                except IndexError:
+                    record_id = rcd.value('001')
+                except KeyError:
+                    continue
+                missing_records_ids.discard(record_id)
+                if bib_index.get(record_id) == rcd.raw:
+                    unchanged_count += 1
                     continue
-                bib_index[record_id] = rcd.as_marc()
+                bib_index[record_id] = rcd.raw
+                changed_records_ids.append(record_id)
+                if journal is not None:
+                    journal.upsert(record_id, rcd.raw)
+
+            missing_count += len(missing_records_ids)
+            if progress is not None:
+                progress.update(updated=len(changed_records_ids), unchanged=unchanged_count, missing=missing_count)
+
+        return changed_records_ids
 
     @staticmethod
-    def remove_deleted_records_from_authority_index(records_ids, authority_index):
+    def remove_deleted_records_from_authority_index(records_ids, authority_index, journal=None):
+        """
+        Removes records from authority index (and writes deletes to journal, if given). Returns ids of removed records.
+        """
+        removed_records_ids = []
         for record_id in records_ids:
-            if record_id in authority_index:
-                heading = authority_index.pop(record_id)
-                heading_ids = authority_index[heading]
-                if len(heading_ids) > 1:
-                    heading_ids.remove(record_id)
-                else:
-                    del authority_index[heading]
+            if authority_index.has_id(record_id):
+                authority_index.remove_record(record_id)
+                removed_records_ids.append(record_id)
+                if journal is not None:
+                    journal.delete(record_id)
+        return removed_records_ids
 
     @staticmethod
-    def remove_deleted_records_from_bibliographic_index(records_ids, bib_index):
+    def remove_deleted_records_from_bibliographic_index(records_ids, bib_index, journal=None):
+        """
+        Removes records from bib index (and writes deletes to journal, if given). Returns ids of removed records.
+        """
+        removed_records_ids = []
         for record_id in records_ids:
             if record_id in bib_index:
                 del bib_index[record_id]
+                removed_records_ids.append(record_id)
+                if journal is not None:
+                    journal.delete(record_id)
+        return removed_records_ids
 
-    @staticmethod
-    def get_records_ids_from_data_bn_for_authority_index_update(query):
-        records_ids = []
-
-        while query:
-            r = requests.get(query)
-            #logging.debug("Pobieram: {}".format(query))
-            json_chunk = r.json()
-
-            for rcd in json_chunk['authorities']:
-                try:
-                    record_id = rcd['marc']['fields'][0]['001']
-                except TypeError:
-                    record_id = 'a' + calculate_check_digit(str(rcd['id']))
-                records_ids.append(record_id)
-                #logging.debug("Dołączam rekord nr: {}".format(record_id))
-
-            query = json_chunk['nextPage'] if json_chunk['nextPage'] else None
-
-        return records_ids
-
-    @staticmethod
-    def get_records_ids_from_data_bn_for_bibliographic_index_update(query):
-        records_ids = []
+    def replay_journal(self, journal, index, records_type, position=None):
+        """
+        Applies changes committed to journal after given position (see ChangeJournal.get_position)
+        to index (records_type: 'bibs' or 'authorities'). Returns list of changed records ids.
+        """
+        start = time.perf_counter()
+        changed_records_ids = []
+
+        for operation, record_id, raw in journal.iter_changes(position):
+            changed_records_ids.append(record_id)
+            if records_type == 'bibs':
+                if operation == JOURNAL_DELETE:
+                    self.remove_deleted_records_from_bibliographic_index([record_id], index)
+                else:
+                    index[record_id] = raw
+            else:
+                if operation == JOURNAL_DELETE:
+                    self.remove_deleted_records_from_authority_index([record_id], index)
+                else:
+                    self.index_updated_authority_records(raw, index)
 
-        while query:
-            r = requests.get(query)
-            #logging.debug("Pobieram: {}".format(query))
-            json_chunk = r.json()
+        logging.info('Odtworzono zmian z dziennika {}: {} ({:.1f} s)'.format(
+            journal.path, len(changed_records_ids), time.perf_counter() - start))
+        return changed_records_ids
 
-            for rcd in json_chunk['bibs']:
+    def iter_records_ids_from_data_bn(self, query, records_type):
+        """
+        Yields records ids from all pages of data.bn.org.pl listing (records_type: 'bibs' or 'authorities').
+        """
+        for json_chunk in self.client.iter_json_pages(query):
+            for rcd in json_chunk[records_type]:
                 try:
                     record_id = rcd['marc']['fields'][0]['001']
                 except TypeError:
                     record_id = 'a' + calculate_check_digit(str(rcd['id']))
-                records_ids.append(record_id)
                 #logging.debug("Dołączam rekord nr: {}".format(record_id))
-
-            query = json_chunk['nextPage'] if json_chunk['nextPage'] else None
-
-        return records_ids
+                yield record_id
 
 
 class BibliographicRecordsChunk(object):
-    def __init__(self, query, auth_index, bib_index):
+    """
+    Page of enriched bibliographic records for data.bn.org.pl bibs.json query. Ids of records on the page are listed
+    by local listing index (see BibListingIndex), if it is given and can answer the query, otherwise by data.bn.org.pl.
+    """
+    def __init__(self, query, auth_index, bib_index, enriched_store=None, enriched_store_generation=None,
+                 listing_index=None):
         self.query = query
-        self.json_response = self.get_json_response()
+        self.timer = StageTimer()
+        self.json_response = None
+        # range of numeric ids of records listed locally (see is_listing_changed), None for pages listed by data.bn
+        self.listed_range = None
+        if listing_index is not None:
+            with self.timer.stage('local_listing'):
+                self.json_response = listing_index.get_json_response(query)
+        if self.json_response is not None:
+            BIB_LISTINGS.inc(source='local')
+            self.listed_range = get_listed_range(query, self.json_response)
+        else:
+            with self.timer.stage('upstream_fetch'):
+                self.json_response = self.get_json_response()
+            BIB_LISTINGS.inc(source='data_bn')
 
         self.next_page_for_data_bn = self.get_next_page_for_data_bn()
         self.next_page_for_user = self.create_next_page_for_user()
-        self.records_ids = self.get_bibliographic_records_ids_from_data_bn()
-        self.marc_chunk = self.get_bibliographic_records_in_marc_from_local_bib_index(bib_index)
-        self.marc_objects_chunk = self.read_marc_from_binary_in_chunks()
-        self.marc_processed_objects_chunk = self.batch_process_records(auth_index)
-        self.xml_processed_chunk = self.produce_output_xml()
+        with self.timer.stage('id_extraction'):
+            self.records_ids = self.get_bibliographic_records_ids_from_data_bn()
+        with self.timer.stage('local_lookup'):
+            self.marc_records = self.get_bibliographic_records_in_marc_from_local_bib_index(bib_index)
+        self.observe_records()
+
+        # records are parsed, processed and rendered lazily - while the response is streamed;
+        # complete output is kept for next requests (by output format), concurrent requests wait for output
+        # being rendered (future by output format)
+        # rendered records are taken from (and put to) enriched records store, if given - generation
+        # is the one of the store read before indexes (see EnrichedRecordsStore.put)
+        self.auth_index = auth_index
+        self.enriched_store = enriched_store
+        self.enriched_store_generation = enriched_store_generation
+        self.rendered_outputs = {}
+        self.rendering = {}
+        self.rendering_lock = threading.Lock()
+
+    def observe_records(self):
+        self.timer.observe(CHUNK_STAGE_SECONDS)
+        CHUNK_RECORDS.observe(len(self.records_ids), source='listed')
+        CHUNK_RECORDS.observe(len(self.marc_records), source='local')
+
+        missing_count = len(self.records_ids) - len(self.marc_records)
+        if missing_count:
+            LOCAL_INDEX_MISSES.inc(missing_count)
+            logging.debug('Brak rekordów w lokalnym indeksie: {} z {} ({})'.format(
+                missing_count, len(self.records_ids), self.query))
 
     def get_json_response(self):
         if 'http://data.bn.org.pl/api/bibs.json?{}' not in self.query:
-            processed_query = 'http://data.bn.org.pl/api/bibs.json?{}'.format(self.query)
+            processed_query = data_bn_client.get_api_url('bibs.json?{}'.format(self.query))
         else:
             processed_query = self.query
 
-        r = requests.get(processed_query)
-        json_chunk = r.json()
+        json_chunk = data_bn_client.get_json(processed_query)
         return json_chunk
 
     def get_bibliographic_records_ids_from_data_bn(self):
@@ -365,6 +766,26 @@ class BibliographicRecordsChunk(object):
     def get_next_page_for_data_bn(self):
         return self.json_response['nextPage']
 
+    def is_listing_changed(self, numeric_ids):
+        """
+        Returns True if page is listed locally and any of records (sorted numeric ids) added to, deleted from
+        or changed in listing index is in its range - e.g. new record inserted between records of the page.
+        """
+        if self.listed_range is None:
+            return False
+        since_id, last_id = self.listed_range
+        position = bisect.bisect_right(numeric_ids, since_id)
+        return position < len(numeric_ids) and (last_id is None or numeric_ids[position] <= last_id)
+
+    def get_next_page_query(self):
+        """
+        Returns query for the next page in the same form as query of /get_bibs/{query} (url-decoded),
+        or None for the last page.
+        """
+        if self.next_page_for_data_bn:
+            return unquote(self.next_page_for_data_bn.split('json?')[1])
+        return None
+
     def create_next_page_for_user(self):
         if 'localhost' in BASE_URL:
             base = BASE_URL
@@ -389,94 +810,820 @@ class BibliographicRecordsChunk(object):
 
         if records_ids_length <= 100:
             ids_for_query = '%2C'.join(record_id for record_id in self.records_ids)
-            query = 'http://data.bn.org.pl/api/bibs.marc?id={}&amp;limit=100'.format(ids_for_query)
+            query = data_bn_client.get_api_url('bibs.marc?id={}&amp;limit=100'.format(ids_for_query))
 
-            marc_data_chunk = bytearray(requests.get(query).content)
+            marc_data_chunk = bytearray(data_bn_client.get(query).content)
 
             return marc_data_chunk
 
     def get_bibliographic_records_in_marc_from_local_bib_index(self, bib_index):
-        marc_data_chunk_list = []
+        """
+        Returns list of tuples: record id, raw record (ISO 2709) - for records found in local bib index.
+        """
+        marc_records = []
 
         for record_id in self.records_ids:
             if record_id in bib_index:
-                marc_data_chunk_list.append(bib_index[record_id])
+                marc_records.append((record_id, bib_index[record_id]))
 
-        marc_data_chunk_joined_to_one_bytearray = bytearray().join(marc_data_chunk_list)
+        return marc_records
 
-        return marc_data_chunk_joined_to_one_bytearray
+    def iter_rendered_records(self, output_format, timer=None):
+        """
+        Yields processed records rendered in given format (see ENRICHED_RECORD_RENDERERS).
+        Time of stages (parse, enrich, render) is added to timer (StageTimer), if given.
+        """
+        found = {}
+
+        def lookup(term_to_search):
+            if term_to_search not in found:
+                found[term_to_search] = self.auth_index.get_first_id(term_to_search)
+            return found[term_to_search]
+
+        for record_id, raw_record in self.marc_records:
+            if self.enriched_store is not None:
+                rendered_record = self.enriched_store.get_or_render(record_id, raw_record, output_format, lookup,
+                                                                    self.enriched_store_generation, timer)
+            else:
+                rendered_record = render_enriched_record(raw_record, output_format, lookup, timer)
+            if rendered_record is not None:
+                yield rendered_record
+            else:
+                MARC_READER_FAILED.inc(source='bibs_chunk')
 
-    def read_marc_from_binary_in_chunks(self):
-        marc_objects_chunk = []
+    def iter_output_xml(self, timer=None):
+        yield '<resp><nextPage>{}</nextPage><bibs>'.format(escape_text(self.next_page_for_user))
 
-        marc_rdr = PermissiveMARCReader(self.marc_chunk, to_unicode=True, force_utf8=True, utf8_handling='ignore')
-        for rcd in marc_rdr:
-            marc_objects_chunk.append(rcd)
+        for rendered_record in self.iter_rendered_records('xml', timer):
+            yield '<bib>' + rendered_record + '</bib>'
 
-        return marc_objects_chunk
+        yield '</bibs></resp>'
 
-    def batch_process_records(self, auth_index):
-        processed_records = [process_record(rcd, auth_index) for rcd in self.marc_objects_chunk]
-        return processed_records
+    def iter_output_jsonl(self, timer=None):
+        yield json.dumps({'nextPage': self.next_page_for_user}) + '\n'
+
+        yield from self.iter_rendered_records('jsonl', timer)
+
+    def iter_output(self, output_format='xml'):
+        """
+        Yields output (utf-8 encoded parts) in given format:
+        xml - <resp> with <nextPage> and processed records in MARCXML wrapped in <bib>,
+        jsonl - first line with nextPage, then one processed record in MARC-in-JSON per line.
+        Output being rendered for other request is waited for (at most CHUNK_OUTPUT_WAIT_TIMEOUT seconds, then
+        it is rendered again) and yielded at once.
+        """
+        if output_format in self.rendered_outputs:
+            yield self.rendered_outputs[output_format]
+            return
 
-    def produce_output_xml(self):
-        wrapped_processed_records_in_xml = []
+        with self.rendering_lock:
+            rendering = self.rendering.get(output_format)
+            if rendering is None:
+                rendering = self.rendering[output_format] = Future()
+                first = True
+            else:
+                first = False
 
-        for rcd in self.marc_processed_objects_chunk:
-            xmlized_rcd = marcxml.record_to_xml(rcd, namespace=True)
-            wrapped_rcd = '<bib>' + str(xmlized_rcd)[2:-1] + '</bib>'
-            wrapped_processed_records_in_xml.append(wrapped_rcd)
+        iter_output_in_format = self.iter_output_xml if output_format == 'xml' else self.iter_output_jsonl
 
-        joined_to_str = ''.join(rcd for rcd in wrapped_processed_records_in_xml)
+        if not first:
+            try:
+                output = rendering.result(CHUNK_OUTPUT_WAIT_TIMEOUT)
+            except FutureTimeoutError:
+                # response is already started (requests wait for output before it - see wait_for_output),
+                # so output is rendered again instead of breaking it
+                yield from (part.encode('utf-8') for part in iter_output_in_format())
+                return
+            # None - response of the other request was closed before output was complete
+            if output is None:
+                yield from self.iter_output(output_format)
+            else:
+                yield output
+            return
+
+        parts = []
+        timer = StageTimer()
+
+        try:
+            for part in iter_output_in_format(timer):
+                encoded_part = part.encode('utf-8')
+                parts.append(encoded_part)
+                yield encoded_part
+        except BaseException as e:
+            with self.rendering_lock:
+                del self.rendering[output_format]
+            if isinstance(e, GeneratorExit):
+                rendering.set_result(None)
+            else:
+                rendering.set_exception(e)
+            raise
+
+        output = self.rendered_outputs[output_format] = b''.join(parts)
+        with self.rendering_lock:
+            del self.rendering[output_format]
+        rendering.set_result(output)
+
+        timer.observe(CHUNK_STAGE_SECONDS, CHUNK_RENDERING_STAGES)
+        tracer.record('get_bibs', self.query, dict(self.timer.stages, **timer.stages), format=output_format,
+                      listed=len(self.records_ids), local=len(self.marc_records))
+
+    def wait_for_output(self, output_format='xml'):
+        """
+        Waits for output in given format being rendered for other request (at most CHUNK_OUTPUT_WAIT_TIMEOUT
+        seconds), so that response can be started with complete output. SingleFlightTimeout is raised if it takes
+        longer. Returns output or None, if it is not rendered nor being rendered.
+        """
+        with self.rendering_lock:
+            rendering = self.rendering.get(output_format)
+        if rendering is None:
+            return self.rendered_outputs.get(output_format)
+        try:
+            return rendering.result(CHUNK_OUTPUT_WAIT_TIMEOUT)
+        except FutureTimeoutError:
+            raise SingleFlightTimeout('Timeout of waiting for output of page: {}'.format(self.query))
 
-        out_xml = '<resp><nextPage>{}</nextPage><bibs>{}</bibs></resp>'.format(self.next_page_for_user, joined_to_str)
+    def produce_output(self, output_format='xml'):
+        return b''.join(self.iter_output(output_format))
 
-        return out_xml
+    def get_size_in_bytes(self):
+        return sum(len(raw_record) for record_id, raw_record in self.marc_records) + \
+            sum(len(output) for output in self.rendered_outputs.values())
 
 
 class BibliographicRecordsChunksCache(object):
-    def __init__(self, max_chunks):
+    """
+    Cache of bibliographic records chunks (by query) with LRU eviction, limits of chunks count and size in bytes
+    (MARC chunk and rendered outputs), time to live and invalidation after index updates.
+    Chunks missing in cache are created once for concurrent requests of the same query (see create_and_add),
+    callers wait for chunk being created at most wait_timeout seconds.
+    """
+    def __init__(self, max_chunks, max_bytes=None, ttl=None, wait_timeout=None):
         self.max_chunks = max_chunks
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.cache = OrderedDict()
+        self.added = {}
+        self.lock = threading.Lock()
+        self.creating = SingleFlight('chunks', wait_timeout)
+        # bumped by invalidations (see add_to_cache)
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.rejected = 0
+
+    def __contains__(self, query):
+        return query in self.cache
+
+    def get_from_cache(self, query):
+        with self.lock:
+            bib_chunk = self.cache.get(query)
+
+            if bib_chunk is not None and self.ttl is not None and time.monotonic() - self.added[query] > self.ttl:
+                self.remove_from_cache(query)
+                self.expirations += 1
+                bib_chunk = None
+
+            if bib_chunk is None:
+                self.misses += 1
+                return None
+
+            self.cache.move_to_end(query)
+            self.hits += 1
+            return bib_chunk
+
+    def create_and_add(self, query, create_chunk):
+        """
+        Creates chunk for query with create_chunk(query) and adds it to cache. Concurrent calls for the same query
+        (requests, prefetcher) wait for chunk created by the first one and get it (or its exception);
+        SingleFlightTimeout is raised if it takes longer than wait_timeout.
+        """
+        return self.creating.do(query, self.create_chunk_for_cache, query, create_chunk)
 
-        self.chunks_in_cache_count = 0
-        self.cache = {}
-
-    def add_to_cache(self, bib_chunk):
-        self.cache[bib_chunk.query] = bib_chunk
-        self.chunks_in_cache_count += 1
-        #logging.debug('Cache count: {}'.format(self.chunks_in_cache_count))
+    def create_chunk_for_cache(self, query, create_chunk):
+        # generation is read before chunk reads indexes (see add_to_cache)
+        generation = self.generation
+        bib_chunk = create_chunk(query)
+        self.add_to_cache(bib_chunk, generation)
+        return bib_chunk
 
-    def flush_cache(self):
-        if self.chunks_in_cache_count == self.max_chunks:
+    def add_to_cache(self, bib_chunk, generation=None):
+        """
+        Adds chunk to cache. Chunk created before invalidation (generation of cache read before chunk was created
+        differs from the current one) may contain old versions of records - it is not added.
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                self.rejected += 1
+                return
+            self.cache[bib_chunk.query] = bib_chunk
+            self.cache.move_to_end(bib_chunk.query)
+            self.added[bib_chunk.query] = time.monotonic()
+            self.evict()
+
+    def remove_from_cache(self, query):
+        del self.cache[query]
+        del self.added[query]
+
+    def get_size_in_bytes(self):
+        return sum(bib_chunk.get_size_in_bytes() for bib_chunk in self.cache.values())
+
+    def evict(self):
+        # chunks grow after they are rendered, so size is summed up on every eviction check
+        while len(self.cache) > self.max_chunks or (self.max_bytes is not None and len(self.cache) > 1 and
+                                                    self.get_size_in_bytes() > self.max_bytes):
+            self.remove_from_cache(next(iter(self.cache)))
+            self.evictions += 1
+
+    def invalidate_records(self, records_ids, listed=False):
+        """
+        Removes chunks containing any of given bibliographic records; listed - records were also changed
+        in listing index, so chunks listed locally whose range contains any of them are removed too.
+        """
+        records_ids = set(records_ids)
+        numeric_ids = sorted(numeric_id for numeric_id in map(get_numeric_id, records_ids)
+                             if numeric_id is not None) if listed else []
+        with self.lock:
+            self.generation += 1
+            for query in [query for query, bib_chunk in self.cache.items()
+                          if records_ids.intersection(bib_chunk.records_ids) or
+                          bib_chunk.is_listing_changed(numeric_ids)]:
+                self.remove_from_cache(query)
+                self.invalidations += 1
+
+    def invalidate_all(self):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.cache)
             self.cache.clear()
-            self.chunks_in_cache_count = 0
+            self.added.clear()
+
+    def get_stats(self):
+        with self.lock:
+            requests_count = self.hits + self.misses
+            return {'chunks': len(self.cache), 'size_in_bytes': self.get_size_in_bytes(),
+                    'max_chunks': self.max_chunks, 'max_bytes': self.max_bytes, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / requests_count, 4) if requests_count else 0.0,
+                    'evictions': self.evictions, 'expirations': self.expirations, 'invalidations': self.invalidations,
+                    'rejected': self.rejected}
+
+
+class EnrichedRecordsStore(object):
+    """
+    Store of enriched bibliographic records (local ones) rendered in output formats, by record id - filled lazily
+    by served chunks and single records or by bulk pre-pass (see fill); LRU eviction and limit of size in bytes.
+    Entries are not expired: record is removed only when it is updated or when heading it depends on changes
+    in authority index (see invalidate_records and ReverseIndex.get_affected_records_ids).
+
+    Every invalidation increments generation; records rendered with indexes read before invalidation are not stored
+    (put gets generation read before indexes), so store never gets stale entries from requests in progress.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, record_id, output_format):
+        with self.lock:
+            rendered_records = self.entries.get(record_id)
+            rendered_record = rendered_records.get(output_format) if rendered_records is not None else None
+
+            if rendered_record is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(record_id)
+            self.hits += 1
+            return rendered_record
+
+    def put(self, record_id, output_format, rendered_record, generation):
+        """
+        Stores rendered record, unless store was invalidated since given generation was read.
+        """
+        with self.lock:
+            if generation != self.generation:
+                self.rejected += 1
+                return
+
+            rendered_records = self.entries.setdefault(record_id, {})
+            old_rendered_record = rendered_records.get(output_format)
+            if old_rendered_record is not None:
+                self.size -= sys.getsizeof(old_rendered_record)
+            rendered_records[output_format] = rendered_record
+            self.size += sys.getsizeof(rendered_record)
+            self.entries.move_to_end(record_id)
+            self.evict()
+
+    def get_or_render(self, record_id, raw_record, output_format, lookup, generation, timer=None):
+        """
+        Returns enriched record in given format from store or renders and stores it (see render_enriched_record).
+        """
+        rendered_record = self.get(record_id, output_format)
+        if rendered_record is None:
+            rendered_record = render_enriched_record(raw_record, output_format, lookup, timer)
+            if rendered_record is not None:
+                self.put(record_id, output_format, rendered_record, generation)
+        return rendered_record
+
+    def get_or_render_all(self, record_id, raw_record, lookup, generation):
+        """
+        Returns dict: output format: enriched record - in all formats (see ENRICHED_RECORD_RENDERERS),
+        formats missing in store are rendered (and stored) from one enriched record. None if record can't be read.
+        """
+        rendered_records = {output_format: self.get(record_id, output_format)
+                            for output_format in ENRICHED_RECORD_RENDERERS}
+        missing_formats = [output_format for output_format, rendered_record in rendered_records.items()
+                           if rendered_record is None]
+
+        if missing_formats:
+            rcd = read_enriched_record(raw_record, lookup)
+            if rcd is None:
+                return None
+            for output_format in missing_formats:
+                rendered_records[output_format] = ENRICHED_RECORD_RENDERERS[output_format](rcd)
+                self.put(record_id, output_format, rendered_records[output_format], generation)
+
+        return rendered_records
+
+    def remove(self, record_id):
+        self.size -= sum(sys.getsizeof(rendered_record) for rendered_record in self.entries.pop(record_id).values())
+
+    def evict(self):
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def invalidate_records(self, records_ids):
+        with self.lock:
+            self.generation += 1
+            for record_id in records_ids:
+                if record_id in self.entries:
+                    self.remove(record_id)
+                    self.invalidations += 1
+
+    def invalidate_all(self):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.size = 0
+
+    def fill(self, bib_index, auth_index, generation, output_formats=('xml',)):
+        """
+        Bulk pre-pass: renders records of bib index in given formats until store is full.
+        Stops when store is invalidated (indexes were updated). Returns number of stored records.
+        """
+        start = time.perf_counter()
+        stored = 0
+
+        for record_id in bib_index:
+            if self.size >= self.max_bytes or generation != self.generation:
+                break
+            for output_format in output_formats:
+                self.get_or_render(record_id, bib_index[record_id], output_format, auth_index.get_first_id,
+                                   generation)
+            stored += 1
+
+        logging.info('Wypełniono magazyn wzbogaconych rekordów: {} rekordów, {} B ({:.1f} s)'.format(
+            stored, self.size, time.perf_counter() - start))
+        return stored
+
+    def get_stats(self):
+        with self.lock:
+            requests_count = self.hits + self.misses
+            return {'records': len(self.entries), 'size_in_bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / requests_count, 4) if requests_count else 0.0,
+                    'evictions': self.evictions, 'invalidations': self.invalidations, 'rejected': self.rejected}
+
+
+class Harvest(object):
+    """
+    Sequence of /get_bibs pages requested by one client (following nextPage) in given output format.
+    """
+    def __init__(self, output_format='xml'):
+        self.last_request = time.monotonic()
+        self.cancelled = False
+        self.output_format = output_format
+
+    def touch(self):
+        self.last_request = time.monotonic()
+
+    def is_active(self, idle_timeout):
+        return not self.cancelled and time.monotonic() - self.last_request <= idle_timeout
+
+
+class BibliographicRecordsChunksPrefetcher(object):
+    """
+    Builds chunks for next pages of served chunks in background (bounded thread pool) and puts them to chunks cache,
+    so harvester's next request is a cache hit.
+    Prefetching goes max_depth pages ahead of the last served page of a harvest; at most max_workers pages
+    are built (or waiting to be built) at once. Harvest not requested for idle_timeout seconds is cancelled.
+    """
+    def __init__(self, chunks_cache, create_chunk, max_workers=2, max_depth=1, idle_timeout=300):
+        self.chunks_cache = chunks_cache
+        self.create_chunk = create_chunk
+        self.max_workers = max_workers
+        self.max_depth = max_depth
+        self.idle_timeout = idle_timeout
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetcher')
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.harvests = {}
+        self.closed = False
+
+        self.prefetched = 0
+        self.cancelled = 0
+        self.failed = 0
+
+    def get_harvest(self, query, output_format='xml'):
+        """
+        Returns harvest the served query belongs to (new one if query was not prefetched) and marks it as active;
+        next pages are rendered in output format of the served query.
+        """
+        with self.lock:
+            harvest = self.harvests.pop(query, None) or Harvest(output_format)
+            harvest.output_format = output_format
+            harvest.touch()
+            self.cancel_idle_harvests()
+            return harvest
+
+    def cancel_idle_harvests(self):
+        for query, harvest in list(self.harvests.items()):
+            if not harvest.is_active(self.idle_timeout):
+                harvest.cancelled = True
+                del self.harvests[query]
+                future = self.in_flight.pop(query, None)
+                if future is not None and future.cancel():
+                    self.cancelled += 1
+
+    def cancel(self, query):
+        """
+        Stops prefetching pages of harvest the query belongs to.
+        """
+        with self.lock:
+            harvest = self.harvests.get(query)
+            if harvest is not None:
+                harvest.cancelled = True
+                self.cancel_idle_harvests()
+
+    def wait_for_prefetched_chunk(self, query, timeout):
+        """
+        Returns chunk being prefetched for given query (waits for it at most timeout seconds) or None.
+        """
+        with self.lock:
+            future = self.in_flight.get(query)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout)
+        except Exception:
+            return None
+
+    def prefetch_after(self, bib_chunk, harvest, depth=0):
+        """
+        Schedules prefetch of the first page after bib_chunk (and max_depth pages ahead) which is not cached yet.
+        """
+        while depth < self.max_depth and harvest.is_active(self.idle_timeout):
+            next_query = bib_chunk.get_next_page_query()
+            if not next_query:
+                return
+            depth += 1
+
+            with self.lock:
+                if next_query in self.in_flight:
+                    return
+                if next_query in self.chunks_cache:
+                    self.harvests[next_query] = harvest
+                    bib_chunk = self.chunks_cache.cache.get(next_query, bib_chunk)
+                    continue
+                if len(self.in_flight) >= self.max_workers or self.closed:
+                    return
+
+                self.harvests[next_query] = harvest
+                self.in_flight[next_query] = self.executor.submit(self.prefetch, next_query, harvest, depth)
+                return
+
+    def prefetch(self, query, harvest, depth):
+        try:
+            if not harvest.is_active(self.idle_timeout):
+                self.cancelled += 1
+                return None
+
+            # chunk requested meanwhile by harvester is created once (see chunks cache create_and_add)
+            bib_chunk = self.chunks_cache.create_and_add(query, self.create_chunk)
+            # render output in background too (in format the harvester asks for) - served page is then only a copy
+            # from cache
+            bib_chunk.produce_output(harvest.output_format)
+            self.prefetched += 1
+            logging.debug('Pobrano z wyprzedzeniem: {}'.format(query))
+        except Exception:
+            logging.exception('Błąd pobierania z wyprzedzeniem: {}'.format(query))
+            self.failed += 1
+            return None
+        finally:
+            with self.lock:
+                self.in_flight.pop(query, None)
+
+        self.prefetch_after(bib_chunk, harvest, depth)
+        return bib_chunk
+
+    def shutdown(self, wait=True):
+        """
+        Stops prefetching: cancels all harvests and prefetches waiting for thread, waits for running ones (if wait).
+        """
+        with self.lock:
+            self.closed = True
+            for harvest in self.harvests.values():
+                harvest.cancelled = True
+            self.harvests.clear()
+            for query, future in list(self.in_flight.items()):
+                if future.cancel():
+                    del self.in_flight[query]
+                    self.cancelled += 1
+        self.executor.shutdown(wait)
+
+    def get_stats(self):
+        with self.lock:
+            return {'in_flight': len(self.in_flight), 'harvests': len(self.harvests), 'prefetched': self.prefetched,
+                    'cancelled': self.cancelled, 'failed': self.failed}
+
+
+class BulkEnrichment(object):
+    """
+    Enrichment of bibliographic records supplied by client (ISO 2709 or MARCXML stream).
+    Records are read incrementally and processed in batches of batch_size records, so only one batch is kept
+    in memory, whatever the input size; output of each batch is produced before the next one is read.
+    """
+    def __init__(self, marc_stream, input_format, output_format, auth_index, batch_size=1000):
+        self.marc_stream = marc_stream
+        self.input_format = input_format
+        self.output_format = output_format
+        self.auth_index = auth_index
+        self.batch_size = batch_size
+        self.totals = {'batches': 0, 'read': 0, 'failed': 0, 'linked': 0}
+        self.error = None
+
+    def get_reader(self):
+        if self.input_format == 'xml':
+            return PermissiveMARCXMLReader(self.marc_stream)
+        return PermissiveMARCReader(self.marc_stream, to_unicode=True, force_utf8=True, utf8_handling='ignore')
+
+    def iter_records(self, rdr):
+        try:
+            yield from rdr
+        except (RecordLengthInvalid, ValueError) as e:
+            # record length is not a number or stream is cut - nothing more can be read
+            rdr.failed += 1
+            self.error = 'Unreadable ISO 2709 stream after {} records: {!r}'.format(rdr.count, e)
+
+    def iter_batches(self):
+        """
+        Yields tuples: batch (list) of processed records, batch statistics (records read, failed, fields linked).
+        """
+        rdr = self.get_reader()
+        records = self.iter_records(rdr)
+
+        while True:
+            count_before, failed_before = rdr.count, rdr.failed
+            batch = list(islice(records, self.batch_size))
+            if not batch and rdr.failed == failed_before:
+                break
+
+            stats = {'batch': self.totals['batches'] + 1, 'read': rdr.count - count_before,
+                     'failed': rdr.failed - failed_before, 'linked': 0}
+            batch = process_records(batch, self.auth_index, stats)
+
+            self.totals['batches'] += 1
+            for key in ('read', 'failed', 'linked'):
+                self.totals[key] += stats[key]
+            MARC_READER_FAILED.inc(stats['failed'], source='enrich')
+            logging.info('Wzbogacanie rekordów: paczka {batch}, wczytano {read}, błędnych {failed}, '
+                         'powiązano pól {linked}'.format(**stats))
+            yield batch, stats
+
+            if not batch:
+                break
+
+        if getattr(rdr, 'parse_error', None):
+            self.error = 'Malformed MARCXML after {} records: {}'.format(rdr.count, rdr.parse_error)
+        if self.error:
+            logging.warning('Wzbogacanie rekordów przerwane: {}'.format(self.error))
+
+    def get_summary(self):
+        return dict(self.totals, error=self.error)
+
+    def iter_output(self):
+        """
+        Yields output (utf-8 encoded parts, one per batch) in output format:
+        marc - ISO 2709 records,
+        xml - MARCXML collection, statistics of batches and summary in comments,
+        jsonl - one record in MARC-in-JSON per line, statistics of batches in lines with "stats"
+        and summary in the last line (with "summary").
+        """
+        if self.output_format == 'xml':
+            yield COLLECTION_START_TAG.encode('utf-8')
+
+        for batch, stats in self.iter_batches():
+            if self.output_format == 'marc':
+                yield b''.join(rcd.as_marc() for rcd in batch)
+            elif self.output_format == 'xml':
+                parts = [record_to_marcxml(rcd) for rcd in batch]
+                parts.append('<!-- stats: {} -->'.format(json.dumps(stats)))
+                yield ''.join(parts).encode('utf-8')
+            else:
+                parts = [record_to_jsonl(rcd) for rcd in batch]
+                parts.append(json.dumps({'stats': stats}) + '\n')
+                yield ''.join(parts).encode('utf-8')
+
+        if self.output_format == 'xml':
+            summary = json.dumps(self.get_summary(), ensure_ascii=False).replace('--', '- -')
+            yield '<!-- summary: {} -->{}'.format(summary, COLLECTION_END_TAG).encode('utf-8')
+        elif self.output_format == 'jsonl':
+            yield (json.dumps({'summary': self.get_summary()}, ensure_ascii=False) + '\n').encode('utf-8')
 
 
 class MarcRecordWrapper(object):
-    def __init__(self, marc_record, authority_index):
+    """
+    Bibliographic record with its processed version. Processed record is not built again if it is given
+    as enriched_records (dict: output format: rendered record, see EnrichedRecordsStore.get_or_render_all).
+    """
+    def __init__(self, marc_record, authority_index, enriched_records=None):
         self.marc_record = marc_record
         self.marc_record_as_dict = self.marc_record.as_dict()
-        self.marc_record_processed = process_record(self.marc_record, authority_index)
-        self.marc_record_processed_as_dict = self.marc_record_processed.as_dict()
-        self.marc_record_processed_ax_xml = marcxml.record_to_xml(self.marc_record, namespace=True)
+        if enriched_records is None:
+            self.marc_record_processed = process_record(self.marc_record, authority_index)
+            self.marc_record_processed_as_dict = self.marc_record_processed.as_dict()
+            self.marc_record_processed_ax_xml = marcxml.record_to_xml(self.marc_record, namespace=True)
+        else:
+            self.marc_record_processed_as_dict = json.loads(enriched_records['jsonl'])
+            # encoded like output of marcxml.record_to_xml above
+            self.marc_record_processed_ax_xml = marcxml_to_ascii(enriched_records['xml'])
 
 
 class Authority(object):
     def __init__(self, query, authority_index):
         self.query = query
-        self.value_from_dict = authority_index[self.query]
-        self.authority_heading = self.get_heading()
-        self.authority_ids = self.get_ids()
-
-    def get_heading(self):
-        if isinstance(self.value_from_dict, str):
-            return self.value_from_dict
-        else:
+        self.authority_heading = self.get_heading(authority_index)
+        self.authority_ids = self.get_ids(authority_index)
+
+    def get_heading(self, authority_index):
+        heading = authority_index.get_heading(self.query)
+        if heading is not None:
+            return heading
+        elif authority_index.has_heading(self.query):
             return self.query
+        else:
+            return None
 
-    def get_ids(self):
-        if isinstance(self.value_from_dict, list):
-            return self.value_from_dict
+    def get_ids(self, authority_index):
+        if authority_index.has_heading(self.query):
+            return authority_index.get_ids(self.query)
         else:
             return self.query
 
+
+class AuthorityBatchLookup(object):
+    """
+    Lookup of many authority ids and headings at once. Queries are normalized like indexed headings
+    (see get_rid_of_punctuation) and each distinct query is looked up once.
+    """
+    def __init__(self, authority_index):
+        self.authority_index = authority_index
+
+    @staticmethod
+    def read_queries(body, max_queries):
+        """
+        Returns queries from request body: JSON list of authority ids and/or headings (at most max_queries).
+        Raises ValueError (with description for client) if body is malformed.
+        """
+        try:
+            queries = json.loads(body)
+        except ValueError:
+            raise ValueError('Request body is not valid JSON')
+
+        if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+            raise ValueError('Request body must be JSON list of authority ids and/or headings')
+        if len(queries) > max_queries:
+            raise ValueError('Too many queries: {} (max {})'.format(len(queries), max_queries))
+        return queries
+
+    def lookup_one(self, query):
+        """
+        Returns tuple: heading, list of ids - or None, [] if query matches neither id nor heading.
+        """
+        heading = self.authority_index.get_heading(query)
+        if heading is not None:
+            return heading, [query]
+
+        normalized_query = get_rid_of_punctuation(query)
+        return (normalized_query, self.authority_index.get_ids(normalized_query)) \
+            if self.authority_index.has_heading(normalized_query) else (None, [])
+
+    def lookup(self, queries):
+        """
+        Returns dict with lists of: hits (query with one id), ambiguous (heading with several ids),
+        misses (queries not found) - in order of queries.
+        """
+        results = {}
+        response = {'hits': [], 'ambiguous': [], 'misses': []}
+
+        for query in queries:
+            if query in results:
+                continue
+            heading, ids = results[query] = self.lookup_one(query)
+
+            if not ids:
+                response['misses'].append(query)
+            elif len(ids) == 1:
+                response['hits'].append({'query': query, 'heading': heading, 'id': ids[0]})
+            else:
+                response['ambiguous'].append({'query': query, 'heading': heading, 'ids': ids})
+
+        return response
+
+
+class AuthoritySearch(object):
+    """
+    Search of authority headings by prefix or by similarity to query (see AuthoritySearchIndex).
+    """
+    def __init__(self, search_index, authority_index, prefix=None, query=None, limit=20):
+        self.search_index = search_index
+        self.authority_index = authority_index
+        self.prefix = prefix
+        self.query = query
+        self.limit = limit
+
+    def get_results(self):
+        """
+        Returns list of dicts: heading, ids (and similarity, for search by query).
+        """
+        if self.prefix is not None:
+            return [{'heading': heading, 'ids': self.authority_index.get_ids(heading)}
+                    for heading in self.search_index.search_prefix(self.prefix, self.limit)]
+
+        return [{'heading': heading, 'ids': self.authority_index.get_ids(heading), 'similarity': similarity}
+                for heading, similarity in self.search_index.search(self.query, self.limit)]
+
+
+def get_authority_changes(old_authority_index, new_authority_index, records_ids):
+    """
+    Returns list of tuples: record id, old heading, new heading - for records which heading has changed.
+    """
+    changes = []
+    for record_id in dict.fromkeys(records_ids):
+        old_heading = old_authority_index.get_heading(record_id)
+        new_heading = new_authority_index.get_heading(record_id)
+        if old_heading != new_heading:
+            changes.append((record_id, old_heading, new_heading))
+    return changes
+
+
+class AuthorityChanges(object):
+    """
+    Authority records changed by update job with bibliographic records affected by each change
+    (records with terms equal to old or new heading, see ReverseIndex).
+    """
+    def __init__(self, job, reverse_index):
+        self.job = job
+        self.reverse_index = reverse_index
+
+    def as_dict(self):
+        changes = []
+        for record_id, old_heading, new_heading in self.job.authority_changes:
+            changes.append({'id': record_id, 'old_heading': old_heading, 'new_heading': new_heading,
+                            'bibs': self.reverse_index.get_affected_records_ids([old_heading, new_heading])})
+        return {'job_id': self.job.job_id, 'state': self.job.state, 'changes': changes}
+
+
+class AuthorityBibs(object):
+    """
+    Bibliographic records linked (or linkable) to authority record - given by id or heading.
+    """
+    def __init__(self, query, authority_index, reverse_index):
+        self.query = query
+        heading = authority_index.get_heading(query)
+        self.heading = heading if heading is not None else get_rid_of_punctuation(query)
+        self.authority_ids = authority_index.get_ids(self.heading)
+        self.bibs = reverse_index.get_records_ids(self.heading)
+
+    def as_dict(self):
+        return {'query': self.query, 'heading': self.heading, 'authority_ids': self.authority_ids, 'bibs': self.bibs}
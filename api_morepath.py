@@ -1,5 +1,26 @@
+import copy
 import morepath
+import requests
+from datetime import timezone
+from webob.exc import HTTPBadGateway, HTTPBadRequest, HTTPGatewayTimeout
 from api_core import *
+from index_snapshot import load_or_create_index, load_index_snapshot, save_index_snapshot
+from index_snapshot import get_journaled_snapshot_meta, is_snapshot_due
+from change_journal import ChangeJournal
+from bib_store import CompressedMarcRecordStore
+from authority_search import AuthoritySearchIndex
+from reverse_index import ReverseIndex, create_reverse_index
+from bib_listing import create_bib_listing_index
+from indexer_config import AUTHORITY_FUZZY_FALLBACK, AUTHORITY_FUZZY_MIN_SIMILARITY
+from indexer_config import ENRICHED_STORE, ENRICHED_STORE_MAX_BYTES, ENRICHED_STORE_PREFILL
+from indexer_config import ENRICHED_STORE_PREFILL_FORMATS
+from indexer_config import BIB_STORE_COMPRESSION, LOCAL_BIB_LISTING
+from indexer_config import INDEX_SYNC, INDEX_SYNC_INTERVAL, INDEX_SYNC_OVERLAP
+from parallel_indexer import create_local_bib_index_parallel, create_authority_index_parallel
+from parallel_indexer import create_compressed_bib_index_parallel
+from authority_index import get_deep_size
+from metrics import MetricsRegistry, Tracer, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from single_flight import SingleFlight, SingleFlightTimeout
 
 
 # initialise app
@@ -24,20 +45,50 @@ def get_static_html(self, request):
     return self.open_docs_from_file()
 
 
+# timeout of waiting for page or record being created for concurrent identical request (see SingleFlight)
+
+@App.view(model=SingleFlightTimeout)
+def render_single_flight_timeout(self, request):
+    return HTTPGatewayTimeout(str(self))
+
+
 # single bib record
 
 # available formats: marcxml / json
 # marcxml: only processed bib record available
 # json: original and processed records available
+# processed local records are taken from enriched records store, if it is enabled
 
 @App.path(model=MarcRecordWrapper, path='/get_single_bib_record/{marc_record_number}')
 def get_record(marc_record_number):
-    if local_bib_index[marc_record_number]:
-        return MarcRecordWrapper(read_marc_from_binary(local_bib_index[marc_record_number]), local_auth_index)
+    # concurrent requests of the same record share one wrapper (see SingleFlight)
+    return single_records_flight.do(marc_record_number, create_marc_record_wrapper, marc_record_number)
+
+
+def create_marc_record_wrapper(marc_record_number):
+    generation = enriched_records_store.generation if enriched_records_store is not None else None
+    indexes = local_indexes.current
+    if marc_record_number in indexes.bib_index:
+        raw_record = indexes.bib_index[marc_record_number]
+        enriched_records = None
+        if enriched_records_store is not None:
+            enriched_records = enriched_records_store.get_or_render_all(marc_record_number, raw_record,
+                                                                        indexes.auth_index.get_first_id, generation)
+        marc_record = read_marc_from_binary(raw_record)
+        if marc_record is None:
+            return None
+        return MarcRecordWrapper(marc_record, indexes.auth_index, enriched_records)
     else:
-        r = requests.get('http://data.bn.org.pl/api/bibs.marc?id={}'.format(marc_record_number)).content
+        # records missing in local index are fetched from data.bn.org.pl: its failure is rendered as 502,
+        # record it doesn't return (or which can't be read) as 404 (path returns None)
+        try:
+            r = data_bn_client.get_marc('bibs', [marc_record_number])
+        except requests.RequestException as e:
+            raise HTTPBadGateway('Error of data.bn.org.pl for record {}: {}'.format(marc_record_number, e))
         r = read_marc_from_binary(r)
-        r = MarcRecordWrapper(r, local_auth_index)
+        if r is None:
+            return None
+        r = MarcRecordWrapper(r, indexes.auth_index)
         return r
 
 
@@ -53,78 +104,699 @@ def render_xml(self, request):
 
 # bib records chunk
 
-# available formats: xml
+# available formats (?format=): xml (default) / jsonl
 # xml: only processed bib records available
+# jsonl: only processed bib records available, first line contains nextPage
+# response is streamed while records are processed
+# ids of records on page are listed by local listing index if it supports query parameters (see bib_listing),
+# otherwise by data.bn.org.pl
+
+BIB_CHUNK_CONTENT_TYPES = {'xml': 'application/xml', 'jsonl': 'application/x-ndjson'}
 
 @App.path(model=BibliographicRecordsChunk, path='/get_bibs/{query_for_data_bn}')
-def get_bib_records(query_for_data_bn):
-    if query_for_data_bn in local_next_page_cache.cache:
-        chunk_to_return = local_next_page_cache.cache[query_for_data_bn]
-        return chunk_to_return
-    else:
-        chunk_to_return = BibliographicRecordsChunk(query_for_data_bn, local_auth_index, local_bib_index)
-        local_next_page_cache.add_to_cache(chunk_to_return)
-        local_next_page_cache.flush_cache()
-        return chunk_to_return
+def get_bib_records(request, query_for_data_bn):
+    output_format = request.GET.get('format', 'xml')
+    harvest = chunks_prefetcher.get_harvest(query_for_data_bn,
+                                            output_format if output_format in BIB_CHUNK_CONTENT_TYPES else 'xml')
+
+    chunk_to_return = local_next_page_cache.get_from_cache(query_for_data_bn)
+    if chunk_to_return is None:
+        chunk_to_return = chunks_prefetcher.wait_for_prefetched_chunk(query_for_data_bn, PREFETCH_WAIT_TIMEOUT)
+    if chunk_to_return is None:
+        # concurrent requests of the same page wait for one chunk
+        chunk_to_return = local_next_page_cache.create_and_add(query_for_data_bn, create_bib_chunk)
+
+    # start building next page, harvester will ask for it soon
+    chunks_prefetcher.prefetch_after(chunk_to_return, harvest)
+    # output being rendered for concurrent request of the same page is waited for before response is started
+    # (timeout is rendered as 504, see render_single_flight_timeout)
+    if output_format in BIB_CHUNK_CONTENT_TYPES:
+        chunk_to_return.wait_for_output(output_format)
+    return chunk_to_return
+
+
+def create_bib_chunk(query_for_data_bn):
+    # generation of enriched records store has to be read before indexes (see EnrichedRecordsStore)
+    generation = enriched_records_store.generation if enriched_records_store is not None else None
+    indexes = local_indexes.current
+    return BibliographicRecordsChunk(query_for_data_bn, indexes.auth_index, indexes.bib_index,
+                                     enriched_records_store, generation, bib_listing_index)
 
 
 @App.view(model=BibliographicRecordsChunk)
 def render_bib_records(self, request):
-    return morepath.Response(body=self.xml_processed_chunk, content_type='application/xml')
+    output_format = request.GET.get('format', 'xml')
+    if output_format not in BIB_CHUNK_CONTENT_TYPES:
+        raise HTTPBadRequest('Unknown format: {}'.format(output_format))
+
+    return morepath.Response(app_iter=self.iter_output(output_format),
+                             content_type=BIB_CHUNK_CONTENT_TYPES[output_format], charset='utf-8')
+
+
+# bib records chunks cache and prefetcher status
+
+@App.path(model=BibliographicRecordsChunksCache, path='/get_cache_status')
+def get_cache_status():
+    return local_next_page_cache
+
+@App.json(model=BibliographicRecordsChunksCache)
+def render_cache_status(self, request):
+    bib_index = local_indexes.current.bib_index
+    return {'cache': self.get_stats(), 'prefetcher': chunks_prefetcher.get_stats(),
+            'enriched_store': enriched_records_store.get_stats() if enriched_records_store is not None else None,
+            'bib_store_block_cache': bib_index.base.get_stats()
+            if isinstance(bib_index, CompressedMarcRecordStore) else None,
+            'single_flight': {'chunks': self.creating.get_stats(), 'single_records': single_records_flight.get_stats(),
+                              'data_bn_marc': data_bn_client.marc_fetches.get_stats()}}
+
+
+# bulk enrichment of records supplied by client
+
+# POST ISO 2709 (?input=marc, default) or MARCXML (?input=xml) stream; enriched records are streamed back
+# in the input format or in the one requested with ?format= (marc / xml / jsonl)
+# statistics of batches (records read, failed, fields linked) are logged and added to xml (comments)
+# and jsonl (lines with "stats") output
+
+BULK_CONTENT_TYPES = {'marc': 'application/marc', 'xml': 'application/xml', 'jsonl': 'application/x-ndjson'}
+BULK_ENRICHMENT_BATCH_SIZE = 1000
+
+@App.path(model=BulkEnrichment, path='/enrich')
+def get_bulk_enrichment(request):
+    input_format = request.GET.get('input', 'marc')
+    output_format = request.GET.get('format', input_format)
+    # body is read as it comes (not buffered in memory or temporary file first)
+    return BulkEnrichment(request.body_file, input_format, output_format,
+                          local_indexes.current.auth_index, BULK_ENRICHMENT_BATCH_SIZE)
+
+
+@App.view(model=BulkEnrichment, request_method='POST')
+def render_bulk_enrichment(self, request):
+    if self.input_format not in ('marc', 'xml'):
+        raise HTTPBadRequest('Unknown input format: {}'.format(self.input_format))
+    if self.output_format not in BULK_CONTENT_TYPES:
+        raise HTTPBadRequest('Unknown format: {}'.format(self.output_format))
+
+    return morepath.Response(app_iter=self.iter_output(), content_type=BULK_CONTENT_TYPES[self.output_format],
+                             charset=None if self.output_format == 'marc' else 'utf-8')
 
 
 # single authority record
 
 @App.path(model=Authority, path='/get_authority/{id_or_name}')
 def get_authority(id_or_name):
-    return Authority(id_or_name, local_auth_index)
+    authority = Authority(id_or_name, local_indexes.current.auth_index)
+    # not found - 404
+    return authority if authority.authority_heading is not None else None
 
 @App.view(model=Authority)
 def authority_info(self, request):
     return "Authority: {} - {}".format(str(self.authority_ids), self.authority_heading)
 
+
+# batch authority lookup
+
+# POST JSON list of authority ids and/or headings (max MAX_AUTHORITY_LOOKUP_QUERIES);
+# returns JSON with hits (one id), ambiguous (headings with several ids) and misses
+
+MAX_AUTHORITY_LOOKUP_QUERIES = 10000
+
+@App.path(model=AuthorityBatchLookup, path='/get_authorities')
+def get_authorities():
+    return AuthorityBatchLookup(local_indexes.current.auth_index)
+
+@App.json(model=AuthorityBatchLookup, request_method='POST')
+def render_authorities(self, request):
+    try:
+        queries = self.read_queries(request.body, MAX_AUTHORITY_LOOKUP_QUERIES)
+    except ValueError as e:
+        raise HTTPBadRequest(str(e))
+
+    return self.lookup(queries)
+
+
+# bib records affected by changes of authority records (found with reverse index: headings -> bib records)
+
+# /get_authority_changes/{job_id} - authority records changed by update job with affected bib records
+# /get_authority_bibs/{id_or_name} - bib records with heading of authority record
+
+@App.path(model=AuthorityChanges, path='/get_authority_changes/{job_id}')
+def get_authority_changes_of_job(job_id):
+    job = update_jobs_runner.get_job(job_id)
+    if job is not None and job.index == 'authorities':
+        return AuthorityChanges(job, bib_reverse_index)
+
+@App.json(model=AuthorityChanges)
+def render_authority_changes(self, request):
+    return self.as_dict()
+
+
+@App.path(model=AuthorityBibs, path='/get_authority_bibs/{id_or_name}')
+def get_authority_bibs(id_or_name):
+    return AuthorityBibs(id_or_name, local_indexes.current.auth_index, bib_reverse_index)
+
+@App.json(model=AuthorityBibs)
+def render_authority_bibs(self, request):
+    return self.as_dict()
+
+
+# authority headings search
+
+# ?prefix= - headings starting with prefix (alphabetically), ?q= - headings most similar to query
+# (case, diacritics, punctuation and order of words are ignored); ?limit= - max number of headings (default 20)
+
+MAX_AUTHORITY_SEARCH_LIMIT = 1000
+
+@App.path(model=AuthoritySearch, path='/search_authorities')
+def search_authorities(prefix=None, q=None, limit=20):
+    return AuthoritySearch(authority_search_index, local_indexes.current.auth_index, prefix, q, limit)
+
+@App.json(model=AuthoritySearch)
+def render_authority_search(self, request):
+    if self.prefix is None and self.query is None:
+        raise HTTPBadRequest('Parameter prefix or q is required')
+    if not 0 < self.limit <= MAX_AUTHORITY_SEARCH_LIMIT:
+        raise HTTPBadRequest('Limit must be between 1 and {}'.format(MAX_AUTHORITY_SEARCH_LIMIT))
+
+    return {'prefix': self.prefix, 'q': self.query, 'results': self.get_results()}
+
 # index status
 
-@App.path(model='UpdaterStatus', path='/get_update_status')
+@App.path(model=UpdaterStatus, path='/get_update_status')
 def get_update_status():
     return updater_status
 
 @App.json(model=UpdaterStatus)
 def render_update_status(self, request):
-        return {"update_in_progress": self.update_in_progress, "last_bib_update": self.last_bib_update.isoformat(timespec='seconds') + 'Z', "last_auth_update": self.last_auth_update.isoformat(timespec='seconds') + 'Z'}
+        return {"update_in_progress": update_jobs_runner.is_update_in_progress(), "index_version": local_indexes.current.version, "last_bib_update": self.last_bib_update.isoformat(timespec='seconds') + 'Z', "last_auth_update": self.last_auth_update.isoformat(timespec='seconds') + 'Z', "jobs": update_jobs_runner.get_jobs()}
+
+
+# metrics (Prometheus text format) and per-request tracing
+
+# tracing is disabled by default; POST /tracing?enabled=true (or false) switches it at runtime,
+# GET /tracing returns the last traces
+# in multi-process serving /metrics renders metrics of all workers and the switch of tracing is shared by them,
+# last traces are returned by the worker which recorded them (all traces are logged)
+
+@App.path(model=MetricsRegistry, path='/metrics')
+def get_metrics():
+    return registry
+
+@App.view(model=MetricsRegistry)
+def render_metrics(self, request):
+    response = morepath.Response(body=self.render().encode('utf-8'))
+    response.headers['Content-Type'] = METRICS_CONTENT_TYPE
+    return response
+
+
+@App.path(model=Tracer, path='/tracing')
+def get_tracer():
+    return tracer
+
+@App.json(model=Tracer)
+def render_tracer(self, request):
+    return self.as_dict()
+
+@App.json(model=Tracer, request_method='POST')
+def switch_tracer(self, request):
+    enabled = request.GET.get('enabled', '').lower()
+    if enabled not in ('true', 'false', '1', '0'):
+        raise HTTPBadRequest('Parameter enabled must be true or false')
+
+    self.set_enabled(enabled in ('true', '1'))
+    return {'enabled': self.enabled}
+
+
+# set by register_state_metrics
+index_memory_metric = None
+
+
+def register_state_metrics():
+    """
+    Registers metrics read from state of indexes, caches and updater (by callbacks, while rendering /metrics).
+    """
+    registry.callback('marc_api_index_records', 'Records in local indexes.',
+                      lambda: {('bibs',): len(local_indexes.current.bib_index),
+                               ('authorities',): len(local_indexes.current.auth_index)}, ['index'])
+    registry.callback('marc_api_authority_headings', 'Headings in authority index.',
+                      lambda: len(local_indexes.current.auth_index.headings))
+    registry.callback('marc_api_reverse_index_terms', 'Terms (headings) in reverse index of bib records.',
+                      lambda: len(bib_reverse_index))
+    if bib_listing_index is not None:
+        registry.callback('marc_api_bib_listing_records', 'Records in listing index of bib records.',
+                          lambda: len(bib_listing_index))
+    registry.callback('marc_api_authority_search_headings', 'Headings in authority headings search index.',
+                      lambda: len(authority_search_index))
+    registry.callback('marc_api_bib_store_mapped_bytes', 'Size of memory-mapped segments of bib records store.',
+                      lambda: {('base',): local_indexes.current.bib_index.base.map_size,
+                               ('overlay',): local_indexes.current.bib_index.get_overlay_map_size()}, ['segment'])
+    # sizes of Python objects are computed by walking whole structures - in background, at most once per 10 minutes
+    # and after updates of indexes (see publish_auth_index, publish_bib_index)
+    global index_memory_metric
+    index_memory_metric = registry.callback(
+        'marc_api_index_memory_bytes', 'Memory used by Python structures of indexes.',
+        lambda: {('authorities',): get_deep_size(local_indexes.current.auth_index),
+                 ('bib_locations',): get_deep_size(local_indexes.current.bib_index.locations),
+                 ('reverse',): bib_reverse_index.memory_report()['reverse_index_bytes']},
+        ['index'], cache_seconds=600, background=True)
+    registry.callback('marc_api_last_update_timestamp_seconds', 'Date of the newest update of index (watermark).',
+                      lambda: {('bibs',): updater_status.last_bib_update.replace(tzinfo=timezone.utc).timestamp(),
+                               ('authorities',): updater_status.last_auth_update.replace(tzinfo=timezone.utc).timestamp()},
+                      ['index'])
+    registry.callback('marc_api_index_lag_seconds', 'Time since watermark of index (changes at data.bn.org.pl '
+                      'made before it are applied).',
+                      lambda: {('bibs',): (datetime.utcnow() - updater_status.last_bib_update).total_seconds(),
+                               ('authorities',): (datetime.utcnow() - updater_status.last_auth_update).total_seconds()},
+                      ['index'])
+    registry.callback('marc_api_update_in_progress', 'Whether index update job is running (1) or not (0).',
+                      lambda: int(update_jobs_runner.is_update_in_progress()))
+
+    stats_metrics = [('chunks_cache', local_next_page_cache.get_stats, ['chunks', 'size_in_bytes', 'hit_rate'],
+                      ['hits', 'misses', 'evictions', 'expirations', 'invalidations', 'rejected']),
+                     ('prefetcher', chunks_prefetcher.get_stats, ['in_flight', 'harvests'],
+                      ['prefetched', 'cancelled', 'failed'])]
+    for name, flight in (('chunks', local_next_page_cache.creating), ('single_records', single_records_flight),
+                         ('data_bn_marc', data_bn_client.marc_fetches)):
+        stats_metrics.append(('{}_single_flight'.format(name), flight.get_stats, ['in_flight'],
+                              ['calls', 'coalesced', 'timeouts', 'failed']))
+    if isinstance(local_indexes.current.bib_index, CompressedMarcRecordStore):
+        stats_metrics.append(('bib_store_block_cache', lambda: local_indexes.current.bib_index.base.get_stats(),
+                              ['cached_blocks', 'size_in_bytes', 'compressed_bytes', 'records_bytes', 'hit_rate'],
+                              ['hits', 'misses', 'evictions']))
+    if enriched_records_store is not None:
+        stats_metrics.append(('enriched_store', enriched_records_store.get_stats,
+                              ['records', 'size_in_bytes', 'hit_rate'],
+                              ['hits', 'misses', 'evictions', 'invalidations', 'rejected']))
+
+    for name, get_stats, gauges, counters in stats_metrics:
+        for key in gauges:
+            registry.callback('marc_api_{}_{}'.format(name, key), '{} statistics: {}.'.format(name, key),
+                              lambda get_stats=get_stats, key=key: get_stats()[key])
+        for key in counters:
+            registry.callback('marc_api_{}_{}_total'.format(name, key), '{} statistics: {}.'.format(name, key),
+                              lambda get_stats=get_stats, key=key: get_stats()[key], metric_type='counter')
 
 
 # bibliographic and authority records index updater
 
-@App.path(model='Updater', path='/update/{index}')
+# update runs in background: new version of index is built alongside the live one and swapped in when ready;
+# request returns update job (with id) immediately, progress of jobs is reported by /get_update_status
+# changes are written to journal (replayed at startup), then snapshot of the new version is saved
+# indexes are also synced continuously by incremental update jobs (see index_sync_loop), which start
+# from watermark of index instead of listing the last 3 days of changes again
+
+@App.path(model=UpdateJob, path='/update/{index}')
 def update_index(index):
-    if updater_status.update_in_progress:
-        return updater
+    if index in ('authorities', 'bibs'):
+        return update_jobs_runner.submit(index)
+
+@App.json(model=UpdateJob)
+def render_update_job(self, request):
+    return self.as_dict()
+
+
+def run_update_job(job):
+    if shared_index_state is None:
+        return run_index_update(job)
+
+    # multi-process serving: one update job at a time in all workers, started from the newest version of indexes;
+    # after the job other workers catch up with it (see watch_shared_index_state)
+    job.progress['phase'] = 'waiting for update lock'
+    with shared_index_state.update_lock:
+        catch_up_with_other_workers()
+        try:
+            run_index_update(job)
+        finally:
+            version = shared_index_state.publish()
+    job.progress['phase'] = 'waiting for workers'
+    if not shared_index_state.wait_for_workers(version, PREFORK_SYNC_TIMEOUT):
+        logging.warning('Nie wszystkie procesy przełączyły się na wersję indeksów: {}'.format(version))
+    job.progress['phase'] = 'done'
+
+
+def run_index_update(job):
+    job_status = copy.copy(updater_status)
+    changes = None
+
+    if job.incremental:
+        # incremental update (see index_sync_loop): changes are listed before index is copied,
+        # index is not copied if there are none
+        job.progress['phase'] = 'listing'
+        last_update = updater_status.last_auth_update if job.index == 'authorities' else updater_status.last_bib_update
+        changes = updater.get_changes(job.index, last_update, timedelta(seconds=INDEX_SYNC_OVERLAP), listed=True)
+        deleted_records_ids, updated_records_ids, date_to = changes
+        if not deleted_records_ids and not updated_records_ids:
+            job.progress.update(deleted=0, updated=0, unchanged=0, missing=0)
+            advance_watermark(job.index, date_to)
+            job.progress['phase'] = 'done'
+            return
+
+    job.progress['phase'] = 'copying'
+
+    if job.index == 'authorities':
+        old_auth_index = local_indexes.current.auth_index
+        new_auth_index = old_auth_index.copy()
+        transaction = auth_journal.begin()
+        try:
+            changed_records_ids = updater.update_authority_index(new_auth_index, job_status, job.progress, transaction,
+                                                                 changes)
+            if changed_records_ids:
+                transaction.commit(job_status.last_auth_update)
+            else:
+                transaction.abort()
+        except Exception:
+            transaction.abort()
+            raise
+        if not changed_records_ids:
+            advance_watermark('authorities', job_status.last_auth_update)
+        else:
+            job.authority_changes = publish_auth_index(old_auth_index, new_auth_index, changed_records_ids,
+                                                       job_status.last_auth_update)
+            # changes are kept in journal - snapshot is saved periodically (see is_snapshot_due)
+            if compact_journal(auth_journal, job) or is_snapshot_due(auth_marc, auth_journal):
+                job.progress['phase'] = 'saving'
+                save_index_snapshot(new_auth_index, auth_marc,
+                                    get_journaled_snapshot_meta(auth_journal,
+                                                                last_update=updater_status.last_auth_update))
+
+    if job.index == 'bibs':
+        old_bib_index = local_indexes.current.bib_index
+        new_bib_index = old_bib_index.copy()
+        transaction = bib_journal.begin()
+        try:
+            changed_records_ids = updater.update_bibliographic_index(new_bib_index, job_status, job.progress,
+                                                                     transaction, changes)
+            if changed_records_ids:
+                transaction.commit(job_status.last_bib_update)
+            else:
+                transaction.abort()
+        except Exception:
+            transaction.abort()
+            raise
+        if not changed_records_ids:
+            advance_watermark('bibs', job_status.last_bib_update)
+        else:
+            publish_bib_index(old_bib_index, new_bib_index, changed_records_ids, job_status.last_bib_update)
+            # changes are kept in journal - snapshots are saved periodically (see is_snapshot_due) and after
+            # compaction of store (segments replaced by it can be removed only when snapshot doesn't reference them)
+            if compact_journal(bib_journal, job) or new_bib_index.obsolete_paths or \
+                    is_snapshot_due(bib_marc, bib_journal, bib_snapshot_kind):
+                job.progress['phase'] = 'saving'
+                save_bib_snapshots(new_bib_index)
+                new_bib_index.remove_obsolete_segments()
+
+    job.progress['phase'] = 'done'
+
+
+def advance_watermark(index, last_update):
+    """
+    Moves watermark of index (date of the newest update) after update which found no changed records
+    (index is left as it is, watermark is stored next to journal).
+    """
+    if index == 'authorities':
+        auth_journal.advance_watermark(last_update)
+        updater_status.last_auth_update = last_update
     else:
-        if index == 'authorities':
-            updater.update_authority_index(local_auth_index, updater_status)
-        if index == 'bibs':
-            updater.update_bibliographic_index(local_bib_index, updater_status)
-
-@App.json(model=Updater)
-def render_after_update(self, request):
-    return {"update_in_progress": updater_status.update_in_progress, "last_bib_update": updater_status.last_bib_update.isoformat(timespec='seconds') + 'Z', "last_auth_update": updater_status.last_auth_update.isoformat(timespec='seconds') + 'Z'}
+        bib_journal.advance_watermark(last_update)
+        updater_status.last_bib_update = last_update
+
+
+def publish_auth_index(old_auth_index, new_auth_index, changed_records_ids, last_update):
+    """
+    Swaps in new version of authority index, updates headings search index and invalidates cached records
+    affected by changes. Returns authority changes (see get_authority_changes).
+    """
+    # search index is updated first, so fuzzy fallback never matches against new index with old headings
+    authority_search_index.sync(old_auth_index, new_auth_index, changed_records_ids)
+    local_indexes.swap(auth_index=new_auth_index)
+    updater_status.last_auth_update = last_update
+    authority_changes = get_authority_changes(old_auth_index, new_auth_index, changed_records_ids)
+    if AUTHORITY_FUZZY_FALLBACK:
+        # headings matched by fuzzy fallback are not known in advance - any changed heading can affect any record
+        local_next_page_cache.invalidate_all()
+        if enriched_records_store is not None:
+            enriched_records_store.invalidate_all()
+    else:
+        # only chunks with bib records having old or new heading of changed authority records are affected
+        affected_records_ids = bib_reverse_index.get_affected_records_ids(
+            heading for record_id, old_heading, new_heading in authority_changes
+            for heading in (old_heading, new_heading))
+        local_next_page_cache.invalidate_records(affected_records_ids)
+        if enriched_records_store is not None:
+            enriched_records_store.invalidate_records(affected_records_ids)
+    index_memory_metric.refresh_in_background()
+    return authority_changes
+
+
+def publish_bib_index(old_bib_index, new_bib_index, changed_records_ids, last_update):
+    """
+    Swaps in new version of bib records store, updates reverse and listing indexes and invalidates cached
+    changed records.
+    """
+    local_indexes.swap(bib_index=new_bib_index)
+    bib_reverse_index.sync(old_bib_index, new_bib_index, changed_records_ids)
+    if bib_listing_index is not None:
+        bib_listing_index.sync(new_bib_index, changed_records_ids)
+    updater_status.last_bib_update = last_update
+    local_next_page_cache.invalidate_records(changed_records_ids, listed=bib_listing_index is not None)
+    if enriched_records_store is not None:
+        enriched_records_store.invalidate_records(changed_records_ids)
+    index_memory_metric.refresh_in_background()
+
+
+def compact_journal(journal, job):
+    """
+    Compacts journal, if it needs compaction. Returns True if it was compacted.
+    """
+    if not journal.needs_compaction():
+        return False
+    job.progress['phase'] = 'compacting journal'
+    journal.compact()
+    return True
+
+
+def save_bib_snapshots(bib_index):
+    """
+    Saves snapshots of bib records store and indexes derived from it, at the same journal position.
+    """
+    position = bib_journal.get_position()
+    save_index_snapshot(bib_index, bib_marc,
+                        get_journaled_snapshot_meta(bib_journal, last_update=updater_status.last_bib_update),
+                        bib_snapshot_kind)
+    save_index_snapshot(bib_reverse_index, bib_marc, position, 'reverse')
+    if bib_listing_index is not None:
+        save_index_snapshot(bib_listing_index, bib_marc, position, 'listing')
+
+
+def replay_journal(journal, index, index_meta, records_type):
+    """
+    Replays changes from journal which are not in index yet (index built from dump or loaded from older snapshot).
+    Returns tuple: date of the newest update in index, list of changed records ids.
+    """
+    changed_records_ids = updater.replay_journal(journal, index, records_type, index_meta)
+    return journal.last_update or index_meta['last_update'], changed_records_ids
+
+
+def load_or_create_bib_derived_index(create_index, bib_index, position, kind):
+    """
+    Loads index derived from bib records (kind: 'reverse' or 'listing') from snapshot, if it is up to date
+    with bib index (snapshot was taken at given journal position of bib index), otherwise builds it from bib index
+    and saves snapshot.
+    """
+    derived_index, meta = load_index_snapshot(bib_marc, kind)
+
+    if derived_index is None or {key: meta.get(key) for key in position} != position:
+        derived_index = create_index(bib_index)
+        save_index_snapshot(derived_index, bib_marc, position, kind)
+    return derived_index
+
+
+# multi-process serving (see prefork_server): indexes are loaded once by master process and shared with forked workers;
+# update jobs run in one worker at a time (shared update lock) and publish new version of indexes (shared counter),
+# other workers catch up with it - authority changes are replayed from journal, new version of bib records store
+# (which is already in shared overlay segment) is loaded from snapshot - and report version they serve
+
+shared_index_state = None
+PREFORK_SYNC_TIMEOUT = 600
+PREFORK_WATCH_INTERVAL = 1
+
+
+def attach_worker(state):
+    """
+    Attaches worker process (after fork) to state shared by workers; catches up with updates made
+    since master process loaded indexes and starts watching for updates of other workers.
+    """
+    global shared_index_state
+    shared_index_state = state
+    registry.attach_worker(state.worker_number, state.metrics_directory)
+    tracer.share_switch(state.tracing_enabled)
+    with shared_index_state.update_lock:
+        catch_up_with_other_workers()
+    threading.Thread(target=watch_shared_index_state, name='index-version-watcher', daemon=True).start()
+
+
+def watch_shared_index_state():
+    while True:
+        time.sleep(PREFORK_WATCH_INTERVAL)
+        if shared_index_state.published_version.value == shared_index_state.get_worker_version():
+            continue
+        try:
+            with shared_index_state.update_lock:
+                catch_up_with_other_workers()
+        except Exception:
+            logging.exception('Błąd przełączania wersji indeksów w procesie: {}'.format(os.getpid()))
+
+
+def catch_up_with_other_workers():
+    """
+    Publishes changes committed to journals by other workers since this worker read them
+    (must be called with update lock held). Reports published version as served by this worker.
+    """
+    version = shared_index_state.published_version.value
+    auth_position = auth_journal.get_position()
+    bib_position = bib_journal.get_position()
+    auth_journal.refresh()
+    bib_journal.refresh()
+
+    # changes are applied to new version of indexes of this worker, which keeps only them over tables of the current
+    # version (see layered_dict) - tables inherited from master process stay shared by all workers
+    if auth_journal.get_position() != auth_position:
+        old_auth_index = local_indexes.current.auth_index
+        new_auth_index = old_auth_index.copy()
+        changed_records_ids = updater.replay_journal(auth_journal, new_auth_index, 'authorities', auth_position)
+        publish_auth_index(old_auth_index, new_auth_index, changed_records_ids, auth_journal.last_update)
+
+    if bib_journal.get_position() != bib_position:
+        # records written by the other worker are found in the shared overlay segment (see apply_changes);
+        # snapshot is loaded only if the other worker compacted the store or journal (snapshot is saved then),
+        # changes committed after the snapshot are applied to it in the same way
+        changes = [(record_id, raw) for operation, record_id, raw in bib_journal.iter_changes(bib_position)]
+        old_bib_index = local_indexes.current.bib_index
+        new_bib_index = old_bib_index.copy()
+        if not new_bib_index.apply_changes(changes):
+            logging.info('Wczytywanie snapshotu indeksu rekordów bibliograficznych po zmianach innego procesu')
+            new_bib_index, meta = load_index_snapshot(bib_marc, bib_snapshot_kind)
+            if new_bib_index is None:
+                raise RuntimeError('Snapshot of bib records store can not be loaded: {}'.format(bib_marc))
+            if not new_bib_index.apply_changes([(record_id, raw) for operation, record_id, raw
+                                                in bib_journal.iter_changes(meta)]):
+                raise RuntimeError('Changes committed after snapshot of bib records store can not be applied: '
+                                   '{}'.format(bib_marc))
+        publish_bib_index(old_bib_index, new_bib_index, [record_id for record_id, raw in changes],
+                          bib_journal.last_update)
+
+    # watermarks moved by updates without changes (see advance_watermark)
+    if auth_journal.last_update is not None and auth_journal.last_update > updater_status.last_auth_update:
+        updater_status.last_auth_update = auth_journal.last_update
+    if bib_journal.last_update is not None and bib_journal.last_update > updater_status.last_bib_update:
+        updater_status.last_bib_update = bib_journal.last_update
+
+    shared_index_state.set_worker_version(version)
 
 
 # set index source files
 bib_marc = 'bibs-all.marc'
 auth_marc = 'authorities-all.marc'
 
-# create indexes
-local_bib_index = create_local_bib_index(bib_marc)
-local_auth_index = create_authority_index(auth_marc)
 
-# create updater and updater_status
+def create_bib_index_with_reverse_index(data):
+    """
+    Creates bib records store (compressed, if BIB_STORE_COMPRESSION is on) and - in the same pass over dump -
+    reverse index of its records (dump_reverse_index).
+    """
+    global dump_reverse_index
+    dump_reverse_index = ReverseIndex()
+    if BIB_STORE_COMPRESSION:
+        return create_compressed_bib_index_parallel(data, reverse_index=dump_reverse_index)
+    return create_local_bib_index_parallel(data, reverse_index=dump_reverse_index)
+
+
+# create indexes (or load them from snapshots) and open journals of their changes
+# bib records are optionally compressed (see BIB_STORE_COMPRESSION), snapshots of both kinds of store are kept apart
+# reverse index of bib records is built with bib index, if bib index is built from dump (not loaded from snapshot)
+dump_reverse_index = None
+bib_snapshot_kind = 'compressed' if BIB_STORE_COMPRESSION else None
+bib_index, bib_snapshot_meta = load_or_create_index(create_bib_index_with_reverse_index, bib_marc, bib_snapshot_kind)
+auth_index, auth_snapshot_meta = load_or_create_index(create_authority_index_parallel, auth_marc)
+bib_journal = ChangeJournal(bib_marc)
+auth_journal = ChangeJournal(auth_marc)
+
+# create updater, restore updates from journals (and last update dates), create updater_status
+# and background update jobs runner
 updater = Updater()
 updater_status = UpdaterStatus(datetime.utcnow())
-
-# set max bibs cache size
-local_next_page_cache = BibliographicRecordsChunksCache(20)
+# changes are replayed to new version of store, so indexes derived from the loaded (or built) version can be synced
+# with them
+snapshot_bib_index, bib_index = bib_index, bib_index.copy()
+updater_status.last_bib_update, replayed_bib_records_ids = replay_journal(bib_journal, bib_index, bib_snapshot_meta,
+                                                                          'bibs')
+updater_status.last_auth_update, replayed_auth_records_ids = replay_journal(auth_journal, auth_index,
+                                                                            auth_snapshot_meta, 'authorities')
+# segments of bib records store left by compaction interrupted before snapshot was saved
+bib_index.remove_unused_segments()
+local_indexes = Indexes(bib_index, auth_index)
+update_jobs_runner = UpdateJobsRunner(run_update_job)
+
+# create loop of continuous sync of indexes with data.bn.org.pl (optional, see INDEX_SYNC in indexer_config);
+# it is started by API server (waitress_server_deploy, prefork_server - in one worker)
+index_sync_loop = IndexSyncLoop(update_jobs_runner, INDEX_SYNC_INTERVAL) if INDEX_SYNC else None
+
+# create reverse index of bib records (authority headings -> bib records) - or take the one built with bib index;
+# it is synced with replayed changes
+bib_snapshot_position = {key: bib_snapshot_meta.get(key) for key in bib_journal.get_position()}
+if dump_reverse_index is None:
+    bib_reverse_index = load_or_create_bib_derived_index(create_reverse_index, snapshot_bib_index,
+                                                         bib_snapshot_position, 'reverse')
+else:
+    bib_reverse_index = dump_reverse_index
+bib_reverse_index.sync(snapshot_bib_index, bib_index, replayed_bib_records_ids)
+
+# create listing index of bib records (ids order, 005, filter fields), which answers /get_bibs queries locally
+# (optional, see LOCAL_BIB_LISTING in indexer_config)
+bib_listing_index = None
+if LOCAL_BIB_LISTING:
+    bib_listing_index = load_or_create_bib_derived_index(create_bib_listing_index, snapshot_bib_index,
+                                                         bib_snapshot_position, 'listing')
+    bib_listing_index.sync(bib_index, replayed_bib_records_ids)
+
+# replayed records were written to bib records store again - snapshots are saved, so they are not replayed again
+if replayed_bib_records_ids:
+    save_bib_snapshots(bib_index)
+if replayed_auth_records_ids:
+    save_index_snapshot(auth_index, auth_marc,
+                        get_journaled_snapshot_meta(auth_journal, last_update=updater_status.last_auth_update))
+
+# create authority headings search index (optionally used for fuzzy matching of headings while enriching records)
+authority_search_index = AuthoritySearchIndex.from_authority_index(auth_index)
+if AUTHORITY_FUZZY_FALLBACK:
+    record_enricher.fallback_matcher = lambda term: authority_search_index.find_best_match(
+        term, AUTHORITY_FUZZY_MIN_SIMILARITY)
+
+# set max time (seconds) request waits for page or record created for concurrent identical request
+SINGLE_FLIGHT_TIMEOUT = 60
+
+# set bibs cache limits: max chunks, max size in bytes, time to live in seconds
+local_next_page_cache = BibliographicRecordsChunksCache(200, max_bytes=256 * 1024 * 1024, ttl=3600,
+                                                        wait_timeout=SINGLE_FLIGHT_TIMEOUT)
+single_records_flight = SingleFlight('single records', SINGLE_FLIGHT_TIMEOUT)
+
+# set next page prefetching: worker threads, pages ahead, harvest idle timeout in seconds
+# and max time (seconds) request waits for a page which is being prefetched
+chunks_prefetcher = BibliographicRecordsChunksPrefetcher(local_next_page_cache, create_bib_chunk,
+                                                         max_workers=2, max_depth=1, idle_timeout=300)
+PREFETCH_WAIT_TIMEOUT = 60
+
+# create enriched records store (optional, see ENRICHED_STORE in indexer_config) and fill it in background
+enriched_records_store = EnrichedRecordsStore(ENRICHED_STORE_MAX_BYTES) if ENRICHED_STORE else None
+enriched_store_prefill_thread = None
+if enriched_records_store is not None and ENRICHED_STORE_PREFILL:
+    enriched_store_prefill_thread = threading.Thread(target=enriched_records_store.fill, name='enriched-store-prefill',
+                                                     daemon=True, args=(bib_index, auth_index,
+                                                                        enriched_records_store.generation,
+                                                                        ENRICHED_STORE_PREFILL_FORMATS))
+    enriched_store_prefill_thread.start()
+
+# register metrics of indexes, caches and updater (see /metrics)
+register_state_metrics()
 
 if __name__ == '__main__':
     logging.root.addHandler(logging.StreamHandler(sys.stdout))
@@ -0,0 +1,195 @@
+import sys
+import re
+from layered_dict import copy_layered
+
+# authority records index
+
+RECORD_ID_PATTERN = re.compile(r'[1-9]\d*[\dx]')
+
+
+def calculate_check_digit(record_id):
+    char_sum = 0
+    i = 2
+    for character in record_id[::-1]:
+        char_sum += int(character) * i
+        i += 1
+    remainder = char_sum % 11
+    check_digit = str(remainder) if remainder != 10 else 'x'
+    return record_id + check_digit
+
+
+def pack_record_id(record_id, prefix='a'):
+    """
+    Packs record id (e.g. 'a1000001x'; prefix 'a' for authority, 'b' for bibliographic records) into int
+    (numeric part without prefix and check digit: 1000001).
+    Ids which can't be restored from numeric part (other prefix, leading zeros, wrong check digit) are kept as strings.
+    """
+    if record_id[:1] == prefix and RECORD_ID_PATTERN.fullmatch(record_id, 1) and \
+            calculate_check_digit(record_id[1:-1]) == record_id[1:]:
+        return int(record_id[1:-1])
+    return record_id
+
+
+def unpack_record_id(packed_id, prefix='a'):
+    if isinstance(packed_id, int):
+        return prefix + calculate_check_digit(str(packed_id))
+    return packed_id
+
+
+def get_deep_size(obj, seen=None):
+    """
+    Returns memory used by object and all objects referenced by it (containers are traversed, shared objects counted once).
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(get_deep_size(key, seen) + get_deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(get_deep_size(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += get_deep_size(obj.__dict__, seen)
+
+    return size
+
+
+class AuthorityIndex(object):
+    """
+    Authority records index with separate tables:
+    ids: packed record id (int, see pack_record_id): heading (interned string)
+    headings: heading (interned string): packed record id or - only for headings shared by several records -
+    list of packed record ids.
+
+    Available requests: by authority id and authority heading.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.headings = {}
+
+    def __eq__(self, other):
+        return isinstance(other, AuthorityIndex) and self.ids == other.ids and self.headings == other.headings
+
+    def __len__(self):
+        return len(self.ids)
+
+    def copy(self):
+        """
+        Returns new version of index: tables keep only its changes over tables of this version (see layered_dict),
+        lists of ids are shared (updates replace them, see add_heading_id).
+        """
+        index_copy = AuthorityIndex()
+        index_copy.ids = copy_layered(self.ids)
+        index_copy.headings = copy_layered(self.headings)
+        return index_copy
+
+    def has_id(self, record_id):
+        return pack_record_id(record_id) in self.ids
+
+    def has_heading(self, heading):
+        return heading in self.headings
+
+    def get_heading(self, record_id):
+        return self.ids.get(pack_record_id(record_id))
+
+    def get_ids(self, heading):
+        packed_ids = self.headings.get(heading)
+        if packed_ids is None:
+            return []
+        if isinstance(packed_ids, list):
+            return [unpack_record_id(packed_id) for packed_id in packed_ids]
+        return [unpack_record_id(packed_ids)]
+
+    def get_first_id(self, heading):
+        packed_ids = self.headings.get(heading)
+        if packed_ids is None:
+            return None
+        if isinstance(packed_ids, list):
+            return unpack_record_id(packed_ids[0])
+        return unpack_record_id(packed_ids)
+
+    def add_heading_id(self, heading, packed_id):
+        """
+        Adds id to ids of heading; list of ids is replaced, not modified (it can be shared with older version).
+        """
+        packed_ids = self.headings.get(heading)
+        if packed_ids is None:
+            self.headings[heading] = packed_id
+        elif isinstance(packed_ids, list):
+            self.headings[heading] = packed_ids + [packed_id]
+        else:
+            self.headings[heading] = [packed_ids, packed_id]
+
+    def remove_heading_id(self, heading, packed_id):
+        packed_ids = self.headings.get(heading)
+        if isinstance(packed_ids, list):
+            if packed_id in packed_ids:
+                packed_ids = list(packed_ids)
+                packed_ids.remove(packed_id)
+                self.headings[heading] = packed_ids[0] if len(packed_ids) == 1 else packed_ids
+        elif packed_ids == packed_id:
+            del self.headings[heading]
+
+    def index_record(self, record_id, heading):
+        """
+        Adds heading of authority record (used by index build; records with several heading fields
+        are findable by all of them, but id points to the last one).
+        """
+        heading = sys.intern(heading)
+        packed_id = pack_record_id(record_id)
+        packed_ids = self.headings.get(heading)
+        if isinstance(packed_ids, list):
+            # index being built is not shared yet - list is extended in place
+            packed_ids.append(packed_id)
+        else:
+            self.add_heading_id(heading, packed_id)
+        self.ids[packed_id] = heading
+
+    def update_record(self, record_id, heading):
+        """
+        Adds new authority record or moves existing one to the new heading.
+        """
+        heading = sys.intern(heading)
+        packed_id = pack_record_id(record_id)
+        old_heading = self.ids.get(packed_id)
+
+        if old_heading == heading:
+            return
+        if old_heading is not None:
+            self.remove_heading_id(old_heading, packed_id)
+
+        self.ids[packed_id] = heading
+        self.add_heading_id(heading, packed_id)
+
+    def remove_record(self, record_id):
+        packed_id = pack_record_id(record_id)
+        heading = self.ids.pop(packed_id, None)
+        if heading is not None:
+            self.remove_heading_id(heading, packed_id)
+
+    def as_dict(self):
+        """
+        Returns index in the old form of one dictionary: record id (string): heading (string)
+        and heading (string): record ids (list).
+        """
+        record_ids = {packed_id: unpack_record_id(packed_id) for packed_id in self.ids}
+
+        authority_dict = {}
+        for heading, packed_ids in self.headings.items():
+            packed_ids = packed_ids if isinstance(packed_ids, list) else [packed_ids]
+            authority_dict[heading] = [record_ids.get(packed_id) or unpack_record_id(packed_id) for packed_id in packed_ids]
+        for packed_id, heading in self.ids.items():
+            authority_dict[record_ids[packed_id]] = heading
+        return authority_dict
+
+    def memory_report(self):
+        """
+        Returns memory used by this index and by the same data in the old form of one dictionary (see as_dict), in bytes.
+        """
+        index_size = get_deep_size(self)
+        dict_size = get_deep_size(self.as_dict())
+        return {'records': len(self.ids), 'headings': len(self.headings),
+                'authority_index_bytes': index_size, 'dict_bytes': dict_size,
+                'saved_percent': round(100 * (dict_size - index_size) / dict_size, 1) if dict_size else 0.0}
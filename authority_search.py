@@ -0,0 +1,270 @@
+import re
+import time
+import bisect
+import logging
+import threading
+import unicodedata
+from array import array
+from collections import Counter
+
+# search index over authority headings (secondary to AuthorityIndex): prefix search and fuzzy search
+
+# headings are folded (case, diacritics, punctuation and extra spaces ignored, see fold_heading);
+# prefix search uses sorted list of folded headings, fuzzy search uses trigrams of folded headings
+# with sorted words (so different order of words does not matter) and Dice coefficient as similarity
+
+NON_WORD_PATTERN = re.compile(r'[\W_]+')
+
+# index is rebuilt when this fraction of heading numbers belongs to removed headings
+REBUILD_RATIO = 0.2
+
+# fuzzy search limits: max heading numbers read from trigram postings (rarest trigrams are read first)
+# and max candidates (headings sharing most trigrams with query) for which similarity is computed
+MAX_SCANNED_POSTINGS = 20000
+MAX_VERIFIED_CANDIDATES = 200
+
+
+class FoldingTable(dict):
+    """
+    Translation table (for str.translate) of characters to lowercase characters without diacritics;
+    characters are decomposed on first use and cached.
+    """
+    SPECIAL_CHARACTERS = {'ł': 'l', 'đ': 'd', 'ø': 'o', 'ß': 'ss'}
+
+    def __missing__(self, code_point):
+        character = chr(code_point).casefold()
+        character = self.SPECIAL_CHARACTERS.get(character, character)
+        folded = ''.join(part for part in unicodedata.normalize('NFKD', character) if not unicodedata.combining(part))
+        self[code_point] = folded
+        return folded
+
+
+FOLDING_TABLE = FoldingTable()
+
+
+def fold_heading(heading):
+    """
+    Returns heading in lowercase, without diacritics and punctuation, with words separated by single spaces.
+    """
+    return NON_WORD_PATTERN.sub(' ', heading.translate(FOLDING_TABLE)).strip()
+
+
+def get_words_key(folded_heading):
+    return ' '.join(sorted(folded_heading.split()))
+
+
+def get_trigrams(words_key):
+    padded = ' {} '.format(words_key)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def get_similarity(trigrams, other_trigrams):
+    """
+    Returns Dice coefficient of two sets of trigrams (1.0 - the same sets).
+    """
+    return 2 * len(trigrams & other_trigrams) / (len(trigrams) + len(other_trigrams))
+
+
+class AuthoritySearchIndex(object):
+    """
+    Search index over headings of AuthorityIndex. Headings are numbered; structures:
+    headings: heading number: heading (None for removed headings)
+    numbers: heading: heading number
+    words_keys: heading number: folded heading with sorted words
+    sorted_folded, sorted_numbers: folded headings (sorted) and numbers of their headings - for prefix search
+    words_index: folded heading with sorted words: heading number or list of numbers (headings folded the same way)
+    trigrams: trigram: array of heading numbers (numbers of removed headings are skipped while searching)
+
+    Index is shared by all versions of AuthorityIndex and updated in place (see sync).
+    """
+    def __init__(self):
+        self.headings = []
+        self.numbers = {}
+        self.words_keys = []
+        self.sorted_folded = []
+        self.sorted_numbers = array('I')
+        self.words_index = {}
+        self.trigrams = {}
+        self.removed_count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.numbers)
+
+    @classmethod
+    def from_authority_index(cls, authority_index):
+        search_index = cls()
+        search_index.build(authority_index.headings)
+        return search_index
+
+    def build(self, headings):
+        start = time.perf_counter()
+
+        self.headings = []
+        self.numbers = {}
+        self.words_keys = []
+        self.words_index = {}
+        self.trigrams = {}
+        self.removed_count = 0
+        sorted_entries = []
+
+        for heading in headings:
+            number, folded = self.add_to_tables(heading)
+            sorted_entries.append((folded, number))
+
+        sorted_entries.sort()
+        self.sorted_folded = [folded for folded, number in sorted_entries]
+        self.sorted_numbers = array('I', (number for folded, number in sorted_entries))
+
+        logging.info('Zbudowano indeks wyszukiwania haseł wzorcowych: {} haseł, {} trygramów ({:.1f} s)'.format(
+            len(self.numbers), len(self.trigrams), time.perf_counter() - start))
+
+    def add_to_tables(self, heading):
+        number = len(self.headings)
+        folded = fold_heading(heading)
+        words_key = get_words_key(folded)
+
+        self.headings.append(heading)
+        self.numbers[heading] = number
+        self.words_keys.append(words_key)
+
+        numbers = self.words_index.get(words_key)
+        if numbers is None:
+            self.words_index[words_key] = number
+        elif isinstance(numbers, list):
+            numbers.append(number)
+        else:
+            self.words_index[words_key] = [numbers, number]
+
+        for trigram in get_trigrams(words_key):
+            postings = self.trigrams.get(trigram)
+            if postings is None:
+                postings = self.trigrams[trigram] = array('I')
+            postings.append(number)
+
+        return number, folded
+
+    def add_heading(self, heading):
+        with self.lock:
+            if heading in self.numbers:
+                return
+            number, folded = self.add_to_tables(heading)
+            position = bisect.bisect_left(self.sorted_folded, folded)
+            self.sorted_folded.insert(position, folded)
+            self.sorted_numbers.insert(position, number)
+
+    def remove_heading(self, heading):
+        with self.lock:
+            number = self.numbers.pop(heading, None)
+            if number is None:
+                return
+
+            # number stays in trigram postings (skipped while searching) until rebuild
+            self.headings[number] = None
+            self.removed_count += 1
+
+            words_key = self.words_keys[number]
+            numbers = self.words_index.get(words_key)
+            if isinstance(numbers, list):
+                numbers.remove(number)
+                if len(numbers) == 1:
+                    self.words_index[words_key] = numbers[0]
+            else:
+                del self.words_index[words_key]
+
+            folded = fold_heading(heading)
+            position = bisect.bisect_left(self.sorted_folded, folded)
+            while self.sorted_numbers[position] != number:
+                position += 1
+            del self.sorted_folded[position]
+            del self.sorted_numbers[position]
+
+            if self.removed_count > len(self.headings) * REBUILD_RATIO:
+                self.build(list(self.numbers))
+
+    def sync(self, old_authority_index, new_authority_index, records_ids):
+        """
+        Updates index after records with given ids were changed (new_authority_index is the updated copy
+        of old_authority_index).
+        """
+        changed_headings = set()
+        for record_id in records_ids:
+            changed_headings.add(old_authority_index.get_heading(record_id))
+            changed_headings.add(new_authority_index.get_heading(record_id))
+        changed_headings.discard(None)
+
+        for heading in changed_headings:
+            if new_authority_index.has_heading(heading):
+                self.add_heading(heading)
+            else:
+                self.remove_heading(heading)
+
+    def search_prefix(self, prefix, limit=20):
+        """
+        Returns headings (max limit) which start with given prefix (after folding), in alphabetical order.
+        """
+        folded_prefix = fold_heading(prefix)
+        results = []
+
+        with self.lock:
+            position = bisect.bisect_left(self.sorted_folded, folded_prefix)
+            while position < len(self.sorted_folded) and len(results) < limit:
+                if not self.sorted_folded[position].startswith(folded_prefix):
+                    break
+                results.append(self.headings[self.sorted_numbers[position]])
+                position += 1
+
+        return results
+
+    def search(self, query, limit=20, min_similarity=0.5):
+        """
+        Returns list of tuples: heading, similarity (0-1) - max limit headings most similar to query,
+        with similarity not lower than min_similarity.
+        Search is approximate for queries made only of very common trigrams (see MAX_SCANNED_POSTINGS).
+        """
+        words_key = get_words_key(fold_heading(query))
+        query_trigrams = get_trigrams(words_key)
+
+        with self.lock:
+            # every heading with similarity >= min_similarity shares at least required trigrams with query,
+            # so it is found in postings of (len(query_trigrams) - required + 1) rarest trigrams of query
+            required = max(1, int(min_similarity * len(query_trigrams) / (2 - min_similarity)))
+            postings = sorted((self.trigrams.get(trigram, ()) for trigram in query_trigrams), key=len)
+            candidates = Counter()
+            scanned = 0
+            for numbers in postings[:len(query_trigrams) - required + 1]:
+                if scanned and scanned + len(numbers) > MAX_SCANNED_POSTINGS:
+                    break
+                candidates.update(numbers)
+                scanned += len(numbers)
+
+            results = []
+            for number, shared in candidates.most_common(MAX_VERIFIED_CANDIDATES):
+                heading = self.headings[number]
+                if heading is None:
+                    continue
+                similarity = get_similarity(query_trigrams, get_trigrams(self.words_keys[number]))
+                if similarity >= min_similarity:
+                    results.append((heading, round(similarity, 3)))
+
+        results.sort(key=lambda result: (-result[1], result[0]))
+        return results[:limit]
+
+    def find_best_match(self, query, min_similarity=0.9):
+        """
+        Returns the only heading matching query after folding (or the only one most similar to query,
+        with similarity not lower than min_similarity); None if there is no such heading or match is ambiguous.
+        """
+        words_key = get_words_key(fold_heading(query))
+
+        with self.lock:
+            numbers = self.words_index.get(words_key)
+            if isinstance(numbers, list):
+                return None
+            if numbers is not None:
+                return self.headings[numbers]
+
+        results = self.search(query, limit=2, min_similarity=min_similarity)
+        if not results or len(results) == 2 and results[0][1] == results[1][1]:
+            return None
+        return results[0][0]
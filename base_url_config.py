@@ -1 +1,2 @@
-BASE_URL = 'localhost:80'
\ No newline at end of file
+BASE_URL = 'localhost:80'
+DATA_BN_URL = 'http://data.bn.org.pl'
\ No newline at end of file
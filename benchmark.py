@@ -0,0 +1,369 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import threading
+import subprocess
+from datetime import datetime
+
+# performance benchmarks on synthetic data (see synthetic_marc.py) with local data.bn.org.pl stand-in
+# (see fake_data_bn.py):
+# index build (time, memory), record processing throughput, compressed bib records store (memory saved, added latency
+# of reading a page), /get_bibs latency (end to end, over HTTP) and updater catch-up (update jobs run by the API)
+
+# results (flat dict: benchmark.metric: value) are written to JSON file with parameters and environment;
+# results of two runs can be compared with --compare
+
+# all benchmarks run in work directory (dumps, snapshots and journals are created there)
+
+RESULTS_FORMAT_VERSION = 1
+
+# metrics for which lower value is better (the others: higher is better); used by comparison only
+LOWER_IS_BETTER_SUFFIXES = ('_seconds', '_bytes', '_ms')
+
+
+def get_peak_memory_bytes():
+    """
+    Returns peak resident memory of this process, None if it is not available (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def get_percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def get_environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'commit': commit}
+
+
+def prepare_data(args):
+    """
+    Generates dumps in work directory (unless dumps generated with the same parameters already exist).
+    """
+    from synthetic_marc import generate_dumps
+
+    parameters = {'authorities': args.authorities, 'bibs': args.bibs, 'seed': args.seed,
+                  'broken_ratio': args.broken_ratio}
+    parameters_path = 'dumps.json'
+    if os.path.exists(parameters_path) and os.path.exists('bibs-all.marc') and os.path.exists('authorities-all.marc'):
+        with open(parameters_path, 'r', encoding='utf-8') as fp:
+            if json.load(fp) == parameters:
+                logging.info('Używam wygenerowanych wcześniej plików')
+                return {}
+
+    start = time.perf_counter()
+    counters = generate_dumps('authorities-all.marc', 'bibs-all.marc', args.authorities, args.bibs, args.seed,
+                              args.broken_ratio)
+    with open(parameters_path, 'w', encoding='utf-8') as fp:
+        json.dump(parameters, fp)
+
+    return {'data.generate_seconds': time.perf_counter() - start,
+            'data.bibs_bytes': os.path.getsize('bibs-all.marc'),
+            'data.authorities_bytes': os.path.getsize('authorities-all.marc'),
+            'data.broken_records': counters['bibs']['broken'] + counters['authorities']['broken']}
+
+
+def benchmark_index_build(args):
+    from authority_index import get_deep_size
+    from api_core import create_authority_index, create_local_bib_index
+    from parallel_indexer import create_authority_index_parallel, create_local_bib_index_parallel
+
+    results = {}
+    builders = [('serial', create_authority_index, create_local_bib_index),
+                ('parallel', lambda data: create_authority_index_parallel(data, args.processes),
+                 lambda data: create_local_bib_index_parallel(data, args.processes))]
+
+    for mode, create_auth, create_bib in builders:
+        start = time.perf_counter()
+        auth_index = create_auth('authorities-all.marc')
+        results['index_build.authorities_{}_seconds'.format(mode)] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        bib_index = create_bib('bibs-all.marc')
+        results['index_build.bibs_{}_seconds'.format(mode)] = time.perf_counter() - start
+
+    memory_report = auth_index.memory_report()
+    results.update({'index_build.authority_records': memory_report['records'],
+                    'index_build.authority_headings': memory_report['headings'],
+                    'index_build.authority_index_bytes': memory_report['authority_index_bytes'],
+                    'index_build.bib_records': len(bib_index),
+                    'index_build.bib_locations_bytes': get_deep_size(bib_index.locations)})
+    return results
+
+
+def benchmark_processing(args):
+    from permissive import PermissiveMARCReader
+    from parallel_indexer import create_authority_index_parallel
+    from api_core import process_records
+    from marc_serializers import record_to_marcxml, record_to_jsonl
+
+    # index is built from dump (snapshot in work directory can contain updates made by previous runs)
+    auth_index = create_authority_index_parallel('authorities-all.marc', args.processes)
+
+    with open('bibs-all.marc', 'rb') as fp:
+        start = time.perf_counter()
+        rdr = PermissiveMARCReader(fp, to_unicode=True, force_utf8=True, utf8_handling='ignore')
+        records = [rcd for rcd, i in zip(rdr, range(args.process_records))]
+        parse_seconds = time.perf_counter() - start
+
+    stats = {'linked': 0}
+    start = time.perf_counter()
+    records = process_records(records, auth_index, stats)
+    enrich_seconds = time.perf_counter() - start
+
+    results = {'processing.records': len(records), 'processing.reader_failed': rdr.failed,
+               'processing.linked_fields_per_record': stats['linked'] / len(records) if records else 0,
+               'processing.parse_records_per_second': len(records) / parse_seconds,
+               'processing.enrich_records_per_second': len(records) / enrich_seconds}
+
+    for output_format, serialize in (('xml', record_to_marcxml), ('jsonl', record_to_jsonl)):
+        start = time.perf_counter()
+        for rcd in records:
+            serialize(rcd)
+        results['processing.render_{}_records_per_second'.format(output_format)] = \
+            len(records) / (time.perf_counter() - start)
+    return results
+
+
+def read_pages(store, pages):
+    """
+    Reads records of pages (lists of ids) from bib records store. Returns list of latencies (seconds) of pages.
+    """
+    latencies = []
+    for page in pages:
+        start = time.perf_counter()
+        for record_id in page:
+            bytes(store[record_id])
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def benchmark_bib_store(args):
+    """
+    Memory of records (mapped segment, decompressed blocks cache) and latency of reading /get_bibs pages
+    (records in order of ids, as listed by data.bn) - uncompressed and compressed bib records store.
+    """
+    from fake_data_bn import get_numeric_id
+    from parallel_indexer import create_local_bib_index_parallel, create_compressed_bib_index_parallel
+
+    start = time.perf_counter()
+    plain_store = create_local_bib_index_parallel('bibs-all.marc', args.processes)
+    plain_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    compressed_store = create_compressed_bib_index_parallel('bibs-all.marc', args.processes)
+    compressed_seconds = time.perf_counter() - start
+
+    records_ids = sorted(plain_store, key=get_numeric_id)
+    pages = [records_ids[i:i + args.page_size] for i in range(0, len(records_ids), args.page_size)][:args.pages]
+    plain_latencies = read_pages(plain_store, pages)
+    compressed_store.base.clear_cache()
+    cold_latencies = read_pages(compressed_store, pages)
+    warm_latencies = read_pages(compressed_store, pages)
+    stats = compressed_store.base.get_stats()
+
+    plain_ms = get_percentile(plain_latencies, 50) * 1000
+    cold_ms = get_percentile(cold_latencies, 50) * 1000
+    return {'bib_store.build_plain_seconds': plain_seconds,
+            'bib_store.build_compressed_seconds': compressed_seconds,
+            'bib_store.plain_bytes': os.path.getsize('bibs-all.marc'),
+            'bib_store.compressed_bytes': stats['compressed_bytes'],
+            'bib_store.compression_ratio': stats['records_bytes'] / stats['compressed_bytes'],
+            'bib_store.compressed_memory_bytes': stats['compressed_bytes'] + stats['size_in_bytes'],
+            'bib_store.blocks': stats['blocks'],
+            'bib_store.page_plain_p50_ms': plain_ms,
+            'bib_store.page_compressed_cold_p50_ms': cold_ms,
+            'bib_store.page_compressed_warm_p50_ms': get_percentile(warm_latencies, 50) * 1000,
+            'bib_store.page_added_latency_ms': cold_ms - plain_ms}
+
+
+def start_api(fake_data_bn_url):
+    """
+    Starts the API (indexes built or loaded at import) on free port in background thread.
+    Returns tuple: api_morepath module, API base url, startup time (seconds).
+    """
+    from waitress.server import create_server
+    from data_bn_client import data_bn_client
+
+    data_bn_client.base_url = fake_data_bn_url
+    start = time.perf_counter()
+    import api_morepath
+    startup_seconds = time.perf_counter() - start
+
+    app = api_morepath.App()
+    app.commit()
+    server = create_server(app, host='127.0.0.1', port=0, threads=8)
+    threading.Thread(target=server.run, name='api', daemon=True).start()
+    return api_morepath, 'http://127.0.0.1:{}'.format(server.effective_port), startup_seconds
+
+
+def harvest(session, api_url, first_query, pages):
+    """
+    Requests /get_bibs pages following nextPage (max pages). Returns list of tuples: latency (seconds), records.
+    """
+    latencies = []
+    query = first_query
+    while query and len(latencies) < pages:
+        start = time.perf_counter()
+        response = session.get('{}/get_bibs/{}?format=jsonl'.format(api_url, query))
+        response.raise_for_status()
+        lines = response.content.splitlines()
+        latencies.append((time.perf_counter() - start, len(lines) - 1))
+
+        next_page = json.loads(lines[0])['nextPage']
+        query = next_page.split('/get_bibs/', 1)[1] if next_page else None
+    return latencies
+
+
+def summarize_harvest(name, latencies):
+    seconds = [latency for latency, records in latencies]
+    records = sum(records for latency, records in latencies)
+    return {'{}.pages'.format(name): len(latencies), '{}.records'.format(name): records,
+            '{}.latency_p50_ms'.format(name): get_percentile(seconds, 50) * 1000,
+            '{}.latency_p95_ms'.format(name): get_percentile(seconds, 95) * 1000,
+            '{}.latency_max_ms'.format(name): max(seconds) * 1000,
+            '{}.records_per_second'.format(name): records / sum(seconds) if sum(seconds) else 0}
+
+
+def wait_for_job(session, api_url, job_id, timeout=3600):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        jobs = {job['job_id']: job for job in session.get('{}/get_update_status'.format(api_url)).json()['jobs']}
+        if jobs[job_id]['state'] in ('done', 'failed'):
+            return jobs[job_id]
+        time.sleep(0.2)
+    raise TimeoutError('Update job {} not finished in {} s'.format(job_id, timeout))
+
+
+def benchmark_api(args):
+    import requests
+    from fake_data_bn import FakeDataBnServer
+
+    fake_data_bn = FakeDataBnServer('bibs-all.marc', 'authorities-all.marc', latency=args.latency,
+                                    updated_count=args.updated, deleted_count=args.deleted, seed=args.seed)
+    fake_data_bn.start()
+
+    # start from scratch - indexes are built at startup
+    shutil.rmtree('snapshots', ignore_errors=True)
+    api_morepath, api_url, startup_seconds = start_api(fake_data_bn.base_url)
+    results = {'api.startup_seconds': startup_seconds, 'api.peak_memory_bytes': get_peak_memory_bytes()}
+
+    session = requests.Session()
+    first_query = 'limit={}'.format(args.page_size)
+    results.update(summarize_harvest('get_bibs_cold', harvest(session, api_url, first_query, args.pages)))
+    results.update(summarize_harvest('get_bibs_warm', harvest(session, api_url, first_query, args.pages)))
+
+    # updater catch-up: authorities, then bibs (as scheduled in production)
+    for index in ('authorities', 'bibs'):
+        start = time.perf_counter()
+        job = session.get('{}/update/{}'.format(api_url, index)).json()
+        job = wait_for_job(session, api_url, job['job_id'])
+        seconds = time.perf_counter() - start
+        changed = job['progress'].get('deleted', 0) + job['progress'].get('updated', 0)
+        results.update({'update_{}.state_done'.format(index): int(job['state'] == 'done'),
+                        'update_{}.changed_records'.format(index): changed,
+                        'update_{}.seconds'.format(index): seconds,
+                        'update_{}.records_per_second'.format(index): changed / seconds if seconds else 0})
+
+    results['get_bibs_after_update.latency_p50_ms'] = summarize_harvest(
+        'after_update', harvest(session, api_url, first_query, args.pages))['after_update.latency_p50_ms']
+    results['api.data_bn_requests'] = fake_data_bn.requests_count
+    fake_data_bn.stop()
+    return results
+
+
+def compare_results(old_results, new_results):
+    """
+    Returns lines of comparison table of two results files (common numeric metrics).
+    """
+    lines = ['{:<55} {:>14} {:>14} {:>9}'.format('metric', 'old', 'new', 'change')]
+    for name in sorted(set(old_results['results']) & set(new_results['results'])):
+        old_value, new_value = old_results['results'][name], new_results['results'][name]
+        if not isinstance(old_value, (int, float)) or not isinstance(new_value, (int, float)):
+            continue
+        change = '{:+.1f}%'.format(100 * (new_value - old_value) / old_value) if old_value else ''
+        if change and new_value != old_value:
+            # + better, - worse
+            better = new_value < old_value if name.endswith(LOWER_IS_BETTER_SUFFIXES) else new_value > old_value
+            change += ' +' if better else ' -'
+        lines.append('{:<55} {:>14.4g} {:>14.4g} {:>9}'.format(name, old_value, new_value, change))
+    return lines
+
+
+BENCHMARKS = {'index_build': benchmark_index_build, 'processing': benchmark_processing, 'bib_store': benchmark_bib_store,
+              'api': benchmark_api}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Testy wydajności na syntetycznych danych z atrapą data.bn.org.pl.')
+    parser.add_argument('--workdir', default='benchmark_data', help='katalog roboczy (pliki, migawki, dzienniki)')
+    parser.add_argument('--output', default=None, help='plik wyników JSON (domyślnie: benchmark-<data>.json)')
+    parser.add_argument('--compare', default=None, help='plik wyników wcześniejszego przebiegu do porównania')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), default=None, help='wybrane testy')
+    parser.add_argument('--authorities', type=int, default=20000, help='liczba rekordów wzorcowych')
+    parser.add_argument('--bibs', type=int, default=50000, help='liczba rekordów bibliograficznych')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--broken-ratio', type=float, default=0.002, help='udział błędnych rekordów')
+    parser.add_argument('--processes', type=int, default=None, help='procesy budowy indeksów (domyślnie: wszystkie)')
+    parser.add_argument('--process-records', type=int, default=10000, help='rekordy w teście przetwarzania')
+    parser.add_argument('--pages', type=int, default=30, help='strony /get_bibs w każdym przebiegu')
+    parser.add_argument('--page-size', type=int, default=100, help='rekordy na stronie /get_bibs')
+    parser.add_argument('--latency', type=float, default=0.0, help='opóźnienie odpowiedzi atrapy data.bn (s)')
+    parser.add_argument('--updated', type=int, default=500, help='rekordy zaktualizowane (każdego typu)')
+    parser.add_argument('--deleted', type=int, default=50, help='rekordy usunięte (każdego typu)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s %(message)s', datefmt="%H:%M:%S",
+                        stream=sys.stdout)
+
+    output = os.path.abspath(args.output or 'benchmark-{}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+    compare = os.path.abspath(args.compare) if args.compare else None
+    os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir)
+    # docs are served by the API from working directory
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'docs.html'), 'docs.html')
+
+    results = prepare_data(args)
+    for name in args.only or BENCHMARKS:
+        logging.info('Test: {}'.format(name))
+        start = time.perf_counter()
+        results.update(BENCHMARKS[name](args))
+        logging.info('Test {} zakończony ({:.1f} s)'.format(name, time.perf_counter() - start))
+
+    parameters = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+    run = {'format': RESULTS_FORMAT_VERSION, 'created': datetime.now().isoformat(timespec='seconds'),
+           'environment': get_environment(), 'parameters': parameters,
+           'results': {name: round(value, 6) if isinstance(value, float) else value
+                       for name, value in sorted(results.items())}}
+    with open(output, 'w', encoding='utf-8') as fp:
+        json.dump(run, fp, indent=2)
+    logging.info('Wyniki: {}'.format(output))
+
+    if compare:
+        with open(compare, 'r', encoding='utf-8') as fp:
+            print('\n'.join(compare_results(json.load(fp), run)))
+    else:
+        print('\n'.join('{:<55} {:>14.4g}'.format(name, value) for name, value in run['results'].items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+import time
+import bisect
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import parse_qsl, urlencode
+from permissive import PermissiveMARCScanner
+from data_bn_client import data_bn_client
+
+# local listing of bibliographic records: answers /get_bibs queries (data.bn.org.pl bibs.json listings) from local
+# bib records store, without asking data.bn.org.pl for ids of records on the page
+
+# records are ordered by numeric id (id of data.bn.org.pl: record id without prefix and check digit) and pages
+# follow sinceId cursor like data.bn.org.pl; supported parameters (see LISTING_PARAMETERS):
+# limit (required, max MAX_LIMIT), sinceId, updatedDate (from[,to] - compared with date of the latest transaction,
+# field 005), publicationYear (008/07-10), language (MARC code, 008/35-37);
+# queries with other parameters (createdDate, deleted, author...) are answered by data.bn.org.pl
+
+LISTING_PARAMETERS = frozenset(['limit', 'sinceId', 'updatedDate', 'publicationYear', 'language'])
+MAX_LIMIT = 100
+
+# record without field 005 / deleted record (see BibListingIndex.updated)
+NO_DATE = 0
+DELETED = -1
+
+
+def get_numeric_id(record_id):
+    """
+    Returns numeric id of record (e.g. 'b1000001x' -> 1000001), None if record id has other form.
+    """
+    numeric_part = record_id[1:-1]
+    return int(numeric_part) if numeric_part.isdigit() else None
+
+
+def parse_date(value):
+    """
+    Returns date (ISO 8601, e.g. 2018-11-13T10:00:00Z) as number in form of field 005 (YYYYMMDDHHMMSS).
+    """
+    value = value.strip()
+    date = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    return int(date.strftime('%Y%m%d%H%M%S'))
+
+
+def parse_query(query):
+    """
+    Returns tuple: query parameters (list of pairs), limit, sinceId, filters (dict: name: value) -
+    or None if query can't be answered locally.
+    """
+    if '://' in query or '?' in query:
+        return None
+    try:
+        params = parse_qsl(query, keep_blank_values=True, strict_parsing=True)
+    except ValueError:
+        return None
+
+    values = dict(params)
+    if len(values) != len(params) or not set(values) <= LISTING_PARAMETERS or 'limit' not in values:
+        return None
+
+    filters = {}
+    try:
+        limit = int(values['limit'])
+        since_id = int(values.get('sinceId', 0))
+        if 'updatedDate' in values:
+            dates = values['updatedDate'].split(',')
+            if len(dates) > 2:
+                return None
+            filters['updated'] = (parse_date(dates[0]), parse_date(dates[1]) if len(dates) == 2 else None)
+        if 'publicationYear' in values:
+            filters['year'] = int(values['publicationYear'])
+    except ValueError:
+        return None
+    if 'language' in values:
+        if len(values['language']) != 3:
+            return None
+        filters['language'] = values['language']
+
+    if not 0 < limit <= MAX_LIMIT:
+        return None
+    return params, limit, since_id, filters
+
+
+def get_listed_range(query, json_response):
+    """
+    Returns range of numeric ids covered by page listed locally for query: tuple sinceId, numeric id of the last
+    record on page (None for the last page). Page changes when record in range is added, deleted or changed
+    (it can start or stop matching filters).
+    """
+    since_id = parse_query(query)[2]
+    last_id = json_response['bibs'][-1]['id'] if json_response['nextPage'] and json_response['bibs'] else None
+    return since_id, last_id
+
+
+class BibListingIndex(object):
+    """
+    Secondary indexes of bibliographic records store, ordered by numeric id of record (columns of equal length):
+    numeric_ids (sorted), records_ids, updated (field 005 as YYYYMMDDHHMMSS number, NO_DATE or DELETED),
+    years (publication year, 0 - unknown), languages (number of language code in language_codes).
+
+    Index is shared by all versions of bibliographic records store and updated in place (see sync); deleted records
+    are marked in updated column and dropped when there are many of them. Ids of records matching filters
+    of recent queries are cached (pages of one query are answered by bisect of the cached ids).
+    """
+    def __init__(self):
+        self.numeric_ids = array('q')
+        self.records_ids = []
+        self.updated = array('q')
+        self.years = array('h')
+        self.languages = array('H')
+        self.language_codes = ['']
+        self.language_numbers = {'': 0}
+        self.deleted_count = 0
+        self.lock = threading.Lock()
+        self.matches_cache = OrderedDict()
+        self.matches_cache_size = 32
+
+    def __getstate__(self):
+        return {'numeric_ids': self.numeric_ids, 'records_ids': self.records_ids, 'updated': self.updated,
+                'years': self.years, 'languages': self.languages, 'language_codes': self.language_codes,
+                'deleted_count': self.deleted_count}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.__dict__.update(state)
+        self.language_numbers = {code: number for number, code in enumerate(self.language_codes)}
+
+    def __len__(self):
+        return len(self.numeric_ids) - self.deleted_count
+
+    def get_language_number(self, code):
+        number = self.language_numbers.get(code)
+        if number is None:
+            self.language_codes.append(code)
+            number = self.language_numbers[code] = len(self.language_codes) - 1
+        return number
+
+    @staticmethod
+    def get_columns(raw_record):
+        """
+        Returns tuple: updated, year, language code - of bibliographic record (ISO 2709).
+        """
+        for rcd in PermissiveMARCScanner(raw_record, ['005', '008'], utf8_handling='ignore'):
+            updated = NO_DATE
+            year = 0
+            language = ''
+            if '005' in rcd:
+                digits = rcd.value('005')[:14]
+                updated = int(digits) if len(digits) == 14 and digits.isdigit() else NO_DATE
+            if '008' in rcd:
+                data = rcd.value('008')
+                year = int(data[7:11]) if data[7:11].isdigit() else 0
+                language = data[35:38].strip()
+            return updated, year, language
+        return NO_DATE, 0, ''
+
+    def build(self, bib_index):
+        """
+        Indexes all records of bibliographic records store.
+        """
+        start = time.perf_counter()
+        rows = []
+        for record_id in bib_index:
+            numeric_id = get_numeric_id(record_id)
+            if numeric_id is not None:
+                rows.append((numeric_id, record_id) + self.get_columns(bib_index[record_id]))
+        rows.sort()
+
+        with self.lock:
+            self.numeric_ids = array('q', [row[0] for row in rows])
+            self.records_ids = [row[1] for row in rows]
+            self.updated = array('q', [row[2] for row in rows])
+            self.years = array('h', [row[3] for row in rows])
+            self.languages = array('H', [self.get_language_number(row[4]) for row in rows])
+            self.deleted_count = 0
+            self.matches_cache.clear()
+
+        logging.info('Zbudowano indeks listowania rekordów bibliograficznych: {} rekordów ({:.1f} s)'.format(
+            len(rows), time.perf_counter() - start))
+
+    def sync(self, new_bib_index, records_ids):
+        """
+        Updates index after records with given ids were changed (new_bib_index - the updated store).
+        """
+        with self.lock:
+            for record_id in set(records_ids):
+                numeric_id = get_numeric_id(record_id)
+                if numeric_id is None:
+                    continue
+                raw_record = new_bib_index.get(record_id)
+                if raw_record is None:
+                    self.delete_record(numeric_id)
+                else:
+                    self.put_record(numeric_id, record_id, *self.get_columns(raw_record))
+
+            if self.deleted_count > len(self.numeric_ids) // 10:
+                self.drop_deleted()
+            self.matches_cache.clear()
+
+    def put_record(self, numeric_id, record_id, updated, year, language):
+        position = bisect.bisect_left(self.numeric_ids, numeric_id)
+        if position < len(self.numeric_ids) and self.numeric_ids[position] == numeric_id:
+            if self.updated[position] == DELETED:
+                self.deleted_count -= 1
+        else:
+            # new records have the highest ids usually - inserted at the end
+            self.numeric_ids.insert(position, numeric_id)
+            self.records_ids.insert(position, record_id)
+            self.updated.insert(position, 0)
+            self.years.insert(position, 0)
+            self.languages.insert(position, 0)
+        self.updated[position] = updated
+        self.years[position] = year
+        self.languages[position] = self.get_language_number(language)
+
+    def delete_record(self, numeric_id):
+        position = bisect.bisect_left(self.numeric_ids, numeric_id)
+        if position < len(self.numeric_ids) and self.numeric_ids[position] == numeric_id and \
+                self.updated[position] != DELETED:
+            self.updated[position] = DELETED
+            self.deleted_count += 1
+
+    def drop_deleted(self):
+        live = [position for position, updated in enumerate(self.updated) if updated != DELETED]
+        self.numeric_ids = array('q', [self.numeric_ids[position] for position in live])
+        self.records_ids = [self.records_ids[position] for position in live]
+        self.updated = array('q', [self.updated[position] for position in live])
+        self.years = array('h', [self.years[position] for position in live])
+        self.languages = array('H', [self.languages[position] for position in live])
+        self.deleted_count = 0
+
+    def get_matching_positions(self, filters):
+        """
+        Returns sorted list of positions of live records matching filters (by scan of columns; cached by filters).
+        """
+        key = tuple(sorted(filters.items()))
+        positions = self.matches_cache.get(key)
+        if positions is not None:
+            self.matches_cache.move_to_end(key)
+            return positions
+
+        date_from, date_to = filters.get('updated', (None, None))
+        date_from = NO_DATE + 1 if date_from is None else date_from
+        date_to = 99999999999999 if date_to is None else date_to
+        year = filters.get('year')
+        language = self.language_numbers.get(filters['language'], -1) if 'language' in filters else None
+
+        positions = [position for position, updated in enumerate(self.updated)
+                     if (updated != DELETED if 'updated' not in filters else date_from <= updated <= date_to)
+                     and (year is None or self.years[position] == year)
+                     and (language is None or self.languages[position] == language)]
+
+        self.matches_cache[key] = positions
+        if len(self.matches_cache) > self.matches_cache_size:
+            self.matches_cache.popitem(last=False)
+        return positions
+
+    def get_page(self, since_id, limit, filters):
+        """
+        Returns tuple: ids of records (max limit) with numeric id greater than since_id matching filters,
+        whether there are more such records.
+        """
+        with self.lock:
+            start = bisect.bisect_right(self.numeric_ids, since_id)
+            page = []
+            if not filters:
+                position = start
+                while position < len(self.numeric_ids) and len(page) <= limit:
+                    if self.updated[position] != DELETED:
+                        page.append(self.records_ids[position])
+                    position += 1
+            else:
+                positions = self.get_matching_positions(filters)
+                first = bisect.bisect_left(positions, start)
+                page = [self.records_ids[position] for position in positions[first:first + limit + 1]]
+        return page[:limit], len(page) > limit
+
+    def get_json_response(self, query):
+        """
+        Returns listing of records for /get_bibs query in the form of data.bn.org.pl bibs.json response
+        (records with 001 only and nextPage), None if query can't be answered locally (see parse_query).
+        """
+        parsed_query = parse_query(query)
+        if parsed_query is None:
+            return None
+        params, limit, since_id, filters = parsed_query
+
+        records_ids, has_more = self.get_page(since_id, limit, filters)
+        next_page = ''
+        if has_more:
+            next_params = [(name, value) for name, value in params if name != 'sinceId']
+            next_params.append(('sinceId', get_numeric_id(records_ids[-1])))
+            next_page = data_bn_client.get_api_url('bibs.json?{}'.format(urlencode(next_params)))
+        return {'bibs': [{'id': get_numeric_id(record_id), 'marc': {'fields': [{'001': record_id}]}}
+                         for record_id in records_ids], 'nextPage': next_page}
+
+    def memory_report(self):
+        with self.lock:
+            return {'records': len(self), 'deleted': self.deleted_count, 'cached_queries': len(self.matches_cache)}
+
+
+def create_bib_listing_index(bib_index):
+    listing_index = BibListingIndex()
+    listing_index.build(bib_index)
+    return listing_index
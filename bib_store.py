@@ -0,0 +1,509 @@
+import os
+import mmap
+import uuid
+import zlib
+import struct
+import logging
+import threading
+from array import array
+from collections import Counter, OrderedDict
+from permissive import PermissiveMARCScanner
+from layered_dict import copy_layered
+from indexer_config import OVERLAY_COMPACTION_RATIO, BIB_STORE_BLOCK_SIZE, BIB_STORE_COMPRESSION_LEVEL
+from indexer_config import BIB_STORE_DICTIONARY_SIZE, BIB_STORE_DICTIONARY_SAMPLES, BIB_STORE_BLOCK_CACHE_BYTES
+
+# bibliographic records store
+
+# record location is packed into one int:
+# bit 63 - segment (0: base file, 1: overlay), bits 17-62 - offset, bits 0-16 - length (ISO 2709 record is max 99999 bytes)
+
+LENGTH_BITS = 17
+LENGTH_MASK = (1 << LENGTH_BITS) - 1
+OVERLAY_FLAG = 1 << 63
+
+BASE_SEGMENT = 0
+OVERLAY_SEGMENT = 1
+
+
+def new_segment_path(source_path, kind):
+    """
+    Returns path of new segment file (kind: 'overlay' or 'compacted') of store built from source_path.
+    Every generation of segments gets its own file, so files referenced by saved snapshots are never rewritten.
+    """
+    return '{}.{}.{}'.format(source_path, kind, uuid.uuid4().hex[:16])
+
+
+def pack_location(segment, offset, length):
+    return (OVERLAY_FLAG if segment == OVERLAY_SEGMENT else 0) | (offset << LENGTH_BITS) | length
+
+
+def unpack_location(location):
+    segment = OVERLAY_SEGMENT if location & OVERLAY_FLAG else BASE_SEGMENT
+    return segment, (location & ~OVERLAY_FLAG) >> LENGTH_BITS, location & LENGTH_MASK
+
+
+class MappedSegment(object):
+    """
+    Read-only memory map of ISO 2709 file, remapped on demand when the file grows.
+    File stays open, so the segment keeps reading the same file even after it is replaced on disk (by compaction).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file_handle = open(path, 'rb')
+        self.map = None
+        self.map_size = 0
+        self.lock = threading.Lock()
+        self.remap()
+
+    def remap(self):
+        with self.lock:
+            size = os.fstat(self.file_handle.fileno()).st_size
+            if size and size != self.map_size:
+                self.map = mmap.mmap(self.file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+                self.map_size = size
+
+    def get_slice(self, offset, length):
+        if offset + length > self.map_size:
+            self.remap()
+        return memoryview(self.map)[offset:offset + length]
+
+
+class MarcRecordStore(object):
+    """
+    Bibliographic records store in form of dictionary-like object.
+    Structure:
+    record id (string): location of record (offset, length) in memory-mapped ISO 2709 file.
+
+    Records are sliced from memory map without copying (as memoryview).
+    Updated records are appended to overlay segment (separate file, created with the first write), deleted records
+    are only removed from the table; both segments are merged into new base file by compact().
+    Segment files are named by generation (see new_segment_path) next to the source file (dump); files replaced
+    by compaction are removed by remove_obsolete_segments, after snapshot of the new version is saved.
+    """
+    base_segment_class = MappedSegment
+
+    def __init__(self, base_path, overlay_path=None):
+        self.source_path = base_path
+        self.base_path = base_path
+        self.overlay_path = overlay_path or new_segment_path(base_path, 'overlay')
+
+        self.locations = {}
+        self.write_lock = threading.Lock()
+        self.obsolete_paths = []
+
+        self.overlay_size = 0
+
+        self.base = self.base_segment_class(self.base_path)
+        self.overlay = None
+
+    def __getstate__(self):
+        return {'source_path': self.source_path, 'base_path': self.base_path, 'base_size': self.base.map_size,
+                'overlay_path': self.overlay_path, 'overlay_size': self.overlay_size, 'locations': self.locations}
+
+    def __setstate__(self, state):
+        self.source_path = state['source_path']
+        self.base_path = state['base_path']
+        self.overlay_path = state['overlay_path']
+        self.locations = state['locations']
+        self.write_lock = threading.Lock()
+        self.obsolete_paths = []
+
+        if not os.path.exists(self.base_path) or os.path.getsize(self.base_path) != state['base_size']:
+            raise OSError('Base segment is missing or changed: {}'.format(self.base_path))
+        if state['overlay_size'] and (not os.path.exists(self.overlay_path) or
+                                      os.path.getsize(self.overlay_path) < state['overlay_size']):
+            raise OSError('Overlay segment is missing or truncated: {}'.format(self.overlay_path))
+
+        # records appended after the snapshot was taken are not referenced, but are left in place
+        # (other versions may read them), new records are appended after them
+        self.overlay_size = state['overlay_size']
+
+        self.base = self.base_segment_class(self.base_path)
+        self.overlay = MappedSegment(self.overlay_path) if self.overlay_size else None
+
+    def __contains__(self, record_id):
+        return record_id in self.locations
+
+    def __getitem__(self, record_id):
+        segment, offset, length = unpack_location(self.locations[record_id])
+        if segment == OVERLAY_SEGMENT:
+            return self.overlay.get_slice(offset, length)
+        return self.base.get_slice(offset, length)
+
+    def __setitem__(self, record_id, marc_record):
+        with self.write_lock:
+            # offset is the real end of overlay file - other versions (e.g. copy updated by failed job)
+            # may have appended records after the last record of this version
+            with open(self.overlay_path, 'ab') as fp:
+                offset = fp.seek(0, os.SEEK_END)
+                fp.write(marc_record)
+            if self.overlay is None:
+                self.overlay = MappedSegment(self.overlay_path)
+            self.locations[record_id] = pack_location(OVERLAY_SEGMENT, offset, len(marc_record))
+            self.overlay_size = offset + len(marc_record)
+
+    def __delitem__(self, record_id):
+        del self.locations[record_id]
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __iter__(self):
+        return iter(self.locations)
+
+    def get(self, record_id, default=None):
+        return self[record_id] if record_id in self.locations else default
+
+    def copy(self):
+        """
+        Returns new version of store: location table keeps only changes over table of this version
+        (see layered_dict), segments (memory maps) are shared.
+        Records written to the copy are appended to the end of overlay file (after all records of this version),
+        so this version can still be read while the copy is being updated, or after the copy is discarded.
+        """
+        with self.write_lock:
+            store_copy = type(self).__new__(type(self))
+            store_copy.source_path = self.source_path
+            store_copy.base_path = self.base_path
+            store_copy.overlay_path = self.overlay_path
+            store_copy.overlay_size = self.overlay_size
+            store_copy.locations = copy_layered(self.locations)
+            store_copy.write_lock = threading.Lock()
+            store_copy.obsolete_paths = []
+            store_copy.base = self.base
+            store_copy.overlay = self.overlay
+            return store_copy
+
+    def get_segments(self):
+        """
+        Returns segment files of this version and size of overlay (saved in snapshot metadata, see apply_changes).
+        """
+        return {'base_path': self.base_path, 'overlay_path': self.overlay_path, 'overlay_size': self.overlay_size}
+
+    def get_segments_on_disk(self):
+        """
+        Returns segment files of this version with size of overlay file (including records appended by other
+        versions and processes).
+        """
+        overlay_size = os.path.getsize(self.overlay_path) if os.path.exists(self.overlay_path) else 0
+        return {'base_path': self.base_path, 'overlay_path': self.overlay_path, 'overlay_size': overlay_size}
+
+    def apply_changes(self, changes, segments=None):
+        """
+        Applies changes (tuples: record id, raw record or None for deleted records) made by other process
+        to its version of store with given segments (see get_segments; segments on disk by default), without
+        writing records again: they were appended to the same overlay, so they are found in it by content (after
+        the last record of this version). Returns False if changes can't be applied this way (segments were
+        compacted by other process or record is missing) - store has to be loaded from snapshot then.
+        """
+        segments = segments if segments is not None else self.get_segments_on_disk()
+        if segments['base_path'] != self.base_path or segments['overlay_path'] != self.overlay_path or \
+                segments['overlay_size'] < self.overlay_size:
+            return False
+
+        # appended records by id: offset, raw record (also records of updates which were not committed)
+        appended_records = {}
+        with open(self.overlay_path, 'rb') as fp:
+            fp.seek(self.overlay_size)
+            appended_data = fp.read(segments['overlay_size'] - self.overlay_size)
+        for rcd in PermissiveMARCScanner(appended_data, ['001'], utf8_handling='ignore'):
+            if '001' in rcd:
+                appended_records.setdefault(rcd.value('001'), []).append((self.overlay_size + rcd.offset, rcd.raw))
+
+        locations = {}
+        for record_id, raw in changes:
+            if raw is None:
+                locations[record_id] = None
+                continue
+            offsets = [offset for offset, appended_raw in appended_records.get(record_id, []) if appended_raw == raw]
+            if not offsets:
+                return False
+            locations[record_id] = pack_location(OVERLAY_SEGMENT, offsets[-1], len(raw))
+
+        with self.write_lock:
+            for record_id, location in locations.items():
+                if location is None:
+                    self.locations.pop(record_id, None)
+                else:
+                    self.locations[record_id] = location
+            self.overlay_size = segments['overlay_size']
+            if self.overlay is None and self.overlay_size:
+                self.overlay = MappedSegment(self.overlay_path)
+        return True
+
+    def add_base_record(self, record_id, offset, length):
+        self.locations[record_id] = pack_location(BASE_SEGMENT, offset, length)
+
+    def needs_compaction(self):
+        return self.overlay_size > os.path.getsize(self.base_path) * OVERLAY_COMPACTION_RATIO
+
+    def compact(self):
+        """
+        Writes all live records (from base and overlay segments) to a new base file and starts a new overlay.
+        Old files are left as they are - older versions of store (and snapshots) still read them;
+        they are removed by remove_obsolete_segments.
+        """
+        with self.write_lock:
+            compacted_path = new_segment_path(self.source_path, 'compacted')
+            new_locations, size = self.write_base_segment(compacted_path)
+
+            self.obsolete_paths.extend(path for path in (self.base_path, self.overlay_path)
+                                       if path != self.source_path)
+            self.base_path = compacted_path
+            self.base = self.base_segment_class(self.base_path)
+            self.overlay_path = new_segment_path(self.source_path, 'overlay')
+            self.overlay = None
+            self.overlay_size = 0
+            self.locations = new_locations
+
+        logging.info('Skompaktowano indeks rekordów bibliograficznych: {} ({} B)'.format(compacted_path, size))
+
+    def remove_obsolete_segments(self):
+        """
+        Removes segment files replaced by compaction of this version - to be called after its snapshot is saved
+        (readers of older versions keep reading them, as their files stay open).
+        """
+        for path in self.obsolete_paths:
+            if os.path.exists(path):
+                os.remove(path)
+                logging.info('Usunięto nieużywany segment rekordów bibliograficznych: {}'.format(path))
+        self.obsolete_paths = []
+
+    def remove_unused_segments(self):
+        """
+        Removes segment files of the same source not used by this version of store (e.g. written by compaction
+        interrupted before snapshot of the new version was saved). Called at startup, with store loaded
+        from the latest snapshot.
+        """
+        directory = os.path.dirname(self.source_path) or '.'
+        used_paths = {os.path.abspath(self.base_path), os.path.abspath(self.overlay_path)}
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            for kind in ('overlay', 'compacted'):
+                if name.startswith('{}.{}.'.format(os.path.basename(self.source_path), kind)) and \
+                        os.path.abspath(path) not in used_paths:
+                    os.remove(path)
+                    logging.info('Usunięto nieużywany segment rekordów bibliograficznych: {}'.format(path))
+
+    def get_overlay_map_size(self):
+        return self.overlay.map_size if self.overlay is not None else 0
+
+    def write_base_segment(self, path):
+        """
+        Writes all live records to new base segment file. Returns tuple: new locations, size of file.
+        """
+        tmp_path = path + '.tmp'
+        new_locations = {}
+        offset = 0
+        with open(tmp_path, 'wb') as fp:
+            for record_id in self.locations:
+                record = self[record_id]
+                fp.write(record)
+                new_locations[record_id] = pack_location(BASE_SEGMENT, offset, len(record))
+                offset += len(record)
+        os.replace(tmp_path, path)
+        return new_locations, offset
+
+
+# compressed bibliographic records store (optional, see BIB_STORE_COMPRESSION in indexer_config)
+
+# base segment is a file of zlib-compressed blocks of consecutive records (records of one /get_bibs page are usually
+# in a few neighbouring blocks, so only these blocks are decompressed); blocks are compressed with preset dictionary
+# trained on sample of records (see train_dictionary), which makes even small blocks compress well;
+# recently used blocks are kept decompressed in LRU cache; overlay segment (updated records) is not compressed
+
+# file layout:
+# header (see COMPRESSED_HEADER) + dictionary + compressed blocks + block table (uint64 offsets of blocks
+# and of the end of the last block)
+# header: magic, format version, dictionary length, blocks count, block table offset, size of records (uncompressed)
+# offset of record in its location (see pack_location): block number << BLOCK_OFFSET_BITS | offset in decompressed
+# block (blocks are max 128 KB, see BIB_STORE_BLOCK_SIZE)
+
+COMPRESSED_MAGIC = b'MARCZBL\x00'
+COMPRESSED_FORMAT_VERSION = 1
+COMPRESSED_HEADER = struct.Struct('<8sIIQQQ')
+
+BLOCK_OFFSET_BITS = 17
+BLOCK_OFFSET_MASK = (1 << BLOCK_OFFSET_BITS) - 1
+
+FIELD_TERMINATOR = b'\x1e'
+SUBFIELD_DELIMITER = b'\x1f'
+
+
+def train_dictionary(records, size):
+    """
+    Returns zlib preset dictionary (max size bytes) built from sample records (ISO 2709): fields and subfields
+    repeated in sample, the ones saving most bytes at the end of dictionary (closest to compressed data).
+    """
+    counts = Counter()
+    for raw in records:
+        raw = bytes(raw)
+        base_address = int(raw[12:17]) if raw[12:17].isdigit() else 0
+        for field in raw[base_address:].split(FIELD_TERMINATOR):
+            counts[field + FIELD_TERMINATOR] += 1
+            for subfield in field.split(SUBFIELD_DELIMITER)[1:]:
+                counts[SUBFIELD_DELIMITER + subfield] += 1
+
+    chosen = []
+    chosen_size = 0
+    for fragment, count in sorted(counts.items(), key=lambda item: (item[1] - 1) * len(item[0]), reverse=True):
+        if count < 2 or len(fragment) < 3:
+            continue
+        if chosen_size + len(fragment) > size:
+            continue
+        chosen.append(fragment)
+        chosen_size += len(fragment)
+    return b''.join(reversed(chosen))
+
+
+def write_compressed_segment(path, records, dictionary, block_size=BIB_STORE_BLOCK_SIZE,
+                             level=BIB_STORE_COMPRESSION_LEVEL):
+    """
+    Writes records (iterable of tuples: record id, raw record) to compressed segment file.
+    Returns list of tuples: record id, offset (see BLOCK_OFFSET_BITS), length.
+    """
+    entries = []
+    block_offsets = array('Q')
+    block = bytearray()
+    data_size = 0
+
+    def write_block(fp):
+        compressor = zlib.compressobj(level, zdict=dictionary) if dictionary else zlib.compressobj(level)
+        block_offsets.append(fp.tell())
+        fp.write(compressor.compress(block) + compressor.flush())
+        block.clear()
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        fp.write(bytes(COMPRESSED_HEADER.size))
+        fp.write(dictionary)
+        for record_id, raw in records:
+            if block and len(block) + len(raw) > block_size:
+                write_block(fp)
+            entries.append((record_id, len(block_offsets) << BLOCK_OFFSET_BITS | len(block), len(raw)))
+            block += raw
+            data_size += len(raw)
+        if block:
+            write_block(fp)
+
+        table_offset = fp.tell()
+        block_offsets.append(table_offset)
+        fp.write(block_offsets.tobytes())
+        fp.seek(0)
+        fp.write(COMPRESSED_HEADER.pack(COMPRESSED_MAGIC, COMPRESSED_FORMAT_VERSION, len(dictionary),
+                                        len(block_offsets) - 1, table_offset, data_size))
+    os.replace(tmp_path, path)
+    return entries
+
+
+def write_compressed_records(store, path):
+    """
+    Writes all live records of store (in order of their locations, i.e. order of dump) to compressed segment file,
+    with dictionary trained on evenly spaced sample of them. Returns entries (see write_compressed_segment).
+    """
+    records_ids = sorted(store.locations, key=store.locations.get)
+    step = max(1, len(records_ids) // BIB_STORE_DICTIONARY_SAMPLES)
+    dictionary = train_dictionary((store[record_id] for record_id in records_ids[::step]), BIB_STORE_DICTIONARY_SIZE)
+    return write_compressed_segment(path, ((record_id, store[record_id]) for record_id in records_ids), dictionary)
+
+
+class CompressedSegment(object):
+    """
+    Read-only memory map of compressed segment file (see write_compressed_segment) with LRU cache
+    of decompressed blocks, shared by all versions of store reading this file.
+    """
+    def __init__(self, path, cache_max_bytes=BIB_STORE_BLOCK_CACHE_BYTES):
+        self.path = path
+        self.segment = MappedSegment(path)
+
+        header = bytes(self.segment.get_slice(0, COMPRESSED_HEADER.size))
+        magic, version, dictionary_length, blocks_count, table_offset, self.data_size = \
+            COMPRESSED_HEADER.unpack(header)
+        if magic != COMPRESSED_MAGIC or version != COMPRESSED_FORMAT_VERSION:
+            raise OSError('Not a compressed records segment: {}'.format(path))
+        self.dictionary = bytes(self.segment.get_slice(COMPRESSED_HEADER.size, dictionary_length))
+        self.block_offsets = array('Q')
+        self.block_offsets.frombytes(self.segment.get_slice(table_offset, (blocks_count + 1) * 8))
+
+        self.cache = OrderedDict()
+        self.cache_size = 0
+        self.cache_max_bytes = cache_max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def map_size(self):
+        return self.segment.map_size
+
+    def get_block(self, block_number):
+        with self.lock:
+            block = self.cache.get(block_number)
+            if block is not None:
+                self.cache.move_to_end(block_number)
+                self.hits += 1
+                return block
+            self.misses += 1
+
+        start, end = self.block_offsets[block_number], self.block_offsets[block_number + 1]
+        decompressor = zlib.decompressobj(zdict=self.dictionary) if self.dictionary else zlib.decompressobj()
+        block = decompressor.decompress(self.segment.get_slice(start, end - start))
+
+        with self.lock:
+            if block_number not in self.cache:
+                self.cache[block_number] = block
+                self.cache_size += len(block)
+                while self.cache_size > self.cache_max_bytes and len(self.cache) > 1:
+                    self.cache_size -= len(self.cache.popitem(last=False)[1])
+                    self.evictions += 1
+        return block
+
+    def get_slice(self, offset, length):
+        block = self.get_block(offset >> BLOCK_OFFSET_BITS)
+        offset &= BLOCK_OFFSET_MASK
+        return memoryview(block)[offset:offset + length]
+
+    def clear_cache(self):
+        with self.lock:
+            self.cache.clear()
+            self.cache_size = 0
+
+    def get_stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'blocks': len(self.block_offsets) - 1, 'cached_blocks': len(self.cache),
+                    'size_in_bytes': self.cache_size, 'max_bytes': self.cache_max_bytes,
+                    'compressed_bytes': self.segment.map_size, 'records_bytes': self.data_size,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': round(self.hits / requests, 4) if requests else 0.0}
+
+
+class CompressedMarcRecordStore(MarcRecordStore):
+    """
+    Bibliographic records store with base segment compressed in blocks (see CompressedSegment) - the same interface
+    as MarcRecordStore. Records are sliced from decompressed blocks; compaction writes new compressed segment.
+    """
+    base_segment_class = CompressedSegment
+
+    @classmethod
+    def from_store(cls, store, path):
+        """
+        Returns compressed store with all records of given store, written to compressed segment file path.
+        """
+        entries = write_compressed_records(store, path)
+        compressed_store = cls(path)
+        for record_id, offset, length in entries:
+            compressed_store.add_base_record(record_id, offset, length)
+
+        logging.info('Skompresowano rekordy bibliograficzne: {} ({} B -> {} B)'.format(
+            path, compressed_store.base.data_size, compressed_store.base.map_size))
+        return compressed_store
+
+    def needs_compaction(self):
+        return self.overlay_size > self.base.data_size * OVERLAY_COMPACTION_RATIO
+
+    def write_base_segment(self, path):
+        new_locations = {record_id: pack_location(BASE_SEGMENT, offset, length)
+                         for record_id, offset, length in write_compressed_records(self, path)}
+        return new_locations, os.path.getsize(path)
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from multiprocessing import Pool
+from tqdm import tqdm
+from permissive import PermissiveMARCReader
+from api_core import process_records
+from marc_serializers import record_to_marcxml, record_to_jsonl, COLLECTION_START_TAG, COLLECTION_END_TAG
+from index_snapshot import load_or_create_index, get_source_fingerprint
+from parallel_indexer import split_marc_dump, read_range, get_processes_count
+from parallel_indexer import create_authority_index_parallel
+from indexer_config import INDEX_BUILD_RANGES_PER_PROCESS
+
+# offline bulk enrichment of the whole bibliographic dump (without HTTP API)
+
+# authority index is loaded once (from snapshot, if available) and shared read-only with worker processes
+# (inherited on fork, copied once per worker otherwise); dump is split into byte ranges aligned to record boundaries,
+# ranges are enriched in parallel and written in dump order
+# after each written range checkpoint (input offset, output size, counters) is saved, so interrupted run
+# can be resumed with --resume
+
+# max size of one dump range (whole range and its output are kept in memory of worker)
+MAX_RANGE_BYTES = 64 * 1024 * 1024
+BATCH_SIZE = 1000
+
+RECORD_SERIALIZERS = {'marc': lambda rcd: rcd.as_marc(),
+                      'xml': lambda rcd: record_to_marcxml(rcd).encode('utf-8'),
+                      'jsonl': lambda rcd: record_to_jsonl(rcd).encode('utf-8')}
+
+# authority index of worker process (set by init_worker)
+worker_auth_index = None
+
+
+def init_worker(auth_index):
+    global worker_auth_index
+    worker_auth_index = auth_index
+
+
+def enrich_range(task):
+    """
+    Worker: enriches bibliographic records from given byte range of dump.
+    Returns tuple: start offset, end offset, output (bytes), counters (records read, failed, fields linked).
+    """
+    data, start, end, output_format = task
+    serialize = RECORD_SERIALIZERS[output_format]
+
+    rdr = PermissiveMARCReader(read_range(data, start, end), to_unicode=True, force_utf8=True, utf8_handling='ignore')
+    stats = {'read': 0, 'failed': 0, 'linked': 0}
+    output = []
+
+    batch = []
+    for rcd in rdr:
+        batch.append(rcd)
+        if len(batch) == BATCH_SIZE:
+            output.extend(serialize(rcd) for rcd in process_records(batch, worker_auth_index, stats))
+            batch = []
+    output.extend(serialize(rcd) for rcd in process_records(batch, worker_auth_index, stats))
+
+    stats['read'] = rdr.count
+    stats['failed'] = rdr.failed
+    return start, end, b''.join(output), stats
+
+
+class Checkpoint(object):
+    """
+    Progress of enrichment (saved atomically next to the output file):
+    input offset (all records before it are written), output size, counters.
+    """
+    def __init__(self, path, data, output_format):
+        self.path = path
+        self.data = data
+        self.output_format = output_format
+        self.input_offset = 0
+        self.output_size = 0
+        self.stats = {'read': 0, 'failed': 0, 'linked': 0}
+        self.done = False
+
+    def load(self):
+        """
+        Loads checkpoint; returns False if it is missing or belongs to other input or output format.
+        """
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, 'r', encoding='utf-8') as fp:
+            state = json.load(fp)
+
+        # fingerprint is saved in JSON as list
+        if state['input_fingerprint'] != list(get_source_fingerprint(self.data)) or \
+                state['format'] != self.output_format:
+            logging.warning('Punkt kontrolny {} dotyczy innego pliku wejściowego lub formatu'.format(self.path))
+            return False
+
+        self.input_offset = state['input_offset']
+        self.output_size = state['output_size']
+        self.stats = state['stats']
+        self.done = state['done']
+        return True
+
+    def save(self):
+        state = {'input': self.data, 'input_fingerprint': list(get_source_fingerprint(self.data)),
+                 'format': self.output_format, 'input_offset': self.input_offset, 'output_size': self.output_size,
+                 'stats': self.stats, 'done': self.done}
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            json.dump(state, fp)
+        os.replace(tmp_path, self.path)
+
+
+def enrich_dump(data, output, output_format, auth_marc, processes=None, resume=False):
+    """
+    Enriches all bibliographic records from dump and writes them to output file in given format.
+    Returns counters (records read, failed, fields linked).
+    """
+    checkpoint = Checkpoint(output + '.checkpoint', data, output_format)
+    if resume and checkpoint.load() and os.path.exists(output) and os.path.getsize(output) >= checkpoint.output_size:
+        if checkpoint.done:
+            logging.info('Plik {} jest już kompletny'.format(output))
+            return checkpoint.stats
+        logging.info('Wznawiam od bajtu {} pliku wejściowego'.format(checkpoint.input_offset))
+    else:
+        checkpoint = Checkpoint(output + '.checkpoint', data, output_format)
+
+    auth_index, auth_meta = load_or_create_index(create_authority_index_parallel, auth_marc)
+
+    processes = get_processes_count(processes)
+    file_size = os.path.getsize(data)
+    ranges_count = max(processes * INDEX_BUILD_RANGES_PER_PROCESS,
+                       (file_size - checkpoint.input_offset) // MAX_RANGE_BYTES + 1)
+    ranges = split_marc_dump(data, ranges_count, checkpoint.input_offset) if checkpoint.input_offset < file_size else []
+    tasks = [(data, start, end, output_format) for start, end in ranges]
+
+    start_time = time.perf_counter()
+    read_before = checkpoint.stats['read']
+
+    with open(output, 'ab') as fp:
+        # drop output written after the last checkpoint
+        fp.truncate(checkpoint.output_size)
+        if output_format == 'xml' and checkpoint.output_size == 0:
+            fp.write(COLLECTION_START_TAG.encode('utf-8'))
+
+        with Pool(processes, initializer=init_worker, initargs=(auth_index,)) as pool, \
+                tqdm(total=file_size, initial=checkpoint.input_offset, unit='B', unit_scale=True) as progress:
+            for start, end, range_output, stats in pool.imap(enrich_range, tasks):
+                fp.write(range_output)
+                fp.flush()
+                os.fsync(fp.fileno())
+
+                checkpoint.input_offset = end
+                checkpoint.output_size = fp.tell()
+                for key in stats:
+                    checkpoint.stats[key] += stats[key]
+                checkpoint.save()
+                progress.update(end - start)
+
+        if output_format == 'xml':
+            fp.write(COLLECTION_END_TAG.encode('utf-8'))
+        checkpoint.output_size = fp.tell()
+
+    checkpoint.done = True
+    checkpoint.save()
+
+    elapsed = time.perf_counter() - start_time
+    records_count = checkpoint.stats['read'] - read_before
+    logging.info('Wzbogacono rekordów: {read} (błędnych: {failed}), powiązano pól: {linked}'.format(**checkpoint.stats))
+    logging.info('Czas: {:.1f} s, {:.0f} rekordów/s, {:.1f} MB/s ({} procesów)'.format(
+        elapsed, records_count / elapsed if elapsed else 0,
+        (file_size - ranges[0][0]) / elapsed / 1024 / 1024 if ranges and elapsed else 0, processes))
+    return checkpoint.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Wzbogaca wszystkie rekordy bibliograficzne z pliku ISO 2709 '
+                                                 'o identyfikatory rekordów wzorcowych (podpole 0).')
+    parser.add_argument('input', help='plik ISO 2709 z rekordami bibliograficznymi, np. bibs-all.marc')
+    parser.add_argument('output', help='plik wynikowy')
+    parser.add_argument('--format', choices=sorted(RECORD_SERIALIZERS), default='marc', help='format pliku wynikowego')
+    parser.add_argument('--authorities', default='authorities-all.marc', help='plik ISO 2709 z rekordami wzorcowymi')
+    parser.add_argument('--processes', type=int, default=None, help='liczba procesów (domyślnie: wszystkie rdzenie)')
+    parser.add_argument('--resume', action='store_true', help='wznów przerwane wzbogacanie od punktu kontrolnego')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s',
+        datefmt="%H:%M:%S",
+        stream=sys.stdout)
+
+    enrich_dump(args.input, args.output, args.format, args.authorities, args.processes, args.resume)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+import os
+import json
+import uuid
+import zlib
+import struct
+import logging
+import threading
+from datetime import datetime
+from indexer_config import SNAPSHOT_DIR, JOURNAL_COMPACTION_MIN_BYTES, JOURNAL_COMPACTION_RATIO
+from index_snapshot import get_source_fingerprint
+
+# persistent journal of index changes (deleted and updated records with their raw MARC) made by updater
+
+# file layout:
+# header (fixed size, see JOURNAL_HEADER) + entries
+# header: magic, format version, source dump size, source dump mtime (ns), journal id (random, changes when
+#         journal is started from scratch, so snapshot can tell which journal its position refers to)
+# entry: JOURNAL_ENTRY header (operation, record id length, payload length, crc32 of record id and payload)
+#        + record id (utf-8) + payload (raw ISO 2709 record for upsert, JSON with sequence and last update for commit)
+#
+# changes of one updater run are followed by commit entry; entries after the last commit (interrupted run)
+# are ignored and cut off when journal is opened
+#
+# watermark moved by updater runs without changes (see ChangeJournal.advance_watermark) is kept in small JSON file
+# next to journal (.watermark), valid only for journal id and sequence written in it
+
+JOURNAL_MAGIC = b'MARCJRN\x00'
+JOURNAL_FORMAT_VERSION = 1
+JOURNAL_HEADER = struct.Struct('<8sIQQ16s')
+JOURNAL_ENTRY = struct.Struct('<BHII')
+
+DELETE = 1
+UPSERT = 2
+COMMIT = 3
+
+
+def journal_path_for(data):
+    """
+    Returns journal file path for given MARC dump.
+    """
+    return os.path.join(SNAPSHOT_DIR, os.path.basename(data) + '.journal')
+
+
+def pack_entry(operation, record_id, payload):
+    record_id = record_id.encode('utf-8')
+    checksum = zlib.crc32(payload, zlib.crc32(record_id))
+    return JOURNAL_ENTRY.pack(operation, len(record_id), len(payload), checksum) + record_id + payload
+
+
+def iter_entries(fp, file_size):
+    """
+    Yields tuples: offset of entry, operation, record id, payload offset, payload length, payload (None for upserts).
+    Stops at the first truncated or corrupted entry.
+    """
+    offset = JOURNAL_HEADER.size
+    fp.seek(offset)
+
+    while offset + JOURNAL_ENTRY.size <= file_size:
+        operation, record_id_length, payload_length, checksum = JOURNAL_ENTRY.unpack(fp.read(JOURNAL_ENTRY.size))
+        entry_end = offset + JOURNAL_ENTRY.size + record_id_length + payload_length
+        if operation not in (DELETE, UPSERT, COMMIT) or entry_end > file_size:
+            return
+
+        record_id = fp.read(record_id_length)
+        payload = fp.read(payload_length)
+        if zlib.crc32(payload, zlib.crc32(record_id)) != checksum:
+            return
+
+        yield (offset, operation, record_id.decode('utf-8'), entry_end - payload_length, payload_length,
+               payload if operation == COMMIT else None)
+        offset = entry_end
+
+
+class ChangeJournal(object):
+    """
+    Append-only journal of changes of index built from given MARC dump.
+    Changes are written in transactions (one per updater run, see begin), so journal always contains complete runs.
+    Replaying journal on top of index built from the dump (or loaded from snapshot) restores all updates
+    without downloading them again; last commit keeps the date of the newest update (watermark).
+    Journal is dropped when the dump changes.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.path = journal_path_for(data)
+        self.watermark_path = self.path + '.watermark'
+        self.lock = threading.Lock()
+
+        self.journal_id = None
+        self.sequence = 0
+        self.last_update = None
+        self.size = 0
+        self.entries_count = 0
+        self.records_ids = set()
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if not self.open_existing():
+            self.start_new()
+
+    def open_existing(self):
+        """
+        Reads state of existing journal and cuts off entries after the last commit.
+        Returns False if journal is missing, has other format or belongs to other version of the dump.
+        """
+        file_size = self.read_state()
+        if file_size is None:
+            return False
+
+        if self.size < file_size:
+            logging.warning('Pominięto niezatwierdzone zmiany w dzienniku: {} ({} B)'.format(
+                self.path, file_size - self.size))
+            with open(self.path, 'r+b') as fp:
+                fp.truncate(self.size)
+
+        logging.info('Wczytano dziennik zmian: {} (zatwierdzonych zmian: {})'.format(self.path, self.entries_count))
+        return True
+
+    def refresh(self):
+        """
+        Reads state of journal written by other process (see prefork_server) - entries after the last commit
+        are left as they are (they can belong to transaction in progress).
+        Returns False if journal can't be read.
+        """
+        with self.lock:
+            return self.read_state() is not None
+
+    def read_state(self):
+        """
+        Reads journal id, sequence, watermark, size and changed records of committed transactions.
+        Returns size of journal file, None if journal is missing, has other format or belongs to other version
+        of the dump (state is not changed then).
+        """
+        if not os.path.exists(self.path):
+            logging.info('Brak dziennika zmian: {}'.format(self.path))
+            return None
+
+        file_size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as fp:
+            header = fp.read(JOURNAL_HEADER.size)
+            if len(header) != JOURNAL_HEADER.size:
+                logging.warning('Uszkodzony dziennik zmian: {}'.format(self.path))
+                return None
+
+            magic, version, source_size, source_mtime, journal_id = JOURNAL_HEADER.unpack(header)
+            if magic != JOURNAL_MAGIC or version != JOURNAL_FORMAT_VERSION:
+                logging.info('Nieaktualna wersja dziennika zmian: {}'.format(self.path))
+                return None
+            if os.path.exists(self.data) and get_source_fingerprint(self.data) != (source_size, source_mtime):
+                logging.info('Dziennik zmian starszy niż plik źródłowy: {}'.format(self.path))
+                return None
+
+            sequence = 0
+            last_update = None
+            committed_size = JOURNAL_HEADER.size
+            entries_count = 0
+            records_ids = set()
+            batch_records_ids = []
+
+            for offset, operation, record_id, payload_offset, payload_length, payload in iter_entries(fp, file_size):
+                if operation == COMMIT:
+                    commit = json.loads(payload.decode('utf-8'))
+                    sequence = commit['sequence']
+                    last_update = datetime.fromisoformat(commit['last_update'])
+                    committed_size = payload_offset + payload_length
+                    entries_count += len(batch_records_ids)
+                    records_ids.update(batch_records_ids)
+                    batch_records_ids = []
+                else:
+                    batch_records_ids.append(record_id)
+
+        watermark = self.read_watermark(journal_id, sequence)
+        if watermark is not None and (last_update is None or watermark > last_update):
+            last_update = watermark
+
+        self.journal_id = journal_id
+        self.sequence = sequence
+        self.last_update = last_update
+        self.size = committed_size
+        self.entries_count = entries_count
+        self.records_ids = records_ids
+        return file_size
+
+    def read_watermark(self, journal_id, sequence):
+        """
+        Returns watermark stored by advance_watermark, None if it is missing or was stored for other journal id
+        or sequence.
+        """
+        try:
+            with open(self.watermark_path, 'r', encoding='utf-8') as fp:
+                watermark = json.load(fp)
+            if watermark['journal_id'] != journal_id.hex() or watermark['sequence'] != sequence:
+                return None
+            return datetime.fromisoformat(watermark['last_update'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def advance_watermark(self, last_update):
+        """
+        Stores newer watermark without changes (updater run which found no changed records).
+        """
+        with self.lock:
+            tmp_path = self.watermark_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as fp:
+                json.dump({'journal_id': self.journal_id.hex(), 'sequence': self.sequence,
+                           'last_update': last_update.isoformat(timespec='microseconds')}, fp)
+            os.replace(tmp_path, self.watermark_path)
+            self.last_update = last_update
+
+    def start_new(self):
+        self.journal_id = uuid.uuid4().bytes
+        self.sequence = 0
+        self.last_update = None
+        self.entries_count = 0
+        self.records_ids = set()
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(self.get_header())
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.path)
+        self.size = JOURNAL_HEADER.size
+
+    def get_header(self):
+        source_size, source_mtime = get_source_fingerprint(self.data)
+        return JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_FORMAT_VERSION, source_size, source_mtime, self.journal_id)
+
+    def get_position(self):
+        """
+        Returns position of journal (to be stored in snapshot metadata, see iter_changes).
+        """
+        return {'journal_id': self.journal_id.hex(), 'journal_sequence': self.sequence}
+
+    def begin(self):
+        """
+        Returns new transaction; changes written to it are visible in journal after commit.
+        """
+        return JournalTransaction(self)
+
+    def iter_changes(self, position=None):
+        """
+        Yields tuples: operation (DELETE or UPSERT), record id, raw record (bytes, None for deletes) -
+        from transactions committed after given position (see get_position; None - all transactions).
+        """
+        position = position or {}
+        since_sequence = position.get('journal_sequence', 0) if position.get('journal_id') == self.journal_id.hex() else 0
+
+        with self.lock, open(self.path, 'rb') as fp:
+            batch = []
+            for offset, operation, record_id, payload_offset, payload_length, payload in iter_entries(fp, self.size):
+                if operation == COMMIT:
+                    if json.loads(payload.decode('utf-8'))['sequence'] > since_sequence:
+                        yield from self.read_batch(fp, batch)
+                    batch = []
+                else:
+                    batch.append((operation, record_id, payload_offset, payload_length))
+
+    @staticmethod
+    def read_batch(fp, batch):
+        position = fp.tell()
+        for operation, record_id, payload_offset, payload_length in batch:
+            raw = None
+            if operation == UPSERT:
+                fp.seek(payload_offset)
+                raw = fp.read(payload_length)
+            yield operation, record_id, raw
+        fp.seek(position)
+
+    def needs_compaction(self):
+        return self.size > JOURNAL_COMPACTION_MIN_BYTES and \
+            self.entries_count > len(self.records_ids) * JOURNAL_COMPACTION_RATIO
+
+    def compact(self):
+        """
+        Rewrites journal keeping only the last change of each record in one transaction (with the last sequence
+        and watermark). Replaying compacted journal gives the same index - also on top of snapshots
+        taken before compaction, as changes of records are idempotent. Kept changes stay in order of the journal
+        (order of records with the same heading in authority index depends on it, see get_first_id).
+        """
+        with self.lock:
+            last_changes = {}
+            with open(self.path, 'rb') as fp:
+                for offset, operation, record_id, payload_offset, payload_length, payload in iter_entries(fp, self.size):
+                    if operation != COMMIT:
+                        # moved to the end - position of the last change of record
+                        last_changes.pop(record_id, None)
+                        last_changes[record_id] = (operation, payload_offset, payload_length)
+
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'wb') as tmp_fp:
+                    tmp_fp.write(self.get_header())
+                    for record_id, (operation, payload_offset, payload_length) in last_changes.items():
+                        fp.seek(payload_offset)
+                        tmp_fp.write(pack_entry(operation, record_id, fp.read(payload_length)))
+                    tmp_fp.write(pack_entry(COMMIT, '', self.get_commit_payload(self.sequence, self.last_update)))
+                    tmp_fp.flush()
+                    os.fsync(tmp_fp.fileno())
+                    size = tmp_fp.tell()
+
+            os.replace(tmp_path, self.path)
+            old_size = self.size
+            self.size = size
+            self.entries_count = len(last_changes)
+
+        logging.info('Skompaktowano dziennik zmian: {} ({} B -> {} B)'.format(self.path, old_size, size))
+
+    @staticmethod
+    def get_commit_payload(sequence, last_update):
+        return json.dumps({'sequence': sequence,
+                           'last_update': last_update.isoformat(timespec='microseconds')}).encode('utf-8')
+
+
+class JournalTransaction(object):
+    """
+    Changes of one updater run. Entries are appended to journal file as they come (no buffering of records in memory),
+    but they are ignored until commit writes the commit entry (with watermark) and syncs file to disk.
+    """
+    def __init__(self, journal):
+        self.journal = journal
+        self.records_ids = []
+        self.fp = None
+
+    def write(self, operation, record_id, payload):
+        if self.fp is None:
+            self.journal.lock.acquire()
+            self.fp = open(self.journal.path, 'r+b')
+            self.fp.seek(self.journal.size)
+        self.fp.write(pack_entry(operation, record_id, bytes(payload)))
+        self.records_ids.append(record_id)
+
+    def delete(self, record_id):
+        self.write(DELETE, record_id, b'')
+
+    def upsert(self, record_id, raw):
+        self.write(UPSERT, record_id, raw)
+
+    def commit(self, last_update):
+        """
+        Commits changes with the date of the newest update (watermark).
+        """
+        journal = self.journal
+        self.write(COMMIT, '', journal.get_commit_payload(journal.sequence + 1, last_update))
+        self.records_ids.pop()
+
+        try:
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+            journal.size = self.fp.tell()
+            journal.sequence += 1
+            journal.last_update = last_update
+            journal.entries_count += len(self.records_ids)
+            journal.records_ids.update(self.records_ids)
+        finally:
+            self.close()
+
+        logging.info('Zapisano w dzienniku zmian: {} (zmian: {})'.format(journal.path, len(self.records_ids)))
+
+    def abort(self):
+        """
+        Drops changes written so far.
+        """
+        if self.fp is not None:
+            try:
+                self.fp.truncate(self.journal.size)
+            finally:
+                self.close()
+
+    def close(self):
+        self.fp.close()
+        self.fp = None
+        self.journal.lock.release()
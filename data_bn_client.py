@@ -0,0 +1,103 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from base_url_config import DATA_BN_URL
+from single_flight import SingleFlight
+
+# shared HTTP client for data.bn.org.pl API
+
+
+class DataBnClient(object):
+    """
+    HTTP client for data.bn.org.pl API: one session with pooled connections (reused by all threads),
+    retries with exponential backoff (connection errors, 429 and 5xx responses)
+    and bounded concurrent fetching of MARC records. Concurrent fetches of the same records are made once
+    (see SingleFlight).
+    """
+    def __init__(self, base_url=DATA_BN_URL, pool_size=10, max_retries=5, backoff_factor=0.5, timeout=60,
+                 max_concurrent_fetches=4):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_concurrent_fetches = max_concurrent_fetches
+
+        retry = Retry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET']), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent_fetches, thread_name_prefix='data_bn_client')
+        self.requests_count = 0
+        self.requests_count_lock = threading.Lock()
+        # callers wait for identical fetch at most as long as it can take with all retries
+        self.marc_fetches = SingleFlight('data.bn MARC', timeout * (max_retries + 1))
+
+    def get_api_url(self, path):
+        """
+        Returns url of API resource, e.g. get_api_url('bibs.json?limit=100').
+        """
+        return '{}/api/{}'.format(self.base_url, path)
+
+    def get(self, url):
+        with self.requests_count_lock:
+            self.requests_count += 1
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def get_json(self, url):
+        return self.get(url).json()
+
+    def iter_json_pages(self, url):
+        """
+        Yields JSON pages of API listing, following nextPage.
+        """
+        while url:
+            json_chunk = self.get_json(url)
+            yield json_chunk
+            url = json_chunk['nextPage'] if json_chunk['nextPage'] else None
+
+    def get_marc(self, records_type, records_ids):
+        """
+        Returns ISO 2709 data of given records (records_type: 'bibs' or 'authorities'; max 100 ids).
+        """
+        records_ids = tuple(records_ids)
+        return bytearray(self.marc_fetches.do((records_type, records_ids), self.fetch_marc, records_type, records_ids))
+
+    def fetch_marc(self, records_type, records_ids):
+        ids_for_query = '%2C'.join(record_id for record_id in records_ids)
+        url = self.get_api_url('{}.marc?id={}&limit=100'.format(records_type, ids_for_query))
+        return self.get(url).content
+
+    def iter_marc_chunks(self, records_type, records_ids, chunk_size=100):
+        """
+        Yields tuples: chunk of records ids, ISO 2709 data of records in chunk - in order of records_ids.
+        records_ids may be any iterable (e.g. generator paging through API listing); chunks are fetched concurrently
+        (at most max_concurrent_fetches at once), so consumer processes one chunk while next ones are downloaded.
+        """
+        pending = deque()
+        chunk = []
+
+        for record_id in records_ids:
+            chunk.append(record_id)
+            if len(chunk) == chunk_size:
+                pending.append((chunk, self.executor.submit(self.get_marc, records_type, chunk)))
+                chunk = []
+                if len(pending) >= self.max_concurrent_fetches:
+                    chunk_ids, future = pending.popleft()
+                    yield chunk_ids, future.result()
+
+        if chunk:
+            pending.append((chunk, self.executor.submit(self.get_marc, records_type, chunk)))
+
+        while pending:
+            chunk_ids, future = pending.popleft()
+            yield chunk_ids, future.result()
+
+
+data_bn_client = DataBnClient()
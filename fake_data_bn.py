@@ -0,0 +1,191 @@
+import sys
+import json
+import time
+import bisect
+import random
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from permissive import PermissiveMARCScanner
+from synthetic_marc import create_updated_record
+
+# local stand-in for data.bn.org.pl API (for benchmarks, see benchmark.py), serving records from MARC dumps
+
+# supported requests (records_type: bibs or authorities):
+# /api/{records_type}.json?limit=&sinceId= - listing of records (ordered by numeric id) with nextPage
+# /api/{records_type}.json?updatedDate=...&limit=&sinceId= - listing of updated records (updatedDate is ignored:
+#     all updates prepared at start are listed), with &deleted=true - listing of deleted records
+# /api/{records_type}.marc?id=...,... - ISO 2709 records (updated version of updated records)
+# listings contain only 001 of records (the only field read by the API); latency of every response can be set,
+# error responses can be queued (see fail_next) and accepted connections are counted (tests of DataBnClient)
+
+
+def get_numeric_id(record_id):
+    return int(record_id[1:-1])
+
+
+class FakeRecords(object):
+    """
+    Records of one type read from ISO 2709 dump, with updated and deleted records chosen at random
+    (updated_count, deleted_count).
+    """
+    def __init__(self, data, updated_count=0, deleted_count=0, seed=0):
+        self.records = {}
+        with open(data, 'rb') as fp:
+            for rcd in PermissiveMARCScanner(fp, ['001'], utf8_handling='ignore'):
+                if '001' in rcd:
+                    self.records[rcd.value('001')] = bytes(rcd.raw)
+
+        self.ids = sorted(self.records, key=get_numeric_id)
+        self.numeric_ids = [get_numeric_id(record_id) for record_id in self.ids]
+
+        rng = random.Random(seed)
+        changed_ids = rng.sample(self.ids, min(len(self.ids), updated_count + deleted_count))
+        self.deleted_ids = sorted(changed_ids[:deleted_count], key=get_numeric_id)
+        self.updated_records = {}
+        for record_id in sorted(changed_ids[deleted_count:], key=get_numeric_id):
+            updated_record = create_updated_record(self.records[record_id], rng)
+            if updated_record is not None:
+                self.updated_records[record_id] = updated_record
+        self.updated_ids = list(self.updated_records)
+
+    def get_page(self, ids, since_id, limit):
+        """
+        Returns tuple: ids of records after since_id (max limit), numeric id of the last record on page
+        (None if there are no more records).
+        """
+        numeric_ids = [get_numeric_id(record_id) for record_id in ids] if ids is not self.ids else self.numeric_ids
+        position = bisect.bisect_right(numeric_ids, since_id)
+        page = ids[position:position + limit]
+        return page, get_numeric_id(page[-1]) if page and position + limit < len(ids) else None
+
+    def get_marc(self, records_ids):
+        return b''.join(self.updated_records.get(record_id) or self.records[record_id]
+                        for record_id in records_ids if record_id in self.records)
+
+
+class FakeDataBnServer(object):
+    """
+    HTTP server (in background thread) with fake data.bn.org.pl API for given dumps.
+    """
+    def __init__(self, bibs_data, authorities_data, host='127.0.0.1', port=0, latency=0.0,
+                 updated_count=0, deleted_count=0, seed=0):
+        self.records = {'bibs': FakeRecords(bibs_data, updated_count, deleted_count, seed),
+                        'authorities': FakeRecords(authorities_data, updated_count, deleted_count, seed + 1)}
+        self.latency = latency
+        self.requests_count = 0
+        self.connections_count = 0
+        self.failures = []
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer((host, port), self.create_handler())
+        self.server.daemon_threads = True
+        self.base_url = 'http://{}:{}'.format(host, self.server.server_address[1])
+        self.thread = None
+
+    def create_handler(self):
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                with fake_server.lock:
+                    fake_server.connections_count += 1
+                super().setup()
+
+            def do_GET(self):
+                fake_server.handle(self)
+
+            def log_message(self, format, *args):
+                logging.debug('fake data.bn: ' + format % args)
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-data-bn', daemon=True)
+        self.thread.start()
+        logging.info('Atrapa data.bn.org.pl: {}'.format(self.base_url))
+        return self.base_url
+
+    def fail_next(self, status, count=1):
+        """
+        Next count requests are answered with error status (e.g. 429, 503) instead of records.
+        """
+        with self.lock:
+            self.failures.extend([status] * count)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, handler):
+        with self.lock:
+            self.requests_count += 1
+            failure = self.failures.pop(0) if self.failures else None
+        if self.latency:
+            time.sleep(self.latency)
+        if failure is not None:
+            return self.respond(handler, failure, b'Error', 'text/plain')
+
+        url = urlsplit(handler.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        resource = url.path.rsplit('/', 1)[-1]
+        records_type, dot, extension = resource.partition('.')
+
+        if not url.path.startswith('/api/') or records_type not in self.records or extension not in ('json', 'marc'):
+            return self.respond(handler, 404, b'Not found', 'text/plain')
+
+        records = self.records[records_type]
+        if extension == 'marc':
+            records_ids = params.get('id', '').split(',')
+            return self.respond(handler, 200, records.get_marc(records_ids), 'application/marc')
+
+        ids = records.ids
+        if 'updatedDate' in params:
+            ids = records.deleted_ids if params.get('deleted') == 'true' else records.updated_ids
+        limit = int(params.get('limit', 10))
+        page, last_numeric_id = records.get_page(ids, int(params.get('sinceId', 0)), limit)
+
+        next_page = ''
+        if last_numeric_id is not None:
+            next_params = dict(params, sinceId=last_numeric_id)
+            next_page = '{}/api/{}.json?{}'.format(self.base_url, records_type,
+                                                   '&'.join('{}={}'.format(key, value)
+                                                            for key, value in next_params.items()))
+        body = json.dumps({records_type: [{'id': get_numeric_id(record_id), 'marc': {'fields': [{'001': record_id}]}}
+                                          for record_id in page], 'nextPage': next_page}).encode('utf-8')
+        return self.respond(handler, 200, body, 'application/json')
+
+    @staticmethod
+    def respond(handler, status, body, content_type):
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Atrapa API data.bn.org.pl udostępniająca rekordy z plików ISO 2709.')
+    parser.add_argument('--bibs', default='bibs-all.marc', help='plik z rekordami bibliograficznymi')
+    parser.add_argument('--authorities', default='authorities-all.marc', help='plik z rekordami wzorcowymi')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='opóźnienie każdej odpowiedzi (s)')
+    parser.add_argument('--updated', type=int, default=0, help='liczba zaktualizowanych rekordów każdego typu')
+    parser.add_argument('--deleted', type=int, default=0, help='liczba usuniętych rekordów każdego typu')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s %(message)s', datefmt="%H:%M:%S",
+                        stream=sys.stdout)
+    server = FakeDataBnServer(args.bibs, args.authorities, args.host, args.port, args.latency, args.updated,
+                              args.deleted)
+    logging.info('Atrapa data.bn.org.pl: {}'.format(server.base_url))
+    server.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import os
+import pickle
+import struct
+import hashlib
+import logging
+from datetime import datetime
+from indexer_config import SNAPSHOT_DIR, SNAPSHOT_FORMAT_VERSION, SNAPSHOT_MAX_JOURNAL_BYTES, SNAPSHOT_MAX_AGE
+
+# snapshots of authority and bibliographic indexes
+
+# file layout:
+# header (fixed size, see SNAPSHOT_HEADER) + pickled metadata (dict) + pickled index
+# header: magic, format version, source dump size, source dump mtime (ns), metadata length, payload length,
+#         blake2b checksum of metadata and payload
+
+SNAPSHOT_MAGIC = b'MARCIDX\x00'
+SNAPSHOT_HEADER = struct.Struct('<8sIQQQQ32s')
+
+# errors of unpickling index (snapshot is then ignored and index is built again)
+SNAPSHOT_LOAD_ERRORS = (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, KeyError, TypeError,
+                        ValueError)
+
+
+def snapshot_path_for(data, kind=None):
+    """
+    Returns snapshot file path for given MARC dump (and kind of index, if several indexes are built from one dump).
+    """
+    name = os.path.basename(data) if kind is None else '{}.{}'.format(os.path.basename(data), kind)
+    return os.path.join(SNAPSHOT_DIR, name + '.snapshot')
+
+
+def get_source_fingerprint(data):
+    stat = os.stat(data)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def save_index_snapshot(index, data, meta=None, kind=None):
+    """
+    Writes index snapshot for given MARC dump.
+    Snapshot is written to temporary file first and then atomically replaces the old one,
+    so a crash during write never leaves a broken snapshot behind.
+    """
+    snapshot_path = snapshot_path_for(data, kind)
+    os.makedirs(os.path.dirname(snapshot_path) or '.', exist_ok=True)
+
+    meta = dict(meta or {})
+    meta.setdefault('created', datetime.utcnow())
+
+    source_size, source_mtime = get_source_fingerprint(data)
+    meta_bytes = pickle.dumps(meta, protocol=pickle.HIGHEST_PROTOCOL)
+    payload = pickle.dumps(index, protocol=pickle.HIGHEST_PROTOCOL)
+
+    checksum = hashlib.blake2b(digest_size=32)
+    checksum.update(meta_bytes)
+    checksum.update(payload)
+
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, source_size, source_mtime,
+                                  len(meta_bytes), len(payload), checksum.digest())
+
+    tmp_path = snapshot_path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        fp.write(header)
+        fp.write(meta_bytes)
+        fp.write(payload)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, snapshot_path)
+
+    logging.info('Zapisano snapshot indeksu: {} ({} B)'.format(snapshot_path, SNAPSHOT_HEADER.size + len(meta_bytes) + len(payload)))
+
+
+def load_index_snapshot(data, kind=None):
+    """
+    Loads index snapshot for given MARC dump.
+    Returns tuple: index, metadata (dict).
+    Returns None, None if snapshot is missing, stale (dump has changed or format version differs) or corrupted.
+    """
+    snapshot_path = snapshot_path_for(data, kind)
+
+    if not os.path.exists(snapshot_path):
+        logging.info('Brak snapshotu indeksu: {}'.format(snapshot_path))
+        return None, None
+
+    with open(snapshot_path, 'rb') as fp:
+        header = fp.read(SNAPSHOT_HEADER.size)
+        if len(header) != SNAPSHOT_HEADER.size:
+            logging.warning('Uszkodzony snapshot indeksu: {}'.format(snapshot_path))
+            return None, None
+
+        magic, version, source_size, source_mtime, meta_length, payload_length, digest = SNAPSHOT_HEADER.unpack(header)
+
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_FORMAT_VERSION:
+            logging.info('Nieaktualna wersja snapshotu indeksu: {}'.format(snapshot_path))
+            return None, None
+
+        if os.path.exists(data) and get_source_fingerprint(data) != (source_size, source_mtime):
+            logging.info('Snapshot indeksu starszy niż plik źródłowy: {}'.format(snapshot_path))
+            return None, None
+
+        meta_bytes = fp.read(meta_length)
+        payload = fp.read(payload_length)
+
+    checksum = hashlib.blake2b(digest_size=32)
+    checksum.update(meta_bytes)
+    checksum.update(payload)
+
+    if len(meta_bytes) != meta_length or len(payload) != payload_length or checksum.digest() != digest:
+        logging.warning('Niezgodna suma kontrolna snapshotu indeksu: {}'.format(snapshot_path))
+        return None, None
+
+    try:
+        index = pickle.loads(payload)
+        meta = pickle.loads(meta_bytes)
+    except SNAPSHOT_LOAD_ERRORS as e:
+        # e.g. files referenced by index (bibliographic records store segments) are missing or snapshot was pickled
+        # from older definitions of index classes
+        logging.warning('Nie można odtworzyć indeksu ze snapshotu {}: {!r}'.format(snapshot_path, e))
+        return None, None
+
+    logging.info('Wczytano snapshot indeksu: {}'.format(snapshot_path))
+    return index, meta
+
+
+def read_snapshot_meta(data, kind=None):
+    """
+    Returns metadata (dict) of index snapshot for given MARC dump without loading the index
+    (checksum is verified only by load_index_snapshot). Returns None if snapshot is missing or stale.
+    """
+    snapshot_path = snapshot_path_for(data, kind)
+    if not os.path.exists(snapshot_path):
+        return None
+
+    with open(snapshot_path, 'rb') as fp:
+        header = fp.read(SNAPSHOT_HEADER.size)
+        if len(header) != SNAPSHOT_HEADER.size:
+            return None
+
+        magic, version, source_size, source_mtime, meta_length, payload_length, digest = SNAPSHOT_HEADER.unpack(header)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_FORMAT_VERSION:
+            return None
+        if os.path.exists(data) and get_source_fingerprint(data) != (source_size, source_mtime):
+            return None
+
+        meta_bytes = fp.read(meta_length)
+
+    try:
+        return pickle.loads(meta_bytes)
+    except Exception:
+        return None
+
+
+def get_journaled_snapshot_meta(journal, **meta):
+    """
+    Returns metadata of snapshot of index updated with changes of journal (ChangeJournal): its position and size.
+    """
+    return dict(journal.get_position(), journal_size=journal.size, **meta)
+
+
+def is_snapshot_due(data, journal, kind=None, now=None):
+    """
+    Checks if snapshot of index updated with changes of journal should be saved: snapshot is missing, belongs
+    to other journal (e.g. compacted), journal grew by SNAPSHOT_MAX_JOURNAL_BYTES since it or it is older
+    than SNAPSHOT_MAX_AGE seconds. Changes committed after snapshot are replayed from journal on startup.
+    """
+    meta = read_snapshot_meta(data, kind)
+    if meta is None or meta.get('journal_id') != journal.get_position()['journal_id'] or 'journal_size' not in meta:
+        return True
+    if journal.size - meta['journal_size'] >= SNAPSHOT_MAX_JOURNAL_BYTES:
+        return True
+    now = now if now is not None else datetime.utcnow()
+    return (now - meta['created']).total_seconds() >= SNAPSHOT_MAX_AGE
+
+
+def load_or_create_index(create_index, data, kind=None):
+    """
+    Loads index from snapshot or - if snapshot is missing or stale - builds it from MARC dump
+    with given index creator and writes a fresh snapshot.
+    Returns tuple: index, metadata (dict with 'last_update' - datetime of the newest data in index).
+    """
+    index, meta = load_index_snapshot(data, kind)
+
+    if index is None:
+        meta = {'last_update': datetime.utcnow()}
+        index = create_index(data)
+        save_index_snapshot(index, data, meta, kind)
+
+    return index, meta
@@ -28,4 +28,80 @@ FIELDS_TO_CHECK = [('100', ['a', 'b', 'c', 'd']),
 
 # authority record fields to index
 
-AUTHORITY_INDEX_FIELDS = ['100', '110', '111', '130', '148', '150', '151', '155']
\ No newline at end of file
+AUTHORITY_INDEX_FIELDS = ['100', '110', '111', '130', '148', '150', '151', '155']
+
+# index snapshots (written after index build and after updates - see below, loaded at startup)
+
+SNAPSHOT_DIR = 'snapshots'
+SNAPSHOT_FORMAT_VERSION = 4
+
+# snapshots after index updates: updates are kept in change journal (replayed on startup on top of the last snapshot),
+# so snapshot is saved only when journal grew by max bytes since the last one, when the last one is older than
+# max age (seconds), or when bib records store or journal is compacted
+
+SNAPSHOT_MAX_JOURNAL_BYTES = 256 * 1024 * 1024
+SNAPSHOT_MAX_AGE = 24 * 3600
+
+# bibliographic records store: compact overlay segment (updated records) when it exceeds this fraction of base file
+
+OVERLAY_COMPACTION_RATIO = 0.1
+
+# new versions of indexes (after each update) keep their changes as layer over tables of older version (see
+# layered_dict), which are shared and never modified; layer is merged into new tables when it exceeds this fraction
+# of their size
+
+INDEX_LAYER_MERGE_RATIO = 0.1
+
+# index build: number of worker processes (None - all available cores, 1 - serial build)
+# and number of dump byte ranges per process (more ranges - smoother progress and load balancing)
+
+INDEX_BUILD_PROCESSES = None
+INDEX_BUILD_RANGES_PER_PROCESS = 8
+
+# change journal (updates of indexes, replayed at startup): compact when it is bigger than min bytes
+# and has more than ratio entries per changed record
+
+JOURNAL_COMPACTION_MIN_BYTES = 64 * 1024 * 1024
+JOURNAL_COMPACTION_RATIO = 2
+
+# authority headings search: fuzzy matching as fallback of exact heading lookup while enriching records
+# (disabled by default) and minimal similarity (0-1) of heading matched this way
+
+AUTHORITY_FUZZY_FALLBACK = False
+AUTHORITY_FUZZY_MIN_SIMILARITY = 0.9
+
+# enriched records store: enriched bib records rendered in output formats kept by record id (disabled by default),
+# max size in bytes and bulk pre-pass at startup (in background) with formats to render
+
+ENRICHED_STORE = False
+ENRICHED_STORE_MAX_BYTES = 1024 * 1024 * 1024
+ENRICHED_STORE_PREFILL = False
+ENRICHED_STORE_PREFILL_FORMATS = ['xml']
+
+# bibliographic records store compression (disabled by default): records are kept in zlib-compressed blocks
+# of consecutive records (block size in bytes, max 128 KB) with preset dictionary (max 32 KB, zlib window) trained
+# on sample of records; decompressed blocks are cached (max bytes of cache, in each process)
+
+BIB_STORE_COMPRESSION = False
+BIB_STORE_BLOCK_SIZE = 16 * 1024
+BIB_STORE_COMPRESSION_LEVEL = 6
+BIB_STORE_DICTIONARY_SIZE = 32 * 1024
+BIB_STORE_DICTIONARY_SAMPLES = 2000
+BIB_STORE_BLOCK_CACHE_BYTES = 64 * 1024 * 1024
+
+# local listing of bib records (disabled by default): /get_bibs queries with supported parameters (limit, sinceId,
+# updatedDate, publicationYear, language - see bib_listing) are answered from local bib records store, other ones
+# by data.bn.org.pl
+
+LOCAL_BIB_LISTING = False
+
+# continuous sync of indexes with data.bn.org.pl (in API server process, instead of update_scheduler runs):
+# every interval seconds records changed since watermark of index (date of the previous query) are applied;
+# overlap in seconds - period before watermark queried again (changes can be listed by data.bn.org.pl with delay),
+# records listed again are skipped if they are equal to indexed ones
+# (disabled by default - indexes are updated by update_scheduler runs; if it is enabled, update_scheduler
+# shouldn't be run)
+
+INDEX_SYNC = False
+INDEX_SYNC_INTERVAL = 300
+INDEX_SYNC_OVERLAP = 120
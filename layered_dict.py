@@ -0,0 +1,86 @@
+from collections.abc import MutableMapping
+from indexer_config import INDEX_LAYER_MERGE_RATIO
+
+# tables of indexes (locations of bib records, authority ids and headings) in versions: new version of index
+# keeps only its changes over the table of older version, instead of copying the whole table for every update;
+# base table is never modified, so it stays shared by all versions (and by prefork workers, see prefork_server)
+
+DELETED = object()
+
+
+class LayeredDict(MutableMapping):
+    """
+    Dictionary made of base table (plain dict, shared and never modified) and own changes: keys set in this layer
+    (values) or deleted from base (DELETED). Keys keep order of base, new keys follow in order of insertion.
+    Pickled as plain dict.
+    """
+    def __init__(self, base, changes=None, size=None):
+        self.base = base
+        self.changes = {} if changes is None else changes
+        self.size = len(base) if size is None else size
+
+    def __getitem__(self, key):
+        if key in self.changes:
+            value = self.changes[key]
+            if value is DELETED:
+                raise KeyError(key)
+            return value
+        return self.base[key]
+
+    def get(self, key, default=None):
+        if key in self.changes:
+            value = self.changes[key]
+            return default if value is DELETED else value
+        return self.base.get(key, default)
+
+    def __contains__(self, key):
+        if key in self.changes:
+            return self.changes[key] is not DELETED
+        return key in self.base
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.size += 1
+        self.changes[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.base:
+            self.changes[key] = DELETED
+        else:
+            del self.changes[key]
+        self.size -= 1
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        changes = self.changes
+        for key in self.base:
+            if key not in changes or changes[key] is not DELETED:
+                yield key
+        for key, value in changes.items():
+            if value is not DELETED and key not in self.base:
+                yield key
+
+    def __reduce__(self):
+        return dict, (), None, None, iter(self.items())
+
+    def merge(self):
+        """
+        Returns plain dict with all items (new base table).
+        """
+        return dict(self.items())
+
+
+def copy_layered(table, merge_ratio=INDEX_LAYER_MERGE_RATIO):
+    """
+    Returns new version of table (dict or LayeredDict) to be modified: layer over the same base, with copy of changes
+    of table - or new base table with changes merged, if they exceed merge_ratio of base size.
+    """
+    if not isinstance(table, LayeredDict):
+        return LayeredDict(table)
+    if len(table.changes) > len(table.base) * merge_ratio:
+        return LayeredDict(table.merge())
+    return LayeredDict(table.base, dict(table.changes), table.size)
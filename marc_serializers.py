@@ -0,0 +1,71 @@
+import json
+from pymarc.marcxml import MARC_XML_NS, MARC_XML_SCHEMA, XSI_NS
+
+# direct serializers for pymarc records (without building ElementTree)
+
+TEXT_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+ATTRIBUTE_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;',
+                                        '\n': '&#10;', '\r': '&#13;', '\t': '&#09;'})
+
+RECORD_START_TAG = '<record>'
+RECORD_START_TAG_WITH_NAMESPACE = '<record xmlns="{}" xmlns:xsi="{}" xsi:schemaLocation="{}">'.format(
+    MARC_XML_NS, XSI_NS, MARC_XML_SCHEMA)
+COLLECTION_START_TAG = '<collection xmlns="{}" xmlns:xsi="{}" xsi:schemaLocation="{}">'.format(
+    MARC_XML_NS, XSI_NS, MARC_XML_SCHEMA)
+COLLECTION_END_TAG = '</collection>'
+
+
+def escape_text(text):
+    return text.translate(TEXT_ESCAPE_TABLE)
+
+
+def escape_attribute(value):
+    return value.translate(ATTRIBUTE_ESCAPE_TABLE)
+
+
+def record_to_marcxml(record, namespace=False):
+    """
+    Returns record as MARCXML string - the same markup as pymarc.marcxml.record_to_xml (for records with unicode data),
+    but written directly and not encoded to ASCII (see marcxml_to_ascii).
+    """
+    parts = [RECORD_START_TAG_WITH_NAMESPACE if namespace else RECORD_START_TAG,
+             '<leader>', escape_text(str(record.leader)), '</leader>']
+
+    for field in record:
+        if field.is_control_field():
+            if not field.data:
+                # empty elements are self-closing in pymarc output (ElementTree)
+                parts.append('<controlfield tag="{}" />'.format(escape_attribute(field.tag)))
+                continue
+            parts.append('<controlfield tag="{}">{}</controlfield>'.format(escape_attribute(field.tag),
+                                                                            escape_text(field.data)))
+        else:
+            parts.append('<datafield ind1="{}" ind2="{}" tag="{}">'.format(escape_attribute(field.indicators[0]),
+                                                                           escape_attribute(field.indicators[1]),
+                                                                           escape_attribute(field.tag)))
+            subfields = field.subfields
+            for i in range(0, len(subfields), 2):
+                if not subfields[i + 1]:
+                    parts.append('<subfield code="{}" />'.format(escape_attribute(subfields[i])))
+                    continue
+                parts.append('<subfield code="{}">{}</subfield>'.format(escape_attribute(subfields[i]),
+                                                                        escape_text(subfields[i + 1])))
+            parts.append('</datafield>')
+
+    parts.append('</record>')
+    return ''.join(parts)
+
+
+def marcxml_to_ascii(rendered_record):
+    """
+    Returns MARCXML string (see record_to_marcxml) encoded like pymarc.marcxml.record_to_xml output: ASCII bytes,
+    other characters as numeric character references.
+    """
+    return rendered_record.encode('ascii', 'xmlcharrefreplace')
+
+
+def record_to_jsonl(record):
+    """
+    Returns record as one line of MARC-in-JSON (with trailing newline).
+    """
+    return json.dumps(record.as_dict(), ensure_ascii=False) + '\n'
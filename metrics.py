@@ -0,0 +1,465 @@
+import os
+import time
+import pickle
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# metrics of the API in Prometheus text exposition format (version 0.0.4), without external dependencies
+
+# metrics are registered in one registry (see registry) by modules which update them; values of metrics
+# which describe state of other objects (index sizes, cache statistics) are read by callbacks while rendering
+
+# in multi-process serving (see prefork_server) every worker writes values of its metrics to its own file
+# (see MetricsRegistry.attach_worker) and /metrics served by any worker renders values of all workers:
+# counters and histograms are summed up (restarted worker continues from values of its predecessor, so sums
+# never go down), other metrics are rendered for each worker with label worker; values of other workers
+# are at most WORKER_FLUSH_INTERVAL seconds old
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# default histogram buckets (upper bounds) for durations in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+WORKER_FLUSH_INTERVAL = 5
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_sample(name, labelnames, labelvalues, value):
+    if not labelnames:
+        return '{} {}'.format(name, format_value(value))
+    labels = ','.join('{}="{}"'.format(labelname, escape_label_value(labelvalue))
+                      for labelname, labelvalue in zip(labelnames, labelvalues))
+    return '{}{{{}}} {}'.format(name, labels, format_value(value))
+
+
+class Metric(object):
+    """
+    Base of metrics: values by label values (tuple, in labelnames order; empty tuple for metric without labels).
+    Values of aggregated metrics are summed up across worker processes (see merge_values).
+    """
+    metric_type = 'untyped'
+    aggregated = False
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('Metric {} has labels {}, got {}'.format(self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[labelname]) for labelname in self.labelnames)
+
+    def get_values(self):
+        """
+        Returns copy of values (dict: label values: value).
+        """
+        with self.lock:
+            return dict(self.values)
+
+    def set_values(self, values):
+        with self.lock:
+            self.values = values
+
+    def iter_samples(self, values=None):
+        """
+        Yields tuples: sample name, label names, label values, value - of given values (see get_values)
+        or of current ones.
+        """
+        values = values if values is not None else self.get_values()
+        for labelvalues, value in sorted(values.items()):
+            if value is not None:
+                yield self.name, self.labelnames, labelvalues, value
+
+    def render(self, values=None, workers_values=None):
+        """
+        Returns metric in Prometheus text format: current or given values, or values of worker processes
+        (workers_values, dict: worker number: values) with label worker.
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation.replace('\\', '\\\\').replace('\n', '\\n')),
+                 '# TYPE {} {}'.format(self.name, self.metric_type)]
+        if workers_values is None:
+            lines.extend(format_sample(*sample) for sample in self.iter_samples(values))
+        else:
+            for worker_number, values in sorted(workers_values.items()):
+                lines.extend(format_sample(name, labelnames + ('worker',), labelvalues + (str(worker_number),), value)
+                             for name, labelnames, labelvalues, value in self.iter_samples(values))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+    aggregated = True
+
+    @staticmethod
+    def merge_values(values_list):
+        merged = {}
+        for values in values_list:
+            for labelvalues, value in values.items():
+                merged[labelvalues] = merged.get(labelvalues, 0) + value
+        return merged
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Histogram of observed values: cumulative counts of values not greater than bucket bounds, sum and count.
+    """
+    metric_type = 'histogram'
+    aggregated = True
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][position] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get_values(self):
+        with self.lock:
+            return {labelvalues: [[*state[0]], state[1], state[2]] for labelvalues, state in self.values.items()}
+
+    @staticmethod
+    def merge_values(values_list):
+        merged = {}
+        for values in values_list:
+            for labelvalues, (counts, values_sum, values_count) in values.items():
+                state = merged.get(labelvalues)
+                if state is None:
+                    merged[labelvalues] = [[*counts], values_sum, values_count]
+                    continue
+                state[0] = [merged_count + count for merged_count, count in zip(state[0], counts)]
+                state[1] += values_sum
+                state[2] += values_count
+        return merged
+
+    def iter_samples(self, values=None):
+        values = values if values is not None else self.get_values()
+
+        bucket_labelnames = self.labelnames + ('le',)
+        for labelvalues, (counts, values_sum, values_count) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield self.name + '_bucket', bucket_labelnames, labelvalues + (format_value(bound),), cumulative
+            yield self.name + '_sum', self.labelnames, labelvalues, values_sum
+            yield self.name + '_count', self.labelnames, labelvalues, values_count
+
+
+class CallbackMetric(Metric):
+    """
+    Metric with values read by callback while rendering: callback returns value (metric without labels)
+    or dict: label values (tuple): value. Result is kept for cache_seconds (for expensive callbacks).
+    Callback of background metric is called in background thread (see refresh_in_background) - rendering
+    never waits for it and gives the last result (no samples before the first one).
+    Failing callback is logged and gives no samples.
+    """
+    def __init__(self, name, documentation, callback, labelnames=(), metric_type='gauge', cache_seconds=0,
+                 background=False):
+        super().__init__(name, documentation, labelnames)
+        self.metric_type = metric_type
+        self.callback = callback
+        self.cache_seconds = cache_seconds
+        self.background = background
+        self.collected = None
+        self.refreshing = None
+
+    def collect(self):
+        with self.lock:
+            if self.collected is not None and time.monotonic() - self.collected[0] < self.cache_seconds:
+                return self.collected[1]
+            if self.background:
+                self.start_refresh()
+                return self.collected[1] if self.collected is not None else {}
+
+        return self.refresh()
+
+    def refresh_in_background(self):
+        """
+        Calls callback in background thread (e.g. after indexes it reads were changed), unless it is running.
+        """
+        with self.lock:
+            self.start_refresh()
+
+    def start_refresh(self):
+        # called with lock held
+        if self.refreshing is None or not self.refreshing.is_alive():
+            self.refreshing = threading.Thread(target=self.refresh, name='metric-{}'.format(self.name), daemon=True)
+            self.refreshing.start()
+
+    def refresh(self):
+        try:
+            values = self.callback()
+        except Exception:
+            logging.exception('Błąd odczytu metryki: {}'.format(self.name))
+            return {}
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        with self.lock:
+            self.collected = (time.monotonic(), values)
+        return values
+
+    def get_values(self):
+        return {tuple(str(labelvalue) for labelvalue in labelvalues): value
+                for labelvalues, value in self.collect().items()}
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+        # set in worker processes of multi-process serving (see attach_worker)
+        self.worker_number = None
+        self.workers_directory = None
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError('Metric already registered: {}'.format(metric.name))
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, callback, labelnames=(), metric_type='gauge', cache_seconds=0,
+                 background=False):
+        return self.register(CallbackMetric(name, documentation, callback, labelnames, metric_type, cache_seconds,
+                                            background))
+
+    def get_metrics(self):
+        with self.lock:
+            return list(self.metrics.values())
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus text format (in worker process: metrics of all workers, see attach_worker).
+        """
+        if self.workers_directory is None:
+            return '\n'.join(metric.render() for metric in self.get_metrics()) + '\n'
+
+        # values of this worker are written first, so they are never older than values rendered before
+        self.flush()
+        workers_values = self.read_workers_values()
+        parts = []
+        for metric in self.get_metrics():
+            values_by_worker = {worker_number: values.get(metric.name, {})
+                                for worker_number, values in workers_values.items()}
+            if metric.aggregated:
+                parts.append(metric.render(values=metric.merge_values(values_by_worker.values())))
+            else:
+                parts.append(metric.render(workers_values=values_by_worker))
+        return '\n'.join(parts) + '\n'
+
+    def get_worker_path(self, worker_number):
+        return os.path.join(self.workers_directory, 'worker-{}.pickle'.format(worker_number))
+
+    def attach_worker(self, worker_number, workers_directory, flush_interval=WORKER_FLUSH_INTERVAL):
+        """
+        Attaches worker process (after fork) to directory with values of metrics of all workers and starts
+        writing values of this worker every flush_interval seconds. Restarted worker continues counters
+        and histograms of its predecessor; other workers than the first one start them from zero (values
+        inherited from master process are counted once).
+        """
+        self.worker_number = worker_number
+        self.workers_directory = workers_directory
+
+        previous_values = self.read_worker_values(self.get_worker_path(worker_number))
+        for metric in self.get_metrics():
+            if not metric.aggregated:
+                continue
+            if previous_values is not None:
+                metric.set_values(previous_values.get(metric.name, {}))
+            elif worker_number != 0:
+                metric.set_values({})
+
+        self.flush()
+        threading.Thread(target=self.flush_periodically, args=(flush_interval,), name='metrics-flush',
+                         daemon=True).start()
+
+    def flush(self):
+        """
+        Writes values of metrics of this worker to its file (atomically).
+        """
+        path = self.get_worker_path(self.worker_number)
+        values = {metric.name: metric.get_values() for metric in self.get_metrics()}
+        with open(path + '.tmp', 'wb') as fp:
+            pickle.dump(values, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def flush_periodically(self, flush_interval):
+        while True:
+            time.sleep(flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Błąd zapisu metryk procesu: {}'.format(self.worker_number))
+
+    @staticmethod
+    def read_worker_values(path):
+        try:
+            with open(path, 'rb') as fp:
+                return pickle.load(fp)
+        except FileNotFoundError:
+            return None
+
+    def read_workers_values(self):
+        """
+        Returns dict: worker number: values of metrics (dict: metric name: values) - of workers which wrote them.
+        """
+        workers_values = {}
+        for file_name in os.listdir(self.workers_directory):
+            if file_name.startswith('worker-') and file_name.endswith('.pickle'):
+                values = self.read_worker_values(os.path.join(self.workers_directory, file_name))
+                if values is not None:
+                    workers_values[int(file_name[len('worker-'):-len('.pickle')])] = values
+        return workers_values
+
+
+registry = MetricsRegistry()
+
+
+def get_resident_memory_bytes():
+    """
+    Returns resident memory of this process (Linux: /proc/self/statm), None if it is not available.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+registry.callback('process_resident_memory_bytes', 'Resident memory size in bytes.', get_resident_memory_bytes)
+
+
+# stage timings and tracing
+
+class StageTimer(object):
+    """
+    Accumulates time (seconds) of named stages of one request.
+    """
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def observe(self, histogram, names=None, **labels):
+        """
+        Observes time of given stages (all by default) in histogram with label stage.
+        """
+        for name in names if names is not None else self.stages:
+            if name in self.stages:
+                histogram.observe(self.stages[name], stage=name, **labels)
+
+
+class Tracer(object):
+    """
+    Per-request tracing (disabled by default, switchable at runtime): traces (request kind and name,
+    stage timings and details) are logged and the last max_traces of them are kept in memory.
+    In multi-process serving switch is shared by workers (see share_switch), traces are kept by each worker.
+    """
+    def __init__(self, max_traces=100, enabled=False):
+        self.switch = None
+        self.local_enabled = enabled
+        self.traces = deque(maxlen=max_traces)
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.switch.value) if self.switch is not None else self.local_enabled
+
+    def share_switch(self, switch):
+        """
+        Uses switch shared by worker processes (multiprocessing.Value, allocated before fork) instead of own one.
+        """
+        self.switch = switch
+
+    def set_enabled(self, enabled):
+        if self.switch is not None:
+            self.switch.value = int(enabled)
+        else:
+            self.local_enabled = enabled
+        logging.info('Śledzenie żądań: {}'.format('włączone' if enabled else 'wyłączone'))
+
+    def record(self, kind, name, stages, **details):
+        if not self.enabled:
+            return
+
+        trace = {'time': time.time(), 'kind': kind, 'name': name,
+                 'stages': {stage: round(seconds, 6) for stage, seconds in stages.items()},
+                 'total': round(sum(stages.values()), 6)}
+        trace.update(details)
+        with self.lock:
+            self.traces.append(trace)
+        logging.info('Śledzenie: {} {} {}'.format(kind, name, trace['stages']))
+
+    def as_dict(self):
+        with self.lock:
+            return {'enabled': self.enabled, 'max_traces': self.traces.maxlen, 'traces': list(self.traces)}
+
+
+tracer = Tracer()
@@ -0,0 +1,204 @@
+import os
+import logging
+from multiprocessing import Pool
+from tqdm import tqdm
+from permissive import PermissiveMARCScanner
+from bib_store import MarcRecordStore, CompressedMarcRecordStore
+from authority_index import AuthorityIndex
+from api_core import create_authority_index, create_local_bib_index, get_rid_of_punctuation, record_enricher
+from indexer_config import AUTHORITY_INDEX_FIELDS, INDEX_BUILD_PROCESSES, INDEX_BUILD_RANGES_PER_PROCESS
+
+# parallel (multi-process) indexers for authorities and bibliographic records
+
+# dump is split into byte ranges aligned to record boundaries, ranges are indexed in process pool
+# and partial results are merged in dump order, so merged indexes are identical to the ones built serially
+# terms of reverse index of bib records (see reverse_index) can be collected in the same pass as bib index
+
+END_OF_RECORD = b'\x1d'
+BOUNDARY_SEARCH_WINDOW = 64 * 1024
+
+
+def is_record_start(fp, position, file_size):
+    """
+    Checks if ISO 2709 record starts at given position: leader begins with 5-digit record length
+    and the byte at the end of the record is the record terminator (0x1D).
+    """
+    if position == file_size:
+        return True
+
+    fp.seek(position)
+    record_length = fp.read(5)
+    if len(record_length) < 5 or not record_length.isdigit() or int(record_length) < 24:
+        return False
+
+    record_end = position + int(record_length)
+    if record_end > file_size:
+        return False
+
+    fp.seek(record_end - 1)
+    return fp.read(1) == END_OF_RECORD
+
+
+def find_record_start(fp, position, file_size):
+    """
+    Returns offset of the first record starting at or after given position.
+    """
+    if position == 0:
+        return 0
+
+    window_start = position - 1
+    while window_start < file_size:
+        fp.seek(window_start)
+        window = fp.read(BOUNDARY_SEARCH_WINDOW)
+
+        i = window.find(END_OF_RECORD)
+        while i != -1:
+            candidate = window_start + i + 1
+            if is_record_start(fp, candidate, file_size):
+                return candidate
+            i = window.find(END_OF_RECORD, i + 1)
+
+        window_start += len(window)
+
+    return file_size
+
+
+def split_marc_dump(data, ranges_count, start=0):
+    """
+    Splits MARC dump (from start offset, which must be a record boundary) into (at most) ranges_count byte ranges
+    aligned to record boundaries.
+    Returns list of tuples: start offset, end offset.
+    """
+    file_size = os.path.getsize(data)
+
+    with open(data, 'rb') as fp:
+        boundaries = {find_record_start(fp, start + (file_size - start) * i // ranges_count, file_size)
+                      for i in range(ranges_count)}
+    boundaries = sorted(boundaries | {file_size})
+
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+
+def read_range(data, start, end):
+    with open(data, 'rb') as fp:
+        fp.seek(start)
+        return fp.read(end - start)
+
+
+def index_authority_range(task):
+    """
+    Worker: indexes authority records from given byte range.
+    Returns list of tuples: record id, heading - in the order create_authority_index applies them.
+    """
+    data, start, end = task
+    entries = []
+
+    rdr = PermissiveMARCScanner(read_range(data, start, end), ['001'] + AUTHORITY_INDEX_FIELDS, utf8_handling='ignore')
+    for rcd in rdr:
+        try:
+            record_id = rcd.value('001')
+        except KeyError:
+            continue
+        for fld in AUTHORITY_INDEX_FIELDS:
+            if fld in rcd:
+                entries.append((record_id, get_rid_of_punctuation(rcd.value(fld))))
+
+    return start, end, entries
+
+
+def index_bib_range(task):
+    """
+    Worker: indexes bibliographic records from given byte range.
+    Returns list of tuples: record id, offset (in the whole dump), length, terms of reverse index
+    (see ReverseIndex.get_terms; None if with_terms is false).
+    """
+    data, start, end, with_terms = task
+    entries = []
+
+    tags = ['001'] + list(record_enricher.tags_subfields) if with_terms else ['001']
+    rdr = PermissiveMARCScanner(read_range(data, start, end), tags, utf8_handling='ignore')
+    for rcd in rdr:
+        try:
+            record_id = rcd.value('001')
+        except KeyError:
+            continue
+        terms = record_enricher.get_terms_of_scanned_record(rcd) if with_terms else None
+        entries.append((record_id, start + rcd.offset, len(rcd.raw), terms))
+
+    return start, end, entries
+
+
+def run_in_pool(worker, data, processes, *args):
+    """
+    Runs worker over byte ranges of MARC dump in process pool (task: data, start, end and given args).
+    Progress (bytes of dump indexed by all workers) is reported as ranges are completed.
+    Returns partial results (lists of entries) in dump order.
+    """
+    ranges = split_marc_dump(data, processes * INDEX_BUILD_RANGES_PER_PROCESS)
+    results = {}
+
+    with Pool(processes) as pool, tqdm(total=os.path.getsize(data), unit='B', unit_scale=True) as progress:
+        for start, end, entries in pool.imap_unordered(worker, [(data, start, end) + args for start, end in ranges]):
+            results[start] = entries
+            progress.update(end - start)
+
+    return [results[start] for start, end in ranges]
+
+
+def get_processes_count(processes):
+    return processes or INDEX_BUILD_PROCESSES or os.cpu_count() or 1
+
+
+def create_authority_index_parallel(data, processes=None):
+    """
+    Creates authority records index (see create_authority_index) using process pool.
+    """
+    processes = get_processes_count(processes)
+    if processes == 1:
+        return create_authority_index(data)
+
+    authority_index = AuthorityIndex()
+
+    for entries in run_in_pool(index_authority_range, data, processes):
+        for record_id, heading in entries:
+            authority_index.index_record(record_id, heading)
+
+    logging.info('Zindeksowano rekordy wzorcowe w {} procesach'.format(processes))
+    return authority_index
+
+
+def create_local_bib_index_parallel(data, processes=None, reverse_index=None):
+    """
+    Creates bibliographic records index (see create_local_bib_index) using process pool.
+    Given reverse index (empty ReverseIndex) is built from terms collected in the same pass.
+    """
+    processes = get_processes_count(processes)
+    if processes == 1 and reverse_index is None:
+        return create_local_bib_index(data)
+
+    l_b_index = MarcRecordStore(data)
+    ranges_entries = run_in_pool(index_bib_range, data, processes, reverse_index is not None)
+    duplicates_ids = set()
+
+    for entries in ranges_entries:
+        for record_id, offset, length, terms in entries:
+            if record_id in l_b_index:
+                duplicates_ids.add(record_id)
+            l_b_index.add_base_record(record_id, offset, length)
+
+    if reverse_index is not None:
+        reverse_index.build_from_records_terms(((record_id, terms) for entries in ranges_entries
+                                                for record_id, offset, length, terms in entries),
+                                               duplicates_ids, l_b_index)
+
+    logging.info('Zindeksowano rekordy bibliograficzne w {} procesach'.format(processes))
+    return l_b_index
+
+
+def create_compressed_bib_index_parallel(data, processes=None, reverse_index=None):
+    """
+    Creates compressed bibliographic records index (see CompressedMarcRecordStore): records are indexed using
+    process pool and written to compressed segment next to the dump.
+    """
+    return CompressedMarcRecordStore.from_store(create_local_bib_index_parallel(data, processes, reverse_index),
+                                                data + '.zblocks')
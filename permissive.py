@@ -1,8 +1,13 @@
 import pymarc
+import xml.etree.ElementTree as ET
+from io import BytesIO
+from pymarc.constants import LEADER_LEN, DIRECTORY_ENTRY_LEN, SUBFIELD_INDICATOR
 from pymarc.exceptions import RecordLengthInvalid, RecordLeaderInvalid
 from pymarc.exceptions import BaseAddressInvalid, BaseAddressNotFound
 from pymarc.exceptions import RecordDirectoryInvalid, NoFieldsFound
 
+SUBFIELD_INDICATOR_BYTES = SUBFIELD_INDICATOR.encode('ascii')
+
 
 class PermissiveMARCReader(pymarc.MARCReader):
     """PermissiveMARCReader: recovers from most pymarc exceptions"""
@@ -14,9 +19,15 @@ class PermissiveMARCReader(pymarc.MARCReader):
         self.count = 0
         self.failed = 0
 
+    def __next__(self):
+        """To support iteration in Python 3; broken records (next returns None for them) are skipped."""
+        record = self.next()
+        while record is None:
+            record = self.next()
+        return record
+
     def next(self):
-        """To support iteration."""
-        pos = self.file_handle.tell()
+        """To support iteration; file_handle is only read (it can be non-seekable stream, e.g. request body)."""
         first5 = self.file_handle.read(5)
         if not first5:
             raise StopIteration
@@ -34,8 +45,200 @@ class PermissiveMARCReader(pymarc.MARCReader):
                                utf8_handling=self.utf8_handling)
             self.count += 1
             return record
-        except (RecordLeaderInvalid, BaseAddressNotFound, BaseAddressInvalid, RecordDirectoryInvalid, NoFieldsFound):
-            self.file_handle.seek(pos + length)
+        except (RecordLeaderInvalid, BaseAddressNotFound, BaseAddressInvalid, RecordDirectoryInvalid, NoFieldsFound,
+                ValueError):
+            # ValueError: non-numeric base address or directory entry (PermissiveMARCScanner skips such records too)
+            # whole record is already read - the next one starts at current position
+            self.count += 1
+            self.failed += 1
+            pass
+
+class ScannedRecord(object):
+    """ScannedRecord: original record bytes with raw data of fields extracted by PermissiveMARCScanner"""
+
+    __slots__ = ('raw', 'offset', 'fields', 'utf8_handling')
+
+    def __init__(self, raw, offset, fields, utf8_handling='strict'):
+        self.raw = raw
+        self.offset = offset
+        self.fields = fields
+        self.utf8_handling = utf8_handling
+
+    def __contains__(self, tag):
+        return tag in self.fields
+
+    def get_raw_fields(self, tag):
+        """Returns raw data (bytes, without field terminator) of all fields with given tag."""
+        return self.fields.get(tag, [])
+
+    def get_subfields(self, tag):
+        """
+        Returns subfields of all fields with given tag - for each field flat list of codes and decoded values,
+        the same as pymarc Field.subfields.
+        """
+        fields_subfields = []
+        for data in self.fields.get(tag, []):
+            subfields = []
+            for subfield in data.split(SUBFIELD_INDICATOR_BYTES)[1:]:
+                if subfield:
+                    subfields.append(subfield[:1].decode('ascii', 'ignore'))
+                    subfields.append(subfield[1:].decode('utf-8', self.utf8_handling))
+            fields_subfields.append(subfields)
+        return fields_subfields
+
+    def value(self, tag):
+        """
+        Returns decoded value of the first field with given tag - the same as pymarc Field.value():
+        control field data or stripped subfield values joined with space (indicators and subfield codes skipped).
+        """
+        data = self.fields[tag][0]
+
+        if tag < '010' and tag.isdigit():
+            return data.decode('utf-8', self.utf8_handling)
+
+        return ' '.join(subfield[1:].decode('utf-8', self.utf8_handling).strip()
+                        for subfield in data.split(SUBFIELD_INDICATOR_BYTES)[1:] if subfield)
+
+
+class PermissiveMARCScanner(object):
+    """
+    PermissiveMARCScanner: reads only leader and directory of ISO 2709 records and extracts requested fields
+    (without building pymarc Records); original record bytes are kept intact.
+    Recovers from broken records the same way as PermissiveMARCReader.
+    """
+
+    def __init__(self, marc_target, tags, utf8_handling='strict'):
+        if hasattr(marc_target, 'read') and callable(marc_target.read):
+            self.file_handle = marc_target
+        else:
+            self.file_handle = BytesIO(marc_target)
+        self.tags = frozenset(tag.encode('ascii') for tag in tags)
+        self.utf8_handling = utf8_handling
+        # offset of the next record (from position of file_handle at start), counted from bytes read
+        self.position = 0
+        self.count = 0
+        self.failed = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        To support iteration; broken records are skipped. file_handle is only read (it can be non-seekable stream).
+        """
+        while True:
+            pos = self.position
+            first5 = self.file_handle.read(5)
+            if not first5:
+                raise StopIteration
+            if len(first5) < 5:
+                raise RecordLengthInvalid
+
+            length = int(first5)
+            chunk = first5 + self.file_handle.read(length - 5)
+            self.position += len(chunk)
             self.count += 1
+            try:
+                return ScannedRecord(chunk, pos, self.scan_fields(chunk), self.utf8_handling)
+            except (RecordLeaderInvalid, BaseAddressNotFound, BaseAddressInvalid, RecordDirectoryInvalid, NoFieldsFound):
+                # whole record is already read - the next one starts at current position
+                self.failed += 1
+
+    def scan_fields(self, chunk):
+        if len(chunk) < LEADER_LEN:
+            raise RecordLeaderInvalid
+
+        try:
+            base_address = int(chunk[12:17])
+        except ValueError:
+            raise BaseAddressInvalid
+        if base_address <= 0:
+            raise BaseAddressNotFound
+        if base_address >= len(chunk):
+            raise BaseAddressInvalid
+
+        directory = chunk[LEADER_LEN:base_address - 1]
+        if len(directory) % DIRECTORY_ENTRY_LEN != 0:
+            raise RecordDirectoryInvalid
+        if not directory:
+            raise NoFieldsFound
+
+        fields = {}
+        for entry_start in range(0, len(directory), DIRECTORY_ENTRY_LEN):
+            entry_tag = directory[entry_start:entry_start + 3]
+            if entry_tag in self.tags:
+                try:
+                    entry_length = int(directory[entry_start + 3:entry_start + 7])
+                    entry_offset = int(directory[entry_start + 7:entry_start + 12])
+                except ValueError:
+                    raise RecordDirectoryInvalid
+                data_start = base_address + entry_offset
+                fields.setdefault(entry_tag.decode('ascii'), []).append(chunk[data_start:data_start + entry_length - 1])
+
+        return fields
+
+
+class PermissiveMARCXMLReader(object):
+    """
+    PermissiveMARCXMLReader: reads MARCXML records (with or without namespace) incrementally from file-like object;
+    parsed elements are dropped after each record, so memory use does not depend on document size.
+    Records which can't be converted are skipped; reading stops at malformed XML (error is kept in parse_error).
+    """
+
+    def __init__(self, marc_target):
+        if hasattr(marc_target, 'read') and callable(marc_target.read):
+            self.file_handle = marc_target
+        else:
+            self.file_handle = BytesIO(marc_target)
+        self.count = 0
+        self.failed = 0
+        self.parse_error = None
+
+    def __iter__(self):
+        root = None
+        try:
+            for event, element in ET.iterparse(self.file_handle, events=('start', 'end')):
+                if root is None:
+                    root = element
+                if event != 'end' or self.local_name(element) != 'record':
+                    continue
+
+                self.count += 1
+                try:
+                    record = self.element_to_record(element)
+                except (KeyError, ValueError):
+                    record = None
+                    self.failed += 1
+                root.clear()
+
+                if record is not None:
+                    yield record
+        except ET.ParseError as e:
             self.failed += 1
-            pass
\ No newline at end of file
+            self.parse_error = str(e)
+
+    @staticmethod
+    def local_name(element):
+        return element.tag.rsplit('}', 1)[-1]
+
+    def element_to_record(self, element):
+        """Converts <record> element to pymarc Record (the same way as pymarc.marcxml.XmlHandler)."""
+        record = pymarc.Record()
+
+        for child in element:
+            name = self.local_name(child)
+            if name == 'leader':
+                record.leader = child.text or ''
+            elif name == 'controlfield':
+                record.add_field(pymarc.Field(child.attrib['tag'], data=child.text or ''))
+            elif name == 'datafield':
+                field = pymarc.Field(child.attrib['tag'], [child.get('ind1', ' '), child.get('ind2', ' ')])
+                for subfield in child:
+                    if self.local_name(subfield) == 'subfield':
+                        field.subfields.append(subfield.attrib['code'])
+                        field.subfields.append(subfield.text or '')
+                record.add_field(field)
+
+        if not record.fields:
+            raise ValueError('Record without fields')
+        return record
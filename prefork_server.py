@@ -0,0 +1,221 @@
+import gc
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import logging
+import argparse
+import tempfile
+import multiprocessing
+from multiprocessing.connection import wait
+from waitress import serve
+from base_url_config import BASE_URL
+
+# multi-process serving (Linux, fork): master process loads indexes once (importing api_morepath), opens listening
+# socket and forks workers, which serve the API with waitress from the shared socket
+
+# memory of indexes is shared by workers: bib records are read from memory-mapped files (page cache),
+# Python structures (authority index, locations of bib records, reverse index) are inherited copy-on-write
+# and frozen (gc.freeze), so garbage collector of workers doesn't touch (copy) their pages
+# each worker has its own cache of chunks, prefetcher and enriched records store
+# update jobs are coordinated across workers with SharedIndexState (see api_morepath.run_update_job),
+# continuous sync of indexes (api_morepath.index_sync_loop) runs in worker nr 0
+# /metrics renders metrics of all workers (written to files in shared directory, see metrics.MetricsRegistry)
+# and switch of tracing is shared by workers, so any worker can serve them
+
+
+# interval of checks (seconds) if process holding update lock is alive while waiting for it
+UPDATE_LOCK_CHECK_INTERVAL = 10
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class UpdateLock(object):
+    """
+    Lock of index updates shared by worker processes. Process holding it is recorded, so lock held by worker
+    which died (e.g. killed during update) is taken over by process waiting for it, instead of blocking updates
+    of all workers forever.
+    """
+    def __init__(self, context, check_interval=UPDATE_LOCK_CHECK_INTERVAL):
+        self.lock = context.Lock()
+        self.owner_lock = context.Lock()
+        self.owner = context.Value('q', 0, lock=False)
+        self.check_interval = check_interval
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        started = time.monotonic()
+        while not self.lock.acquire(timeout=self.check_interval):
+            with self.owner_lock:
+                owner = self.owner.value
+                if owner and not is_process_alive(owner):
+                    self.owner.value = os.getpid()
+                    logging.warning('Przejęto blokadę aktualizacji indeksów po zakończonym procesie: {}'.format(owner))
+                    return
+            logging.info('Oczekiwanie na blokadę aktualizacji indeksów (proces: {}): {:.0f} s'.format(
+                owner, time.monotonic() - started))
+        with self.owner_lock:
+            self.owner.value = os.getpid()
+
+    def release(self):
+        with self.owner_lock:
+            self.owner.value = 0
+        self.lock.release()
+
+
+class SharedIndexState(object):
+    """
+    State shared by worker processes (allocated by master before fork): lock of index updates, published version
+    of indexes (bumped after each update job), versions served by workers, directory with metrics of workers
+    and switch of tracing.
+    """
+    def __init__(self, workers_count, metrics_directory):
+        context = multiprocessing.get_context('fork')
+        self.update_lock = UpdateLock(context)
+        self.published_version = context.Value('Q', 0, lock=False)
+        self.worker_versions = context.Array('Q', workers_count, lock=False)
+        self.metrics_directory = metrics_directory
+        self.tracing_enabled = context.Value('b', 0, lock=False)
+        self.worker_number = None
+
+    def publish(self):
+        """
+        Bumps published version (with update lock held) and returns it; this worker serves it already.
+        """
+        self.published_version.value += 1
+        self.set_worker_version(self.published_version.value)
+        return self.published_version.value
+
+    def get_worker_version(self):
+        return self.worker_versions[self.worker_number]
+
+    def set_worker_version(self, version):
+        if self.worker_versions[self.worker_number] == version:
+            return
+        self.worker_versions[self.worker_number] = version
+        logging.info('Proces {} (nr {}) obsługuje wersję indeksów: {}'.format(os.getpid(), self.worker_number, version))
+
+    def wait_for_workers(self, version, timeout):
+        """
+        Waits until all workers serve given version (or newer). Returns False on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while any(worker_version < version for worker_version in self.worker_versions):
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+
+def create_listening_socket(listen):
+    host, port = listen.rsplit(':', 1)
+    return socket.create_server((host, int(port)), backlog=1024)
+
+
+def run_worker(api_morepath, state, worker_number, sock, threads):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    state.worker_number = worker_number
+    api_morepath.attach_worker(state)
+    if worker_number == 0 and api_morepath.index_sync_loop is not None:
+        # update jobs of sync loop are coordinated with other workers like any other update jobs
+        api_morepath.index_sync_loop.start()
+    logging.info('Uruchomiono proces obsługi żądań nr {}: {}'.format(worker_number, os.getpid()))
+    serve(api_morepath.App(), sockets=[sock], threads=threads)
+
+
+def serve_prefork(listen, workers_count, threads):
+    """
+    Loads indexes, forks workers_count workers serving the API on listen address (host:port) and restarts workers
+    which exit. SIGTERM or SIGINT stops master and workers.
+    """
+    sock = create_listening_socket(listen)
+    state = SharedIndexState(workers_count, tempfile.mkdtemp(prefix='marc-api-metrics-'))
+
+    import api_morepath
+    if api_morepath.enriched_store_prefill_thread is not None:
+        # records rendered before fork are shared by workers
+        logging.info('Oczekiwanie na wypełnienie magazynu wzbogaconych rekordów...')
+        api_morepath.enriched_store_prefill_thread.join()
+    api_morepath.App.commit()
+    gc.collect()
+    gc.freeze()
+
+    context = multiprocessing.get_context('fork')
+    processes = {}
+    stopping = []
+
+    def start_worker(worker_number):
+        process = context.Process(target=run_worker, name='marc-api-worker-{}'.format(worker_number),
+                                  args=(api_morepath, state, worker_number, sock, threads))
+        process.start()
+        processes[worker_number] = process
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for worker_number in range(workers_count):
+        start_worker(worker_number)
+    logging.info('Serwer API: {} (procesów: {}, wątków na proces: {})'.format(listen, workers_count, threads))
+
+    while not stopping:
+        wait([process.sentinel for process in processes.values()], timeout=1)
+        for worker_number, process in list(processes.items()):
+            if not process.is_alive() and not stopping:
+                logging.warning('Proces obsługi żądań nr {} zakończył się (kod: {}), uruchamianie ponownie'.format(
+                    worker_number, process.exitcode))
+                start_worker(worker_number)
+
+    logging.info('Zatrzymywanie serwera API')
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.join()
+    sock.close()
+    shutil.rmtree(state.metrics_directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Wieloprocesowy serwer API (indeksy wspólne dla procesów).')
+    parser.add_argument('--listen', default=BASE_URL, help='adres host:port')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='liczba procesów obsługi żądań')
+    parser.add_argument('--threads', type=int, default=4, help='liczba wątków każdego procesu')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='[%(asctime)s] %(levelname)s [%(processName)s %(name)s.%(funcName)s:%(lineno)d] %(message)s',
+        datefmt="%H:%M:%S",
+        stream=sys.stdout)
+
+    formatter = logging.Formatter('[%(asctime)s] %(levelname)s [%(processName)s %(name)s.%(funcName)s:%(lineno)d] '
+                                  '%(message)s')
+    root_fh = logging.FileHandler('log_marc_api.log', encoding='utf-8')
+    root_fh.setLevel(logging.INFO)
+    root_fh.setFormatter(formatter)
+    logging.root.addHandler(root_fh)
+
+    serve_prefork(args.listen, args.workers, args.threads)
+
+
+if __name__ == '__main__':
+    main()
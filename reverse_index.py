@@ -0,0 +1,199 @@
+import time
+import bisect
+import hashlib
+import logging
+import threading
+from array import array
+from permissive import PermissiveMARCScanner
+from authority_index import pack_record_id, unpack_record_id, get_deep_size
+from api_core import record_enricher
+
+# reverse index: terms searched in authority index (headings) -> bibliographic records with these terms
+
+# bibliographic records ids are packed into ints (see pack_record_id); ids which can't be packed
+# are kept in other_ids table and referenced by negative numbers
+# terms are kept as 64-bit hashes (see get_term_key) - collision only adds records to affected ones (they are
+# enriched again with the same result); most terms (e.g. titles) occur in one record, which is kept as int
+
+
+def get_term_key(term):
+    """
+    Returns key of term in reverse index: 64-bit hash, the same in all processes (unlike hash of str).
+    """
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+class ReverseIndex(object):
+    """
+    Reverse index of bibliographic records.
+    Structure:
+    key of term (see get_term_key; term is the same as searched in authority index while enriching record):
+    packed record id or sorted array of packed record ids (only for terms of several records).
+
+    Index is shared by all versions of bibliographic records store and updated in place (see sync).
+    """
+    def __init__(self):
+        self.terms = {}
+        self.other_ids = []
+        self.other_numbers = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'terms': self.terms, 'other_ids': self.other_ids, 'other_numbers': self.other_numbers}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.terms)
+
+    def pack(self, record_id):
+        packed_id = pack_record_id(record_id, 'b')
+        if isinstance(packed_id, int):
+            return packed_id
+
+        number = self.other_numbers.get(record_id)
+        if number is None:
+            self.other_ids.append(record_id)
+            number = self.other_numbers[record_id] = -len(self.other_ids)
+        return number
+
+    def find(self, record_id):
+        """
+        Returns packed id of record (see pack), None for id which can't be packed and isn't in other_ids.
+        """
+        packed_id = pack_record_id(record_id, 'b')
+        if isinstance(packed_id, int):
+            return packed_id
+        return self.other_numbers.get(record_id)
+
+    def unpack(self, packed_id):
+        if packed_id < 0:
+            return self.other_ids[-packed_id - 1]
+        return unpack_record_id(packed_id, 'b')
+
+    @staticmethod
+    def get_terms(raw_record):
+        """
+        Returns set of terms of bibliographic record (ISO 2709).
+        """
+        for rcd in PermissiveMARCScanner(raw_record, list(record_enricher.tags_subfields), utf8_handling='ignore'):
+            return record_enricher.get_terms_of_scanned_record(rcd)
+        return set()
+
+    def add_record(self, record_id, terms):
+        with self.lock:
+            packed_id = self.pack(record_id)
+            for term in terms:
+                key = get_term_key(term)
+                packed_ids = self.terms.get(key)
+                if packed_ids is None:
+                    self.terms[key] = packed_id
+                    continue
+                if isinstance(packed_ids, int):
+                    if packed_ids != packed_id:
+                        self.terms[key] = array('q', sorted((packed_ids, packed_id)))
+                    continue
+                position = bisect.bisect_left(packed_ids, packed_id)
+                if position == len(packed_ids) or packed_ids[position] != packed_id:
+                    packed_ids.insert(position, packed_id)
+
+    def remove_record(self, record_id, terms):
+        with self.lock:
+            packed_id = self.find(record_id)
+            if packed_id is None:
+                return
+            for term in terms:
+                key = get_term_key(term)
+                packed_ids = self.terms.get(key)
+                if packed_ids is None:
+                    continue
+                if isinstance(packed_ids, int):
+                    if packed_ids == packed_id:
+                        del self.terms[key]
+                    continue
+                position = bisect.bisect_left(packed_ids, packed_id)
+                if position < len(packed_ids) and packed_ids[position] == packed_id:
+                    del packed_ids[position]
+                    if len(packed_ids) == 1:
+                        self.terms[key] = packed_ids[0]
+
+    def build(self, bib_index):
+        """
+        Indexes all records of bibliographic records store.
+        """
+        self.build_from_records_terms((record_id, self.get_terms(bib_index[record_id])) for record_id in bib_index)
+
+    def build_from_records_terms(self, records_terms, duplicates_ids=(), bib_index=None):
+        """
+        Indexes records given as tuples: record id, terms (see get_terms) - e.g. collected while indexing MARC dump
+        (see parallel_indexer.create_local_bib_index_parallel). Records given more than once (duplicates_ids)
+        are indexed again from bib_index.
+        """
+        start = time.perf_counter()
+        terms = {}
+
+        for record_id, record_terms in records_terms:
+            packed_id = self.pack(record_id)
+            for term in record_terms:
+                terms.setdefault(get_term_key(term), []).append(packed_id)
+
+        duplicates = {self.pack(record_id) for record_id in duplicates_ids}
+        self.terms = {}
+        for key, packed_ids in terms.items():
+            packed_ids = [packed_id for packed_id in packed_ids if packed_id not in duplicates] if duplicates \
+                else packed_ids
+            # terms with the same key (hash collision) list the same record twice
+            packed_ids = sorted(set(packed_ids))
+            if len(packed_ids) == 1:
+                self.terms[key] = packed_ids[0]
+            elif packed_ids:
+                self.terms[key] = array('q', packed_ids)
+        for record_id in duplicates_ids:
+            self.add_record(record_id, self.get_terms(bib_index[record_id]))
+
+        logging.info('Zbudowano indeks odwrotny rekordów bibliograficznych: {} haseł ({:.1f} s)'.format(
+            len(self.terms), time.perf_counter() - start))
+
+    def sync(self, old_bib_index, new_bib_index, records_ids):
+        """
+        Updates index after records with given ids were changed (new_bib_index is the updated copy of old_bib_index).
+        """
+        for record_id in set(records_ids):
+            old_record = old_bib_index.get(record_id)
+            new_record = new_bib_index.get(record_id)
+            old_terms = self.get_terms(old_record) if old_record is not None else set()
+            new_terms = self.get_terms(new_record) if new_record is not None else set()
+            self.remove_record(record_id, old_terms - new_terms)
+            self.add_record(record_id, new_terms - old_terms)
+
+    def get_records_ids(self, term):
+        with self.lock:
+            packed_ids = self.terms.get(get_term_key(term), ())
+            if isinstance(packed_ids, int):
+                return [self.unpack(packed_ids)]
+            return [self.unpack(packed_id) for packed_id in packed_ids]
+
+    def get_affected_records_ids(self, terms):
+        """
+        Returns sorted list of ids of records with any of given terms (None is skipped).
+        """
+        records_ids = set()
+        for term in terms:
+            if term is not None:
+                records_ids.update(self.get_records_ids(term))
+        return sorted(records_ids)
+
+    def memory_report(self):
+        with self.lock:
+            return {'terms': len(self.terms),
+                    'postings': sum(1 if isinstance(packed_ids, int) else len(packed_ids)
+                                    for packed_ids in self.terms.values()),
+                    'reverse_index_bytes': get_deep_size(self.terms) + get_deep_size(self.other_ids)}
+
+
+def create_reverse_index(bib_index):
+    reverse_index = ReverseIndex()
+    reverse_index.build(bib_index)
+    return reverse_index
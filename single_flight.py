@@ -0,0 +1,67 @@
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+# coalescing of concurrent identical calls (e.g. requests for the same page or record made by several harvesters
+# at the same moment): the first caller computes the result, the others wait for it instead of computing it again
+
+
+class SingleFlightTimeout(TimeoutError):
+    """
+    Raised in caller which waited for result of identical call longer than timeout of SingleFlight.
+    """
+
+
+class SingleFlight(object):
+    """
+    Calls in flight by key. The first caller of do for a key (leader) calls the function, callers with the same key
+    arriving before it finishes wait for its result (at most timeout seconds, None - no limit) and get the same
+    result or exception. Results are not kept after the call finishes (caches are responsible for that).
+    """
+    def __init__(self, name, timeout=None):
+        self.name = name
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.failed = 0
+
+    def do(self, key, function, *args):
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                future = self.in_flight[key] = Future()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            try:
+                return future.result(self.timeout)
+            except FutureTimeoutError:
+                with self.lock:
+                    self.timeouts += 1
+                raise SingleFlightTimeout('Timeout of waiting for identical call ({}): {}'.format(self.name, key))
+
+        try:
+            result = function(*args)
+        except BaseException as e:
+            with self.lock:
+                self.failed += 1
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def get_stats(self):
+        with self.lock:
+            return {'in_flight': len(self.in_flight), 'calls': self.calls, 'coalesced': self.coalesced,
+                    'timeouts': self.timeouts, 'failed': self.failed}
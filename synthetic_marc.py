@@ -0,0 +1,313 @@
+import sys
+import random
+import logging
+import argparse
+from datetime import datetime, timedelta
+from pymarc import Record, Field
+from authority_index import calculate_check_digit
+
+# synthetic MARC dumps for benchmarks (see benchmark.py)
+
+# authority records have headings in AUTHORITY_INDEX_FIELDS built from Polish names, subjects and places
+# (with diacritics); some headings are repeated on purpose (ambiguous headings, several records with one heading)
+# bibliographic records use headings of authority records in FIELDS_TO_CHECK fields - popular headings
+# are used much more often than the others (skewed distribution, like in real catalogue), some headings
+# are unknown (not linked) and some have extra punctuation and subfields which are not searched
+# small fraction of records is broken (invalid base address or directory, invalid UTF-8), but record lengths
+# are valid, so permissive readers skip them and read the rest of dump
+# data is generated from seed, so the same parameters give the same dumps
+
+FIRST_NAMES = ['Jan', 'Józef', 'Łukasz', 'Małgorzata', 'Zofia', 'Wojciech', 'Krzysztof', 'Agnieszka', 'Grzegorz',
+               'Elżbieta', 'Stanisław', 'Jadwiga', 'Bolesław', 'Zdzisław', 'Ryszard', 'Halina', 'Maciej', 'Bożena',
+               'Mieczysław', 'Urszula', 'Jerzy', 'Teresa', 'Władysław', 'Grażyna', 'Andrzej', 'Wiesława']
+SURNAMES = ['Kowalski', 'Nowak', 'Wiśniewski', 'Wójcik', 'Kamiński', 'Lewandowski', 'Zieliński', 'Szymański',
+            'Woźniak', 'Dąbrowski', 'Kozłowski', 'Jankowski', 'Mazur', 'Krawczyk', 'Piątek', 'Grabowski',
+            'Pawłowski', 'Michalski', 'Król', 'Wieczorek', 'Jabłoński', 'Wróbel', 'Nowakowski', 'Majewski',
+            'Olszewski', 'Stępień', 'Malinowski', 'Jaworski', 'Adamczyk', 'Dudek', 'Górski', 'Sikora', 'Żak',
+            'Świątek', 'Łęcki', 'Ćwik', 'Źrebiec', 'Gęsiarz', 'Kłos', 'Ślusarczyk']
+SUBJECTS = ['Historia', 'Sztuka', 'Literatura polska', 'Architektura', 'Muzyka', 'Teatr', 'Filozofia',
+            'Językoznawstwo', 'Rolnictwo', 'Przemysł', 'Górnictwo', 'Żegluga', 'Pożarnictwo', 'Ogrodnictwo',
+            'Łowiectwo', 'Rzeźba', 'Malarstwo', 'Poezja polska', 'Szkolnictwo', 'Kościół katolicki', 'Ekonomia',
+            'Socjologia', 'Wychowanie fizyczne', 'Źródła historyczne', 'Prawo', 'Medycyna', 'Pielęgniarstwo',
+            'Geografia', 'Turystyka', 'Dziennikarstwo', 'Środowisko przyrodnicze', 'Gospodarka wodna']
+QUALIFIERS = ['teoria', 'dydaktyka', 'nauczanie', 'historia', 'organizacja', 'zarządzanie', 'ochrona',
+              'konserwacja i restauracja', 'badania', 'słowniki', 'bibliografia', 'podręczniki', 'źródła', 'ćwiczenia']
+PLACES = ['Kraków (woj. małopolskie)', 'Warszawa', 'Gdańsk (woj. pomorskie)', 'Wrocław (woj. dolnośląskie)',
+          'Łódź (woj. łódzkie)', 'Poznań (woj. wielkopolskie)', 'Śląsk', 'Mazowsze', 'Pomorze', 'Zakopane',
+          'Częstochowa (woj. śląskie)', 'Białystok', 'Rzeszów', 'Kielce', 'Żywiec', 'Świnoujście', 'Łowicz', 'Ełk',
+          'Sieradz', 'Polska', 'Niemcy', 'Francja', 'Włochy', 'Litwa', 'Ukraina']
+GENRES = ['Podręcznik', 'Monografia', 'Opracowanie', 'Słownik', 'Antologia', 'Powieść', 'Poezja',
+          'Wydawnictwo popularne', 'Publikacja bogato ilustrowana', 'Materiały konferencyjne', 'Biografia',
+          'Album', 'Przewodnik turystyczny', 'Dramat (rodzaj literacki)', 'Źródło historyczne', 'Komiks']
+INSTITUTIONS = ['Uniwersytet Jagielloński', 'Polska Akademia Nauk', 'Biblioteka Narodowa (Polska)',
+                'Politechnika Śląska', 'Towarzystwo Przyjaciół Sztuk Pięknych (Kraków)', 'Muzeum Narodowe (Kraków)',
+                'Związek Harcerstwa Polskiego', 'Uniwersytet Łódzki', 'Akademia Górniczo-Hutnicza im. Stanisława '
+                'Staszica (Kraków)', 'Ośrodek Karta', 'Państwowe Wydawnictwo Naukowe']
+INSTITUTION_UNITS = ['Wydział Historyczny', 'Instytut Historii Sztuki', 'Zakład Językoznawstwa', 'Biblioteka',
+                     'Archiwum', 'Katedra Ekonomii', 'Oddział w Gdańsku', 'Instytut Badań Literackich']
+TITLES = ['Pan Tadeusz', 'Quo vadis', 'Lalka', 'Chłopi', 'Wesele', 'Dziady', 'Potop', 'Ferdydurke', 'Solaris',
+          'Przedwiośnie', 'Żywoty świętych', 'Kronika polska', 'Biblia', 'Konstytucja 3 Maja']
+TITLE_WORDS = ['dzieje', 'źródła', 'świat', 'ludzie', 'miasto', 'wieś', 'życie', 'wojna', 'pokój', 'sztuka',
+               'język', 'nauka', 'szkoła', 'rodzina', 'gospodarka', 'przyroda', 'pamięć', 'tożsamość', 'kultura',
+               'ziemia', 'morze', 'góry', 'rzeka', 'zamek', 'kościół', 'dwór', 'ogród', 'podróż', 'księga', 'list']
+
+RELATOR_TERMS = ['Autor', 'Redakcja', 'Tłumaczenie', 'Ilustracje', 'Wstęp', 'Opracowanie']
+
+# authority headings: tag, share of authority records
+HEADING_TYPES = [('100', 0.55), ('110', 0.1), ('130', 0.05), ('150', 0.2), ('151', 0.05), ('155', 0.05)]
+
+BROKEN_RECORD_KINDS = ('base_address', 'directory', 'encoding')
+
+
+def create_record_id(prefix, number):
+    return prefix + calculate_check_digit(str(number))
+
+
+def pick_popular(rng, items, skew=3):
+    """
+    Returns random item; items at the beginning are picked much more often (skew 1 - uniform distribution).
+    """
+    return items[int(len(items) * rng.random() ** skew)]
+
+
+def get_update_date(rng, start=datetime(2015, 1, 1), days=3000):
+    return (start + timedelta(days=rng.randrange(days), seconds=rng.randrange(86400))).strftime('%Y%m%d%H%M%S.0')
+
+
+def create_heading_subfields(rng, tag):
+    """
+    Returns subfields (pymarc list: code, value, ...) of authority heading of given type.
+    """
+    if tag == '100':
+        birth = rng.randrange(1750, 1990)
+        dates = '{}-{}'.format(birth, birth + rng.randrange(25, 95)) if birth < 1940 else '{}-'.format(birth)
+        subfields = ['a', '{}, {}'.format(rng.choice(SURNAMES), rng.choice(FIRST_NAMES))]
+        if rng.random() < 0.1:
+            subfields += ['c', rng.choice(['(ks.)', '(historyk)', '(malarz)', '(poeta)'])]
+        return subfields + ['d', dates]
+    if tag == '110':
+        subfields = ['a', rng.choice(INSTITUTIONS)]
+        return subfields + ['b', rng.choice(INSTITUTION_UNITS)] if rng.random() < 0.7 else subfields
+    if tag == '130':
+        return ['a', rng.choice(TITLES)]
+    if tag == '150':
+        subfields = ['a', rng.choice(SUBJECTS)]
+        if rng.random() < 0.6:
+            subfields += ['x', rng.choice(QUALIFIERS)]
+        if rng.random() < 0.3:
+            subfields += ['z', rng.choice(PLACES)]
+        return subfields
+    if tag == '151':
+        return ['a', rng.choice(PLACES)]
+    return ['a', rng.choice(GENRES)]
+
+
+def create_authority_record(rng, record_id, tag, heading_subfields):
+    record = Record(leader='00000nz  a2200000n  4500', force_utf8=True)
+    record.add_field(Field(tag='001', data=record_id))
+    record.add_field(Field(tag='005', data=get_update_date(rng)))
+    record.add_field(Field(tag='008', data='150101n| acannaabn          a aaa     d'))
+    record.add_field(Field(tag='040', indicators=[' ', ' '], subfields=['a', 'WA N', 'b', 'pol', 'c', 'WA N']))
+    record.add_field(Field(tag=tag, indicators=['1' if tag == '100' else '2', ' '], subfields=list(heading_subfields)))
+    if tag == '100' and rng.random() < 0.3:
+        surname, first_name = heading_subfields[1].split(', ')
+        record.add_field(Field(tag='400', indicators=['1', ' '],
+                               subfields=['a', '{}, {}.'.format(surname, first_name[0])]))
+    record.add_field(Field(tag='670', indicators=[' ', ' '], subfields=['a', 'Źródło: opracowanie własne']))
+    return record
+
+
+def generate_authorities(count, rng, duplicate_ratio=0.01):
+    """
+    Returns list of tuples: authority record, heading tag, heading subfields.
+    duplicate_ratio of records repeat heading of an earlier record.
+    """
+    tags = [tag for tag, share in HEADING_TYPES]
+    weights = [share for tag, share in HEADING_TYPES]
+    authorities = []
+
+    for number in range(count):
+        if authorities and rng.random() < duplicate_ratio:
+            record, tag, heading_subfields = rng.choice(authorities)
+        else:
+            tag = rng.choices(tags, weights)[0]
+            heading_subfields = create_heading_subfields(rng, tag)
+        record_id = create_record_id('a', 100000000 + number)
+        authorities.append((create_authority_record(rng, record_id, tag, heading_subfields), tag, heading_subfields))
+
+    return authorities
+
+
+def add_punctuation(subfields):
+    """
+    Adds final period to the last subfield (ignored while matching, like in real records).
+    """
+    subfields = list(subfields)
+    if not subfields[-1].endswith(('.', ')', '-')):
+        subfields[-1] += '.'
+    return subfields
+
+
+class BibliographicRecordsGenerator(object):
+    """
+    Generates bibliographic records using headings of given authority records.
+    unknown_ratio of headings are made up (not in authority index).
+    """
+    # authority heading tag: bib record fields for it
+    BIB_TAGS = {'100': ('100', '700', '600'), '110': ('710', '610'), '130': ('630', '730'),
+                '150': ('650',), '151': ('651',), '155': ('655',)}
+
+    def __init__(self, authorities, rng, unknown_ratio=0.1):
+        self.rng = rng
+        self.unknown_ratio = unknown_ratio
+        self.headings = {tag: [] for tag, share in HEADING_TYPES}
+        for record, tag, heading_subfields in authorities:
+            self.headings[tag].append(heading_subfields)
+        # popular headings are at the beginning (see pick_popular)
+        for headings in self.headings.values():
+            rng.shuffle(headings)
+
+    def pick_heading(self, authority_tag):
+        if not self.headings[authority_tag] or self.rng.random() < self.unknown_ratio:
+            return create_heading_subfields(self.rng, authority_tag)
+        return pick_popular(self.rng, self.headings[authority_tag])
+
+    def create_heading_field(self, tag, authority_tag):
+        subfields = add_punctuation(self.pick_heading(authority_tag))
+        if tag in ('100', '700', '710'):
+            subfields += ['e', self.rng.choice(RELATOR_TERMS)]
+        if tag in ('650', '651', '655'):
+            subfields += ['2', 'DBN']
+        indicators = ['1', ' '] if tag in ('100', '600', '700') else ['2', '4'] if tag.startswith('6') else ['2', ' ']
+        return Field(tag=tag, indicators=indicators, subfields=subfields)
+
+    def create_title(self):
+        words = [self.rng.choice(TITLE_WORDS) for i in range(self.rng.randrange(2, 7))]
+        return ' '.join(words).capitalize()
+
+    def create_record(self, record_id):
+        rng = self.rng
+        record = Record(leader='00000nam a2200000 i 4500', force_utf8=True)
+        record.add_field(Field(tag='001', data=record_id))
+        record.add_field(Field(tag='005', data=get_update_date(rng)))
+        record.add_field(Field(tag='008', data='150101s{}    pl            000 0 pol c'.format(rng.randrange(1800, 2024))))
+        record.add_field(Field(tag='040', indicators=[' ', ' '], subfields=['a', 'WA N', 'b', 'pol', 'c', 'WA N']))
+
+        fields = []
+        if rng.random() < 0.8:
+            fields.append(self.create_heading_field('100', '100'))
+        fields.append(Field(tag='245', indicators=['1', '0'],
+                            subfields=['a', self.create_title() + ' /', 'c', 'oprac. zbiorowe.']))
+        fields.append(Field(tag='260', indicators=[' ', ' '],
+                            subfields=['a', rng.choice(['Kraków', 'Warszawa', 'Łódź', 'Wrocław']) + ' :',
+                                       'b', 'Wydawnictwo Śląsk,', 'c', str(rng.randrange(1900, 2024)) + '.']))
+        fields.append(Field(tag='300', indicators=[' ', ' '], subfields=['a', '{} s. ;'.format(rng.randrange(20, 900)),
+                                                                         'c', '24 cm.']))
+        if rng.random() < 0.3:
+            fields.append(Field(tag='500', indicators=[' ', ' '], subfields=['a', 'Bibliogr. s. {}-{}. Indeks.'.format(
+                rng.randrange(100, 200), rng.randrange(200, 300))]))
+
+        for i in range(rng.randrange(0, 3)):
+            fields.append(self.create_heading_field(rng.choice(self.BIB_TAGS['100'][1:]), '100'))
+        for i in range(rng.randrange(1, 5)):
+            fields.append(self.create_heading_field('650', '150'))
+        for authority_tag, share in (('151', 0.4), ('155', 0.8), ('110', 0.2), ('130', 0.1)):
+            if rng.random() < share:
+                fields.append(self.create_heading_field(rng.choice(self.BIB_TAGS[authority_tag]), authority_tag))
+
+        fields.sort(key=lambda fld: fld.tag)
+        for fld in fields:
+            record.add_field(fld)
+        return record
+
+
+def break_record(raw_record, kind):
+    """
+    Returns broken copy of ISO 2709 record (of the same length, so readers can skip it).
+    """
+    raw_record = bytearray(raw_record)
+    if kind == 'base_address':
+        raw_record[12:17] = b'0x0y0'
+    elif kind == 'directory':
+        # base address shifted by one byte - directory length is not a multiple of entry length
+        raw_record[12:17] = '{:05d}'.format(int(raw_record[12:17]) + 1).encode('ascii')
+    else:
+        # invalid UTF-8 in data of the last field
+        raw_record[-6:-3] = b'\xff\xfe\xfd'
+    return bytes(raw_record)
+
+
+def write_records(path, records, rng, broken_ratio):
+    """
+    Writes records (pymarc) to ISO 2709 file, broken_ratio of them are broken (see break_record).
+    Returns counters: written, broken.
+    """
+    counters = {'written': 0, 'broken': 0}
+    with open(path, 'wb') as fp:
+        for record in records:
+            raw_record = record.as_marc()
+            if rng.random() < broken_ratio:
+                raw_record = break_record(raw_record, rng.choice(BROKEN_RECORD_KINDS))
+                counters['broken'] += 1
+            fp.write(raw_record)
+            counters['written'] += 1
+    return counters
+
+
+def generate_dumps(authorities_path, bibs_path, authorities_count, bibs_count, seed=0, broken_ratio=0.002,
+                   duplicate_ratio=0.01, unknown_ratio=0.1):
+    """
+    Writes synthetic authority and bibliographic dumps. Returns counters of written and broken records.
+    """
+    rng = random.Random(seed)
+    authorities = generate_authorities(authorities_count, rng, duplicate_ratio)
+    authorities_counters = write_records(authorities_path, (record for record, tag, subfields in authorities),
+                                         rng, broken_ratio)
+
+    generator = BibliographicRecordsGenerator(authorities, rng, unknown_ratio)
+    bibs = (generator.create_record(create_record_id('b', 100000000 + number)) for number in range(bibs_count))
+    bibs_counters = write_records(bibs_path, bibs, rng, broken_ratio)
+
+    logging.info('Wygenerowano rekordów wzorcowych: {written} (błędnych: {broken})'.format(**authorities_counters))
+    logging.info('Wygenerowano rekordów bibliograficznych: {written} (błędnych: {broken})'.format(**bibs_counters))
+    return {'authorities': authorities_counters, 'bibs': bibs_counters}
+
+
+def create_updated_record(raw_record, rng):
+    """
+    Returns updated version of ISO 2709 record (new 005 and note field; heading of authority record changed
+    in every third record), None if record can't be read.
+    """
+    try:
+        record = Record(data=bytes(raw_record), force_utf8=True, utf8_handling='ignore')
+    except Exception:
+        return None
+
+    for fld in record.get_fields('005'):
+        fld.data = datetime.utcnow().strftime('%Y%m%d%H%M%S.0')
+    record.add_ordered_field(Field(tag='500', indicators=[' ', ' '], subfields=['a', 'Rekord zaktualizowany.']))
+    if rng.random() < 1 / 3:
+        for fld in record.get_fields('100', '150', '151', '155'):
+            fld['a'] = fld['a'] + ' (zm.)'
+    return record.as_marc()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generuje syntetyczne pliki ISO 2709 z rekordami wzorcowymi '
+                                                 'i bibliograficznymi (dla testów wydajności).')
+    parser.add_argument('--authorities', type=int, default=20000, help='liczba rekordów wzorcowych')
+    parser.add_argument('--bibs', type=int, default=50000, help='liczba rekordów bibliograficznych')
+    parser.add_argument('--authorities-output', default='authorities-all.marc', help='plik z rekordami wzorcowymi')
+    parser.add_argument('--bibs-output', default='bibs-all.marc', help='plik z rekordami bibliograficznymi')
+    parser.add_argument('--seed', type=int, default=0, help='ziarno generatora liczb losowych')
+    parser.add_argument('--broken-ratio', type=float, default=0.002, help='udział błędnych rekordów')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s %(message)s', datefmt="%H:%M:%S",
+                        stream=sys.stdout)
+    generate_dumps(args.authorities_output, args.bibs_output, args.authorities, args.bibs, args.seed,
+                   args.broken_ratio)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import copy
+import json
+import pickle
+import pytest
+from authority_index import AuthorityIndex
+from api_core import AuthorityBatchLookup
+
+
+def create_index():
+    authority_index = AuthorityIndex()
+    authority_index.index_record('a1000001x', 'Kowalski, Jan')
+    authority_index.index_record('a10000021', 'Kowalski, Jan')
+    authority_index.index_record('a10000033', 'Nowak, Anna')
+    authority_index.index_record('a10000045', 'Warszawa')
+    return authority_index
+
+
+def test_updates_of_copy_do_not_change_index():
+    authority_index = create_index()
+    expected = copy.deepcopy(authority_index.as_dict())
+
+    index_copy = authority_index.copy()
+    index_copy.update_record('a10000033', 'Kowalski, Jan')
+    index_copy.update_record('a1000001x', 'Nowak, Anna')
+    index_copy.remove_record('a10000045')
+    index_copy.update_record('a10000057', 'Kraków')
+
+    assert authority_index.as_dict() == expected
+    assert index_copy.get_ids('Kowalski, Jan') == ['a10000021', 'a10000033']
+    assert index_copy.get_ids('Nowak, Anna') == ['a1000001x']
+    assert index_copy.get_heading('a10000045') is None
+    assert index_copy.get_first_id('Kraków') == 'a10000057'
+    assert len(index_copy) == 4
+
+
+def test_copies_of_copies_are_equal_to_index_updated_in_place():
+    authority_index = create_index()
+    updated_in_place = pickle.loads(pickle.dumps(authority_index))
+
+    index_copy = authority_index
+    for record_id, heading in [('a10000033', 'Kowalski, Jan'), ('a1000001x', 'Nowak, Anna'),
+                               ('a10000057', 'Kowalski, Jan'), ('a10000033', 'Warszawa')]:
+        index_copy = index_copy.copy()
+        index_copy.update_record(record_id, heading)
+        updated_in_place.update_record(record_id, heading)
+
+    assert index_copy == updated_in_place
+    assert pickle.loads(pickle.dumps(index_copy)) == updated_in_place
+    assert authority_index == create_index()
+
+
+def create_lookup():
+    authority_index = AuthorityIndex()
+    # headings are indexed without punctuation (see api_core.get_rid_of_punctuation)
+    authority_index.index_record('a1000001x', 'Kowalski Jan')
+    authority_index.index_record('a10000021', 'Kowalski Jan')
+    authority_index.index_record('a10000033', 'Nowak Anna')
+    authority_index.index_record('a10000045', 'Warszawa')
+    return AuthorityBatchLookup(authority_index)
+
+
+def test_batch_lookup_returns_hits_ambiguous_headings_and_misses():
+    queries = ['a10000033', 'Warszawa.', 'Kowalski, Jan', 'a99999999', 'Kraków', 'Nowak, Anna', 'a10000033', 'Kraków']
+
+    response = create_lookup().lookup(queries)
+
+    assert response == {
+        'hits': [{'query': 'a10000033', 'heading': 'Nowak Anna', 'id': 'a10000033'},
+                 {'query': 'Warszawa.', 'heading': 'Warszawa', 'id': 'a10000045'},
+                 {'query': 'Nowak, Anna', 'heading': 'Nowak Anna', 'id': 'a10000033'}],
+        'ambiguous': [{'query': 'Kowalski, Jan', 'heading': 'Kowalski Jan', 'ids': ['a1000001x', 'a10000021']}],
+        'misses': ['a99999999', 'Kraków']}
+
+
+def test_batch_lookup_of_no_queries_returns_empty_lists():
+    assert create_lookup().lookup([]) == {'hits': [], 'ambiguous': [], 'misses': []}
+
+
+def test_queries_are_read_from_json_list():
+    body = json.dumps(['a10000033', 'Łódź']).encode('utf-8')
+
+    assert AuthorityBatchLookup.read_queries(body, max_queries=2) == ['a10000033', 'Łódź']
+
+
+@pytest.mark.parametrize('body, error', [
+    (b'["a10000033", ', 'not valid JSON'),
+    (b'\xff\xfe\x00', 'not valid JSON'),
+    (b'{"queries": ["a10000033"]}', 'must be JSON list'),
+    (b'["a10000033", 10000033]', 'must be JSON list'),
+    (b'["a10000033", "a10000045", "Warszawa"]', r'Too many queries: 3 \(max 2\)')])
+def test_malformed_body_is_rejected(body, error):
+    with pytest.raises(ValueError, match=error):
+        AuthorityBatchLookup.read_queries(body, max_queries=2)
@@ -0,0 +1,64 @@
+import pytest
+from authority_search import AuthoritySearchIndex, fold_heading
+
+HEADINGS = ['Kowalski Jan', 'Kowalski Janusz', 'Kowalska Anna', 'Łódź', 'Lodz', 'Mickiewicz Adam (1798-1855)',
+            'Mickiewicz Władysław', 'Żeromski Stefan (1864-1925)']
+
+
+@pytest.fixture
+def search_index():
+    search_index = AuthoritySearchIndex()
+    search_index.build(HEADINGS)
+    return search_index
+
+
+def test_headings_are_folded():
+    assert fold_heading('  Żółć, ŁÓDŹ -- Straße (1864-1925). ') == 'zolc lodz strasse 1864 1925'
+
+
+def test_prefix_search_ignores_case_and_diacritics(search_index):
+    assert search_index.search_prefix('kow') == ['Kowalska Anna', 'Kowalski Jan', 'Kowalski Janusz']
+    assert search_index.search_prefix('KOWALSKI, J') == ['Kowalski Jan', 'Kowalski Janusz']
+    assert search_index.search_prefix('Lo') == ['Łódź', 'Lodz']
+    assert search_index.search_prefix('zeromski') == ['Żeromski Stefan (1864-1925)']
+
+
+def test_prefix_search_is_bounded_by_prefix_and_limit(search_index):
+    assert search_index.search_prefix('kowalski jan') == ['Kowalski Jan', 'Kowalski Janusz']
+    assert search_index.search_prefix('kow', limit=2) == ['Kowalska Anna', 'Kowalski Jan']
+    assert search_index.search_prefix('kowalskiego') == []
+    assert search_index.search_prefix('a') == []
+    assert search_index.search_prefix('zz') == []
+
+
+def test_search_ranks_headings_by_similarity(search_index):
+    # order of words doesn't matter
+    assert search_index.search('Jan Kowalski') == [('Kowalski Jan', 1.0), ('Kowalski Janusz', 0.741)]
+    assert search_index.search('kowalsky jan', min_similarity=0.3) == \
+        [('Kowalski Jan', 0.833), ('Kowalski Janusz', 0.593), ('Kowalska Anna', 0.48)]
+    assert search_index.search('kowalsky jan', limit=1, min_similarity=0.3) == [('Kowalski Jan', 0.833)]
+    assert search_index.search('Sienkiewicz Henryk') == []
+
+
+def test_best_match_is_the_only_heading_folded_like_query(search_index):
+    assert search_index.find_best_match('kowalski, JAN') == 'Kowalski Jan'
+    assert search_index.find_best_match('Stefan Żeromski 1864-1925') == 'Żeromski Stefan (1864-1925)'
+    # headings folded the same way
+    assert search_index.find_best_match('LODZ') is None
+
+
+def test_fuzzy_best_match_requires_min_similarity(search_index):
+    # similarity: 0.844
+    assert search_index.find_best_match('Mickiewicz Adam 1798') is None
+    assert search_index.find_best_match('Mickiewicz Adam 1798', min_similarity=0.84) == 'Mickiewicz Adam (1798-1855)'
+    assert search_index.find_best_match('Mickiewicz Adam 1798', min_similarity=0.85) is None
+
+
+def test_removed_and_added_headings_are_searched(search_index):
+    search_index.remove_heading('Kowalski Jan')
+    search_index.add_heading('Kowalski Jan Maria')
+
+    assert search_index.search_prefix('kowalski') == ['Kowalski Jan Maria', 'Kowalski Janusz']
+    assert search_index.search('Jan Kowalski')[0] == ('Kowalski Jan Maria', 0.8)
+    assert search_index.find_best_match('Kowalski Jan') is None
+    assert len(search_index) == len(HEADINGS)
@@ -0,0 +1,172 @@
+import os
+import shutil
+import pytest
+import api_core
+from api_core import BibliographicRecordsChunk, BibliographicRecordsChunksCache, create_authority_index
+from api_core import create_local_bib_index
+from bib_listing import create_bib_listing_index
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NEW_RECORD_ID = 'b10000045'
+
+
+@pytest.fixture(scope='module')
+def auth_index():
+    return create_authority_index(os.path.join(REPOSITORY_ROOT, 'authorities-test.mrc'))
+
+
+@pytest.fixture
+def bib_index(tmp_path):
+    data = str(tmp_path / 'bibs-test.mrc')
+    shutil.copy(os.path.join(REPOSITORY_ROOT, 'bibs-test.mrc'), data)
+    return create_local_bib_index(data)
+
+
+def create_cached_pages(auth_index, bib_index, listing_index, queries):
+    chunks_cache = BibliographicRecordsChunksCache(100)
+    for query in queries:
+        chunks_cache.add_to_cache(BibliographicRecordsChunk(query, auth_index, bib_index, listing_index=listing_index))
+    return chunks_cache
+
+
+def get_listed_ids(chunks_cache, query):
+    return chunks_cache.cache[query].records_ids
+
+
+def test_new_record_inside_range_of_cached_page_invalidates_it(auth_index, bib_index):
+    old_bib_index = bib_index.copy()
+    del old_bib_index[NEW_RECORD_ID]
+    listing_index = create_bib_listing_index(old_bib_index)
+    queries = ['limit=3', 'limit=3&sinceId=1000003', 'limit=3&sinceId=1000007']
+    chunks_cache = create_cached_pages(auth_index, old_bib_index, listing_index, queries)
+    assert get_listed_ids(chunks_cache, 'limit=3&sinceId=1000003') == ['b10000057', 'b10000069', 'b10000070']
+
+    listing_index.sync(bib_index, [NEW_RECORD_ID])
+    chunks_cache.invalidate_records([NEW_RECORD_ID], listed=True)
+
+    assert list(chunks_cache.cache) == ['limit=3', 'limit=3&sinceId=1000007']
+    page = BibliographicRecordsChunk('limit=3&sinceId=1000003', auth_index, bib_index, listing_index=listing_index)
+    assert page.records_ids == [NEW_RECORD_ID, 'b10000057', 'b10000069']
+
+
+def test_new_record_after_the_last_page_invalidates_it(auth_index, bib_index):
+    listing_index = create_bib_listing_index(bib_index)
+    queries = ['limit=3', 'limit=3&sinceId=1000009']
+    chunks_cache = create_cached_pages(auth_index, bib_index, listing_index, queries)
+    assert chunks_cache.cache['limit=3&sinceId=1000009'].get_next_page_query() is None
+
+    new_bib_index = bib_index.copy()
+    new_bib_index['b1000011x'] = bytes(bib_index['b10000100'])
+    listing_index.sync(new_bib_index, ['b1000011x'])
+    chunks_cache.invalidate_records(['b1000011x'], listed=True)
+
+    assert list(chunks_cache.cache) == ['limit=3']
+
+
+def test_pages_out_of_range_of_changed_records_are_kept(auth_index, bib_index):
+    listing_index = create_bib_listing_index(bib_index)
+    chunks_cache = create_cached_pages(auth_index, bib_index, listing_index, ['limit=3', 'limit=3&sinceId=1000003'])
+
+    # records rendered differently (e.g. after authority update) - only pages containing them are removed
+    chunks_cache.invalidate_records(['b1000001x'])
+    assert list(chunks_cache.cache) == ['limit=3&sinceId=1000003']
+
+    chunks_cache.invalidate_records(['b1000011x'], listed=True)
+    assert list(chunks_cache.cache) == ['limit=3&sinceId=1000003']
+
+
+class FakeChunk(object):
+    def __init__(self, query, size=100, records_ids=()):
+        self.query = query
+        self.size = size
+        self.records_ids = list(records_ids)
+
+    def get_size_in_bytes(self):
+        return self.size
+
+    def is_listing_changed(self, numeric_ids):
+        return False
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(api_core.time, 'monotonic', fake_clock)
+    return fake_clock
+
+
+def test_least_recently_used_chunks_are_evicted(clock):
+    chunks_cache = BibliographicRecordsChunksCache(3)
+    for query in ['page=1', 'page=2', 'page=3']:
+        chunks_cache.add_to_cache(FakeChunk(query))
+
+    assert chunks_cache.get_from_cache('page=1').query == 'page=1'
+    chunks_cache.add_to_cache(FakeChunk('page=4'))
+
+    assert list(chunks_cache.cache) == ['page=3', 'page=1', 'page=4']
+    assert chunks_cache.get_from_cache('page=2') is None
+    stats = chunks_cache.get_stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['hit_rate']) == (1, 1, 1, 0.5)
+
+
+def test_chunks_expire_after_time_to_live(clock):
+    chunks_cache = BibliographicRecordsChunksCache(10, ttl=60)
+    chunks_cache.add_to_cache(FakeChunk('page=1'))
+    clock.now += 30
+    chunks_cache.add_to_cache(FakeChunk('page=2'))
+
+    clock.now += 30
+    assert chunks_cache.get_from_cache('page=1').query == 'page=1'
+    clock.now += 0.5
+    assert chunks_cache.get_from_cache('page=1') is None
+    assert chunks_cache.get_from_cache('page=2').query == 'page=2'
+    clock.now += 30
+    assert chunks_cache.get_from_cache('page=2') is None
+
+    stats = chunks_cache.get_stats()
+    assert (stats['chunks'], stats['hits'], stats['misses'], stats['expirations']) == (0, 2, 2, 2)
+
+
+def test_chunks_are_evicted_over_limit_of_bytes(clock):
+    chunks_cache = BibliographicRecordsChunksCache(10, max_bytes=250)
+    for query in ['page=1', 'page=2']:
+        chunks_cache.add_to_cache(FakeChunk(query))
+    chunks_cache.add_to_cache(FakeChunk('page=3', size=120))
+
+    assert list(chunks_cache.cache) == ['page=2', 'page=3']
+    assert chunks_cache.get_stats()['size_in_bytes'] == 220
+
+    # chunk larger than the limit is kept alone
+    chunks_cache.add_to_cache(FakeChunk('page=4', size=1000))
+    assert list(chunks_cache.cache) == ['page=4']
+    assert chunks_cache.get_stats()['evictions'] == 3
+
+
+def test_chunk_created_before_invalidation_is_not_added(clock):
+    chunks_cache = BibliographicRecordsChunksCache(10)
+
+    def create_chunk(query):
+        # records are changed while chunk is being created
+        chunks_cache.invalidate_records(['b1'])
+        return FakeChunk(query, records_ids=['b1'])
+
+    assert chunks_cache.create_and_add('page=1', create_chunk).query == 'page=1'
+    assert 'page=1' not in chunks_cache
+
+    chunks_cache.create_and_add('page=1', lambda query: FakeChunk(query, records_ids=['b1']))
+    chunks_cache.add_to_cache(FakeChunk('page=2', records_ids=['b2']))
+    chunks_cache.invalidate_records(['b1'])
+    assert list(chunks_cache.cache) == ['page=2']
+    chunks_cache.invalidate_all()
+
+    stats = chunks_cache.get_stats()
+    assert (stats['chunks'], stats['rejected'], stats['invalidations']) == (0, 1, 2)
@@ -0,0 +1,209 @@
+import os
+import pickle
+import random
+import shutil
+import pytest
+from api_core import create_local_bib_index
+from bib_store import CompressedMarcRecordStore
+from synthetic_marc import create_updated_record, generate_dumps
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(params=['plain', 'compressed'])
+def bib_index(request, tmp_path):
+    data = str(tmp_path / 'bibs-test.mrc')
+    shutil.copy(os.path.join(REPOSITORY_ROOT, 'bibs-test.mrc'), data)
+    store = create_local_bib_index(data)
+    if request.param == 'compressed':
+        store = CompressedMarcRecordStore.from_store(store, data + '.zblocks')
+    return store
+
+
+def update_records(bib_index, records_ids, seed):
+    """
+    Writes updated versions of given records to bib_index (as update job does). Returns them by record id.
+    """
+    rng = random.Random(seed)
+    updated_records = {}
+    for record_id in records_ids:
+        updated_record = None
+        while updated_record is None:
+            updated_record = create_updated_record(bytes(bib_index[record_id]), rng)
+        bib_index[record_id] = updated_records[record_id] = updated_record
+    return updated_records
+
+
+def assert_records(bib_index, expected_records):
+    for record_id, raw in expected_records.items():
+        assert bytes(bib_index[record_id]) == raw, record_id
+
+
+def test_update_after_failed_update_writes_records_after_discarded_ones(bib_index):
+    records_ids = list(bib_index)
+    current = bib_index.copy()
+    expected_records = {record_id: bytes(current[record_id]) for record_id in records_ids}
+    expected_records.update(update_records(current, records_ids[:2], seed=1))
+
+    # failed update job - its copy of index is discarded after records were written to overlay
+    failed = current.copy()
+    update_records(failed, records_ids[:5], seed=2)
+    del failed
+
+    updated = current.copy()
+    expected_updated_records = dict(expected_records, **update_records(updated, records_ids[3:7], seed=3))
+
+    assert_records(updated, expected_updated_records)
+    assert_records(current, expected_records)
+
+
+def test_update_of_version_loaded_from_snapshot_after_failed_update(bib_index):
+    records_ids = list(bib_index)
+    current = bib_index.copy()
+    update_records(current, records_ids[:2], seed=1)
+    expected_records = {record_id: bytes(current[record_id]) for record_id in records_ids}
+    snapshot = pickle.dumps(current)
+
+    failed = current.copy()
+    failed_records = update_records(failed, records_ids[:5], seed=2)
+
+    # restarted worker loads the snapshot while the discarded version is still being read
+    loaded = pickle.loads(snapshot)
+    assert_records(loaded, expected_records)
+    assert_records(failed, failed_records)
+
+    updated = loaded.copy()
+    expected_updated_records = dict(expected_records, **update_records(updated, records_ids[3:7], seed=3))
+
+    assert_records(updated, expected_updated_records)
+    assert_records(pickle.loads(pickle.dumps(updated)), expected_updated_records)
+    assert_records(failed, failed_records)
+
+
+def test_compaction_after_failed_update(bib_index):
+    records_ids = list(bib_index)
+    current = bib_index.copy()
+    failed = current.copy()
+    update_records(failed, records_ids[:5], seed=2)
+
+    updated = current.copy()
+    expected_records = {record_id: bytes(current[record_id]) for record_id in records_ids}
+    expected_records.update(update_records(updated, records_ids[3:7], seed=3))
+    updated.compact()
+
+    assert_records(updated, expected_records)
+    updated.remove_obsolete_segments()
+    assert_records(updated, expected_records)
+
+
+def test_changes_of_other_process_are_applied_without_writing_records(bib_index):
+    records_ids = list(bib_index)
+    snapshot = pickle.dumps(bib_index)
+    # processes serving versions loaded from the same snapshot
+    updating, catching_up = pickle.loads(snapshot), pickle.loads(snapshot)
+
+    failed = updating.copy()
+    update_records(failed, records_ids[:3], seed=1)
+    updated = updating.copy()
+    changes = list(update_records(updated, records_ids[2:6], seed=2).items())
+    del updated[records_ids[7]]
+    changes.append((records_ids[7], None))
+    overlay_size = os.path.getsize(updated.overlay_path)
+
+    caught_up = catching_up.copy()
+
+    assert caught_up.apply_changes(changes, updated.get_segments())
+    assert os.path.getsize(updated.overlay_path) == overlay_size
+    assert list(caught_up) == list(updated)
+    assert_records(caught_up, {record_id: bytes(updated[record_id]) for record_id in updated})
+    assert_records(catching_up, {record_id: bytes(bib_index[record_id]) for record_id in bib_index})
+
+
+def test_changes_of_other_process_are_not_applied_after_compaction(bib_index):
+    records_ids = list(bib_index)
+    snapshot = pickle.dumps(bib_index)
+    updating, catching_up = pickle.loads(snapshot), pickle.loads(snapshot)
+
+    updated = updating.copy()
+    changes = list(update_records(updated, records_ids[:2], seed=2).items())
+    segments = updated.get_segments()
+    updated.compact()
+
+    assert not catching_up.copy().apply_changes(changes, updated.get_segments())
+    # record missing in overlay
+    assert not catching_up.copy().apply_changes(changes + [(records_ids[3], b'00005')], segments)
+
+
+# compressed store compared with plain one (the same records, byte for byte)
+
+@pytest.fixture
+def stores(tmp_path):
+    data = str(tmp_path / 'bibs.marc')
+    generate_dumps(str(tmp_path / 'authorities.marc'), data, authorities_count=100, bibs_count=600, seed=22)
+    plain = create_local_bib_index(data)
+    return plain, CompressedMarcRecordStore.from_store(plain, data + '.zblocks')
+
+
+def assert_same_records(compressed, plain):
+    assert sorted(compressed) == sorted(plain)
+    assert_records(compressed, {record_id: bytes(plain[record_id]) for record_id in plain})
+
+
+def test_compressed_store_has_the_same_records_as_plain_one(stores):
+    plain, compressed = stores
+
+    assert compressed.base.get_stats()['cached_blocks'] == 0
+    assert_same_records(compressed, plain)
+    assert_same_records(pickle.loads(pickle.dumps(compressed)), plain)
+    # records are read from several blocks of the segment
+    assert compressed.base.map_size < compressed.base.data_size
+    assert compressed.base.get_stats()['misses'] > 1
+
+
+def test_updates_and_removals_of_compressed_store_are_the_same_as_of_plain_one(stores):
+    plain, compressed = stores
+    records_ids = list(plain)
+    plain, compressed = plain.copy(), compressed.copy()
+
+    updated_records = update_records(plain, records_ids[:50], seed=5)
+    for record_id, raw in updated_records.items():
+        compressed[record_id] = raw
+    for record_id in records_ids[40:60]:
+        del plain[record_id]
+        del compressed[record_id]
+
+    assert_same_records(compressed, plain)
+    assert_same_records(pickle.loads(pickle.dumps(compressed)), plain)
+    assert records_ids[45] not in compressed and records_ids[30] in compressed
+
+
+def test_compaction_of_compressed_store_removes_replaced_segments(stores):
+    plain, compressed = stores
+    records_ids = list(plain)
+    plain, compressed = plain.copy(), compressed.copy()
+    for record_id, raw in update_records(plain, records_ids[:20], seed=6).items():
+        compressed[record_id] = raw
+    del plain[records_ids[25]]
+    del compressed[records_ids[25]]
+    old_paths = [compressed.base_path, compressed.overlay_path]
+
+    compacted = compressed.copy()
+    compacted.compact()
+
+    assert compacted.overlay_size == 0 and compacted.base_path not in old_paths
+    assert_same_records(compacted, plain)
+    # older version still reads replaced segments until they are removed
+    assert_same_records(compressed, plain)
+    compacted.remove_obsolete_segments()
+    # source segment (written from dump) is kept, overlay is removed
+    assert [os.path.exists(path) for path in old_paths] == [True, False]
+    assert_same_records(compacted, plain)
+
+    # segments written by compaction interrupted before snapshot of its version was saved are removed at startup
+    loaded = pickle.loads(pickle.dumps(compacted))
+    interrupted = compacted.copy()
+    update_records(interrupted, records_ids[30:32], seed=7)
+    interrupted.compact()
+    loaded.remove_unused_segments()
+    assert not os.path.exists(interrupted.base_path)
+    assert_same_records(loaded, plain)
@@ -0,0 +1,98 @@
+import io
+import os
+import json
+import pytest
+from pymarc import MARCReader
+from webob.request import LimitedLengthFile
+from api_core import BulkEnrichment, create_authority_index
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class RequestInput(io.RawIOBase):
+    """
+    Non-seekable input stream (as wsgi.input of server), counting bytes read.
+    """
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.data.read(len(buffer))
+        buffer[:len(data)] = data
+        self.bytes_read += len(data)
+        return len(data)
+
+
+@pytest.fixture(scope='module')
+def auth_index():
+    return create_authority_index(os.path.join(REPOSITORY_ROOT, 'authorities-test.mrc'))
+
+
+@pytest.fixture(scope='module')
+def bibs_data():
+    with open(os.path.join(REPOSITORY_ROOT, 'bibs-test.mrc'), 'rb') as fp:
+        return fp.read()
+
+
+def create_body_file(data):
+    request_input = RequestInput(data)
+    return request_input, LimitedLengthFile(request_input, len(data))
+
+
+def test_records_are_read_from_non_seekable_stream_in_batches(auth_index, bibs_data):
+    request_input, body_file = create_body_file(bibs_data)
+    bulk_enrichment = BulkEnrichment(body_file, 'marc', 'jsonl', auth_index, batch_size=3)
+
+    output = bulk_enrichment.iter_output()
+    first_part = next(output)
+    # only the first batch was read before its output
+    assert request_input.bytes_read < len(bibs_data)
+    lines = (first_part + b''.join(output)).decode('utf-8').splitlines()
+
+    records = [json.loads(line) for line in lines if not line.startswith(('{"stats"', '{"summary"'))]
+    expected_ids = [rcd['001'].value() for rcd in MARCReader(bibs_data, to_unicode=True, force_utf8=True)]
+    assert [next(field['001'] for field in record['fields'] if '001' in field) for record in records] == expected_ids
+    assert request_input.bytes_read == len(bibs_data)
+    assert bulk_enrichment.get_summary() == dict(bulk_enrichment.totals, error=None)
+    assert bulk_enrichment.totals['batches'] == 4
+    assert bulk_enrichment.totals['read'] == len(expected_ids)
+
+
+def test_broken_record_in_stream_is_skipped(auth_index, bibs_data):
+    # directory of the first record is not valid - record is skipped, the next ones are read
+    broken_data = bibs_data[:12] + b'xxxxx' + bibs_data[17:]
+    request_input, body_file = create_body_file(broken_data)
+    bulk_enrichment = BulkEnrichment(body_file, 'marc', 'marc', auth_index, batch_size=4)
+
+    output = b''.join(bulk_enrichment.iter_output())
+
+    assert len(list(MARCReader(output))) == 9
+    assert bulk_enrichment.totals['failed'] == 1
+    assert bulk_enrichment.totals['read'] == 10
+
+
+def test_cut_record_at_the_end_of_stream_is_skipped(auth_index, bibs_data):
+    first_length = int(bibs_data[:5])
+    request_input, body_file = create_body_file(bibs_data[:first_length + 100])
+    bulk_enrichment = BulkEnrichment(body_file, 'marc', 'marc', auth_index, batch_size=4)
+
+    output = b''.join(bulk_enrichment.iter_output())
+
+    assert len(list(MARCReader(output))) == 1
+    assert bulk_enrichment.totals['failed'] == 1
+    assert request_input.bytes_read == first_length + 100
+
+
+def test_marcxml_is_read_from_non_seekable_stream(auth_index, bibs_data):
+    marc_output = b''.join(BulkEnrichment(io.BytesIO(bibs_data), 'marc', 'xml', auth_index).iter_output())
+    request_input, body_file = create_body_file(marc_output)
+    bulk_enrichment = BulkEnrichment(body_file, 'xml', 'marc', auth_index, batch_size=4)
+
+    output = b''.join(bulk_enrichment.iter_output())
+
+    assert len(list(MARCReader(output))) == 10
+    assert request_input.bytes_read == len(marc_output)
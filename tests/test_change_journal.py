@@ -0,0 +1,60 @@
+from datetime import datetime
+import pytest
+import change_journal
+from change_journal import ChangeJournal, UPSERT, DELETE
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    monkeypatch.setattr(change_journal, 'SNAPSHOT_DIR', str(tmp_path / 'snapshots'))
+    data = tmp_path / 'authorities.marc'
+    data.write_bytes(b'')
+    return ChangeJournal(str(data))
+
+
+def write_transaction(journal, changes, last_update):
+    transaction = journal.begin()
+    for operation, record_id, raw in changes:
+        if operation == DELETE:
+            transaction.delete(record_id)
+        else:
+            transaction.upsert(record_id, raw)
+    transaction.commit(last_update)
+
+
+def get_last_changes(changes):
+    """
+    Returns the last change of each record, in order of journal.
+    """
+    last_changes = {}
+    for operation, record_id, raw in changes:
+        last_changes.pop(record_id, None)
+        last_changes[record_id] = (operation, record_id, raw)
+    return list(last_changes.values())
+
+
+def test_compact_keeps_order_of_last_changes(journal):
+    transactions = [[(UPSERT, 'a1', b'a1-1'), (UPSERT, 'a2', b'a2-1'), (UPSERT, 'a3', b'a3-1')],
+                    [(UPSERT, 'a4', b'a4-1'), (UPSERT, 'a1', b'a1-2')],
+                    [(DELETE, 'a2', None), (UPSERT, 'a5', b'a5-1'), (UPSERT, 'a2', b'a2-2'), (UPSERT, 'a3', b'a3-2')]]
+    for day, changes in enumerate(transactions, 1):
+        write_transaction(journal, changes, datetime(2026, 10, day))
+    changes = list(journal.iter_changes())
+
+    journal.compact()
+
+    assert list(journal.iter_changes()) == get_last_changes(changes)
+    assert [record_id for operation, record_id, raw in journal.iter_changes()] == ['a4', 'a1', 'a5', 'a2', 'a3']
+    assert journal.sequence == 3
+    assert journal.last_update == datetime(2026, 10, 3)
+
+
+def test_compacted_journal_is_read_again_in_the_same_order(journal):
+    write_transaction(journal, [(UPSERT, 'a1', b'a1-1'), (UPSERT, 'a2', b'a2-1')], datetime(2026, 10, 1))
+    write_transaction(journal, [(UPSERT, 'a1', b'a1-2')], datetime(2026, 10, 2))
+    journal.compact()
+
+    reopened = ChangeJournal(journal.data)
+
+    assert list(reopened.iter_changes()) == [(UPSERT, 'a2', b'a2-1'), (UPSERT, 'a1', b'a1-2')]
+    assert list(reopened.iter_changes(reopened.get_position())) == []
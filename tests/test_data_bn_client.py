@@ -0,0 +1,193 @@
+import os
+import time
+import threading
+import pytest
+import requests
+from pymarc import MARCReader
+from data_bn_client import DataBnClient
+from fake_data_bn import FakeDataBnServer
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def fake_data_bn():
+    server = FakeDataBnServer(os.path.join(REPOSITORY_ROOT, 'bibs-test.mrc'),
+                              os.path.join(REPOSITORY_ROOT, 'authorities-test.mrc'))
+    server.start()
+    yield server
+    server.stop()
+
+
+def create_client(fake_data_bn, **kwargs):
+    return DataBnClient(base_url=fake_data_bn.base_url, **kwargs)
+
+
+def read_ids(marc_data):
+    return [rcd['001'].value() for rcd in MARCReader(bytes(marc_data), to_unicode=True, force_utf8=True)]
+
+
+# retries with backoff
+
+@pytest.mark.parametrize('status', [429, 500, 502, 503, 504])
+def test_get_retries_throttled_and_server_errors(fake_data_bn, status):
+    client = create_client(fake_data_bn, backoff_factor=0.1)
+    fake_data_bn.fail_next(status, 3)
+
+    started = time.monotonic()
+    json_chunk = client.get_json(client.get_api_url('bibs.json?limit=5'))
+
+    assert len(json_chunk['bibs']) == 5
+    assert fake_data_bn.requests_count == 4
+    # backoff before the 2nd and 3rd retry: 0.1 * 2 + 0.1 * 4
+    assert time.monotonic() - started >= 0.6
+
+
+def test_get_raises_when_retries_are_exhausted(fake_data_bn):
+    client = create_client(fake_data_bn, max_retries=2, backoff_factor=0)
+    fake_data_bn.fail_next(503, 3)
+
+    with pytest.raises(requests.HTTPError):
+        client.get(client.get_api_url('bibs.json?limit=5'))
+    assert fake_data_bn.requests_count == 3
+
+
+def test_get_does_not_retry_client_errors(fake_data_bn):
+    client = create_client(fake_data_bn, backoff_factor=0)
+
+    with pytest.raises(requests.HTTPError):
+        client.get(client.get_api_url('unknown.json'))
+    assert fake_data_bn.requests_count == 1
+
+
+# pooled connections
+
+def test_sequential_requests_reuse_connection(fake_data_bn):
+    client = create_client(fake_data_bn)
+
+    pages = list(client.iter_json_pages(client.get_api_url('authorities.json?limit=10')))
+
+    assert len(pages) == 10
+    assert fake_data_bn.connections_count == 1
+
+
+def test_retried_requests_reuse_connection(fake_data_bn):
+    client = create_client(fake_data_bn, backoff_factor=0)
+    fake_data_bn.fail_next(503, 2)
+
+    client.get_json(client.get_api_url('bibs.json?limit=5'))
+    client.get_json(client.get_api_url('bibs.json?limit=5'))
+
+    assert fake_data_bn.requests_count == 4
+    assert fake_data_bn.connections_count == 1
+
+
+def test_concurrent_fetches_use_connections_from_pool(fake_data_bn):
+    client = create_client(fake_data_bn, max_concurrent_fetches=4)
+    records_ids = fake_data_bn.records['authorities'].ids
+
+    for i in range(3):
+        for chunk_ids, marc_data in client.iter_marc_chunks('authorities', records_ids, chunk_size=5):
+            pass
+
+    assert fake_data_bn.requests_count == 60
+    assert fake_data_bn.connections_count <= 4
+
+
+# concurrent fetching of chunks
+
+def test_iter_marc_chunks_yields_chunks_in_order_of_ids(fake_data_bn):
+    client = create_client(fake_data_bn, max_concurrent_fetches=4)
+    records_ids = fake_data_bn.records['authorities'].ids
+    fetch_marc = client.fetch_marc
+
+    # earlier chunks are downloaded longer than the next ones
+    def slow_fetch_marc(records_type, chunk_ids):
+        time.sleep(0.05 * (4 - records_ids.index(chunk_ids[0]) // 7 % 4))
+        return fetch_marc(records_type, chunk_ids)
+    client.fetch_marc = slow_fetch_marc
+
+    chunks = list(client.iter_marc_chunks('authorities', (record_id for record_id in records_ids), chunk_size=7))
+
+    assert [chunk_ids for chunk_ids, marc_data in chunks] == \
+        [records_ids[i:i + 7] for i in range(0, len(records_ids), 7)]
+    for chunk_ids, marc_data in chunks:
+        assert read_ids(marc_data) == chunk_ids
+
+
+def test_iter_marc_chunks_fetches_concurrently(fake_data_bn):
+    fake_data_bn.latency = 0.2
+    client = create_client(fake_data_bn, max_concurrent_fetches=4)
+    records_ids = fake_data_bn.records['authorities'].ids[:40]
+
+    started = time.monotonic()
+    chunks = list(client.iter_marc_chunks('authorities', records_ids, chunk_size=10))
+
+    assert len(chunks) == 4
+    assert time.monotonic() - started < 0.2 * 3
+
+
+def test_iter_marc_chunks_raises_error_of_chunk(fake_data_bn):
+    client = create_client(fake_data_bn, max_retries=0)
+    fake_data_bn.fail_next(500)
+
+    with pytest.raises(requests.HTTPError):
+        list(client.iter_marc_chunks('bibs', fake_data_bn.records['bibs'].ids, chunk_size=5))
+
+
+# coalescing of identical fetches
+
+def test_concurrent_identical_get_marc_is_fetched_once(fake_data_bn):
+    fake_data_bn.latency = 0.3
+    client = create_client(fake_data_bn)
+    records_ids = fake_data_bn.records['bibs'].ids[:5]
+    barrier = threading.Barrier(8)
+    results = [None] * 8
+
+    def get_marc(i):
+        barrier.wait()
+        results[i] = client.get_marc('bibs', records_ids)
+    threads = [threading.Thread(target=get_marc, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert fake_data_bn.requests_count == 1
+    assert all(marc_data == results[0] for marc_data in results)
+    assert read_ids(results[0]) == records_ids
+    assert client.marc_fetches.get_stats() == {'in_flight': 0, 'calls': 1, 'coalesced': 7, 'timeouts': 0, 'failed': 0}
+    # callers get own copies of data
+    results[0][0:1] = b'x'
+    assert results[1] != results[0]
+
+
+def test_get_marc_is_not_cached_after_fetch(fake_data_bn):
+    client = create_client(fake_data_bn)
+    records_ids = fake_data_bn.records['bibs'].ids[:5]
+
+    assert client.get_marc('bibs', records_ids) == client.get_marc('bibs', records_ids)
+    assert fake_data_bn.requests_count == 2
+
+
+def test_error_of_coalesced_get_marc_is_raised_in_all_callers(fake_data_bn):
+    fake_data_bn.latency = 0.3
+    client = create_client(fake_data_bn, max_retries=0)
+    fake_data_bn.fail_next(500)
+    barrier = threading.Barrier(4)
+    errors = []
+
+    def get_marc():
+        barrier.wait()
+        try:
+            client.get_marc('bibs', fake_data_bn.records['bibs'].ids[:5])
+        except requests.HTTPError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=get_marc) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 4
+    assert fake_data_bn.requests_count == 1
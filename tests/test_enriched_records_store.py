@@ -0,0 +1,33 @@
+import pytest
+from api_core import (EnrichedRecordsStore, MarcRecordWrapper, create_authority_index, create_local_bib_index,
+                      read_marc_from_binary)
+from synthetic_marc import generate_dumps
+
+
+@pytest.fixture(scope='module')
+def indexes(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp('synthetic')
+    authorities_path, bibs_path = str(data_dir / 'authorities.marc'), str(data_dir / 'bibs.marc')
+    generate_dumps(authorities_path, bibs_path, authorities_count=300, bibs_count=500, seed=18)
+    return create_authority_index(authorities_path), create_local_bib_index(bibs_path)
+
+
+def test_single_record_from_store_is_the_same_as_rendered_without_store(indexes):
+    auth_index, bib_index = indexes
+    store = EnrichedRecordsStore(max_bytes=10 ** 8)
+    compared = 0
+
+    for record_id in bib_index:
+        raw_record = bib_index[record_id]
+        marc_record = read_marc_from_binary(raw_record)
+        if marc_record is None:
+            continue
+        rendered = MarcRecordWrapper(marc_record, auth_index)
+        enriched_records = store.get_or_render_all(record_id, raw_record, auth_index.get_first_id, store.generation)
+        from_store = MarcRecordWrapper(read_marc_from_binary(raw_record), auth_index, enriched_records)
+
+        assert from_store.marc_record_processed_ax_xml == rendered.marc_record_processed_ax_xml, record_id
+        assert from_store.marc_record_processed_as_dict == rendered.marc_record_processed_as_dict, record_id
+        compared += 1
+
+    assert compared > 450
@@ -0,0 +1,108 @@
+import os
+import shutil
+from datetime import timedelta
+import pytest
+import index_snapshot
+from index_snapshot import get_journaled_snapshot_meta, is_snapshot_due, read_snapshot_meta, save_index_snapshot
+from index_snapshot import load_index_snapshot, load_or_create_index, snapshot_path_for
+from api_core import create_authority_index, create_local_bib_index
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeJournal:
+    def __init__(self, journal_id='journal-1', journal_sequence=0, size=0):
+        self.journal_id, self.journal_sequence, self.size = journal_id, journal_sequence, size
+
+    def get_position(self):
+        return {'journal_id': self.journal_id, 'journal_sequence': self.journal_sequence}
+
+
+@pytest.fixture
+def data(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_snapshot, 'SNAPSHOT_DIR', str(tmp_path / 'snapshots'))
+    data_path = tmp_path / 'records.marc'
+    data_path.write_bytes(b'records')
+    return str(data_path)
+
+
+def test_snapshot_is_due_when_missing_or_taken_from_other_journal(data):
+    journal = FakeJournal()
+    assert is_snapshot_due(data, journal)
+
+    save_index_snapshot({}, data, get_journaled_snapshot_meta(journal))
+    assert not is_snapshot_due(data, journal)
+
+    # journal was compacted
+    journal.journal_id, journal.journal_sequence, journal.size = 'journal-2', 0, 0
+    assert is_snapshot_due(data, journal)
+
+
+def test_snapshot_is_due_when_journal_grew_or_snapshot_is_old(data, monkeypatch):
+    monkeypatch.setattr(index_snapshot, 'SNAPSHOT_MAX_JOURNAL_BYTES', 1000)
+    monkeypatch.setattr(index_snapshot, 'SNAPSHOT_MAX_AGE', 3600)
+    journal = FakeJournal(size=500)
+    save_index_snapshot({}, data, get_journaled_snapshot_meta(journal, last_update=None))
+    created = read_snapshot_meta(data)['created']
+
+    journal.journal_sequence, journal.size = 10, 1499
+    assert not is_snapshot_due(data, journal, now=created + timedelta(seconds=3599))
+    assert is_snapshot_due(data, journal, now=created + timedelta(seconds=3600))
+
+    journal.size = 1500
+    assert is_snapshot_due(data, journal, now=created)
+
+
+def test_indexes_are_loaded_from_snapshots(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_snapshot, 'SNAPSHOT_DIR', str(tmp_path / 'snapshots'))
+    auth_data, bib_data = str(tmp_path / 'authorities-test.mrc'), str(tmp_path / 'bibs-test.mrc')
+    shutil.copy(os.path.join(REPOSITORY_ROOT, 'authorities-test.mrc'), auth_data)
+    shutil.copy(os.path.join(REPOSITORY_ROOT, 'bibs-test.mrc'), bib_data)
+    auth_index, bib_index = create_authority_index(auth_data), create_local_bib_index(bib_data)
+    save_index_snapshot(auth_index, auth_data, {'last_update': 'now'})
+    save_index_snapshot(bib_index, bib_data, kind='store')
+
+    loaded_auth_index, meta = load_index_snapshot(auth_data)
+    loaded_bib_index = load_index_snapshot(bib_data, 'store')[0]
+
+    assert meta['last_update'] == 'now'
+    assert loaded_auth_index == auth_index
+    assert list(loaded_bib_index) == list(bib_index)
+    assert all(bytes(loaded_bib_index[record_id]) == bytes(bib_index[record_id]) for record_id in bib_index)
+
+
+def test_snapshot_with_wrong_checksum_is_ignored(data):
+    save_index_snapshot({'b1': 'Kowalski Jan'}, data)
+    snapshot_path = snapshot_path_for(data)
+    with open(snapshot_path, 'r+b') as fp:
+        fp.seek(-1, os.SEEK_END)
+        last_byte = fp.read(1)
+        fp.seek(-1, os.SEEK_END)
+        fp.write(bytes([last_byte[0] ^ 0xff]))
+
+    assert load_index_snapshot(data) == (None, None)
+
+
+def test_snapshot_of_other_format_version_is_ignored(data, monkeypatch):
+    save_index_snapshot({'b1': 'Kowalski Jan'}, data)
+    monkeypatch.setattr(index_snapshot, 'SNAPSHOT_FORMAT_VERSION', index_snapshot.SNAPSHOT_FORMAT_VERSION + 1)
+
+    assert load_index_snapshot(data) == (None, None)
+    assert read_snapshot_meta(data) is None
+
+
+def test_index_is_built_again_when_dump_changed(data):
+    created = []
+
+    def create_index(data):
+        created.append(data)
+        return {'version': len(created)}
+
+    assert load_or_create_index(create_index, data)[0] == {'version': 1}
+    assert load_or_create_index(create_index, data)[0] == {'version': 1}
+
+    with open(data, 'ab') as fp:
+        fp.write(b'new records')
+    assert load_or_create_index(create_index, data)[0] == {'version': 2}
+    assert load_or_create_index(create_index, data)[0] == {'version': 2}
+    assert len(created) == 2
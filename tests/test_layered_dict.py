@@ -0,0 +1,76 @@
+import pickle
+import random
+from layered_dict import copy_layered
+
+
+def test_layered_dict_behaves_like_dict():
+    base = {key: key for key in range(100)}
+    expected = dict(base)
+    table = copy_layered(base)
+    rng = random.Random(0)
+
+    for step in range(5000):
+        key = rng.randrange(150)
+        if rng.random() < 0.5:
+            table[key] = expected[key] = step
+        elif key in expected:
+            del table[key]
+            del expected[key]
+        if step % 500 == 0:
+            table = copy_layered(table, merge_ratio=0.3)
+
+        assert len(table) == len(expected)
+        assert table.get(key) == expected.get(key)
+        assert (key in table) == (key in expected)
+
+    assert dict(table) == expected
+    assert base == {key: key for key in range(100)}
+
+
+def test_keys_keep_order_of_base():
+    table = copy_layered({'a': 1, 'b': 2, 'c': 3})
+    table['d'] = 4
+    table['a'] = 5
+    del table['b']
+
+    assert list(table.items()) == [('a', 5), ('c', 3), ('d', 4)]
+
+
+def test_copy_shares_base_and_copies_changes():
+    base = {key: key for key in range(100)}
+    table = copy_layered(base)
+    table[1] = 'changed'
+    del table[2]
+
+    table_copy = copy_layered(table)
+    table_copy[3] = 'changed'
+    del table_copy[1]
+
+    assert table_copy.base is base
+    assert table[1] == 'changed' and 3 in table and table[3] == 3
+    assert 1 not in table_copy and 2 not in table_copy and table_copy[3] == 'changed'
+    assert len(table) == 99 and len(table_copy) == 98
+
+
+def test_changes_are_merged_when_they_exceed_merge_ratio():
+    base = {key: key for key in range(100)}
+    table = copy_layered(base)
+    for key in range(20):
+        table[key] = 'changed'
+
+    table_copy = copy_layered(table, merge_ratio=0.1)
+
+    assert table_copy.base is not base
+    assert not table_copy.changes
+    assert dict(table_copy) == dict(table)
+
+
+def test_pickled_as_dict():
+    table = copy_layered({'a': 1, 'b': 2})
+    table['c'] = 3
+    del table['a']
+
+    loaded = pickle.loads(pickle.dumps(table))
+
+    assert type(loaded) is dict
+    assert loaded == {'b': 2, 'c': 3}
@@ -0,0 +1,49 @@
+import os
+import json
+import pytest
+from pymarc import Field, MARCReader, Record
+from pymarc.marcxml import record_to_xml
+from marc_serializers import record_to_marcxml, marcxml_to_ascii, record_to_jsonl
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def create_record_with_special_characters():
+    record = Record(leader='00000nam a2200000 i 4500')
+    record.add_field(Field(tag='001', data='b1000000<&>"x'))
+    record.add_field(Field(tag='005', data='20200101120000.0 żółć'))
+    record.add_field(Field(tag='007', data=''))
+    record.add_field(Field(tag='100', indicators=['1', ' '],
+                           subfields=['a', 'Łukasiewicz, Jan', 'd', '1878-1956', '0', 'a0000001']))
+    record.add_field(Field(tag='245', indicators=['1', '0'],
+                           subfields=['a', 'Tom & Jerry <wybór> "cytat" \'apostrof\'', 'b', 'Ζεύς 東京 \U0001F600']))
+    record.add_field(Field(tag='650', indicators=[' ', '4'],
+                           subfields=['a', 'a > b\ttab', '"', 'kod w cudzysłowie', 'x', '']))
+    return record
+
+
+def read_test_records():
+    with open(os.path.join(REPOSITORY_ROOT, 'bibs-test.mrc'), 'rb') as fp:
+        return [record for record in MARCReader(fp, to_unicode=True, force_utf8=True) if record is not None]
+
+
+@pytest.mark.parametrize('namespace', [False, True])
+def test_marcxml_is_the_same_as_pymarc_one(namespace):
+    for record in [create_record_with_special_characters()] + read_test_records():
+        assert marcxml_to_ascii(record_to_marcxml(record, namespace)) == record_to_xml(record, namespace=namespace)
+
+
+def test_jsonl_is_the_same_as_pymarc_dict():
+    for record in [create_record_with_special_characters()] + read_test_records():
+        line = record_to_jsonl(record)
+
+        assert line.endswith('\n') and '\n' not in line[:-1]
+        assert json.loads(line) == record.as_dict()
+
+
+def test_non_ascii_characters_are_kept_in_output():
+    record = create_record_with_special_characters()
+
+    assert 'Łukasiewicz' in record_to_marcxml(record)
+    assert 'Ζεύς 東京 \U0001F600' in record_to_jsonl(record)
+    assert b'&#321;ukasiewicz' in marcxml_to_ascii(record_to_marcxml(record))
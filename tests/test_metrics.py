@@ -0,0 +1,92 @@
+import threading
+import multiprocessing
+from metrics import MetricsRegistry, Tracer
+
+
+def create_worker_registry(worker_number, workers_directory):
+    worker_registry = MetricsRegistry()
+    worker_registry.counter('requests_total', 'Requests.', ['kind'])
+    worker_registry.histogram('request_seconds', 'Time of requests.', buckets=(0.1, 1))
+    worker_registry.gauge('cached_chunks', 'Chunks in cache.')
+    worker_registry.attach_worker(worker_number, str(workers_directory), flush_interval=3600)
+    return worker_registry
+
+
+def get_samples(worker_registry):
+    return dict(line.rsplit(' ', 1) for line in worker_registry.render().splitlines() if not line.startswith('#'))
+
+
+def test_counters_and_histograms_are_summed_up_across_workers(tmp_path):
+    workers = [create_worker_registry(worker_number, tmp_path) for worker_number in range(2)]
+    for worker_number, worker_registry in enumerate(workers):
+        worker_registry.metrics['requests_total'].inc(worker_number + 1, kind='get_bibs')
+        worker_registry.metrics['request_seconds'].observe(0.75 * (worker_number + 1))
+        worker_registry.metrics['cached_chunks'].set(10 * (worker_number + 1))
+        # values of the other worker are written by its flush thread
+        worker_registry.flush()
+
+    for worker_registry in workers:
+        samples = get_samples(worker_registry)
+        assert samples['requests_total{kind="get_bibs"}'] == '3'
+        assert samples['request_seconds_bucket{le="1"}'] == '1'
+        assert samples['request_seconds_bucket{le="+Inf"}'] == '2'
+        assert samples['request_seconds_count'] == '2'
+        assert samples['cached_chunks{worker="0"}'] == '10'
+        assert samples['cached_chunks{worker="1"}'] == '20'
+
+
+def test_restarted_worker_continues_counters_of_its_predecessor(tmp_path):
+    workers = [create_worker_registry(worker_number, tmp_path) for worker_number in range(2)]
+    workers[1].metrics['requests_total'].inc(5, kind='get_bibs')
+    workers[1].flush()
+    assert get_samples(workers[0])['requests_total{kind="get_bibs"}'] == '5'
+
+    workers[1] = create_worker_registry(1, tmp_path)
+    workers[1].metrics['requests_total'].inc(kind='get_bibs')
+
+    assert get_samples(workers[1])['requests_total{kind="get_bibs"}'] == '6'
+    assert get_samples(workers[0])['requests_total{kind="get_bibs"}'] == '6'
+
+
+def switch_tracing(tracer):
+    tracer.set_enabled(True)
+
+
+def test_tracing_switch_is_shared_by_worker_processes():
+    context = multiprocessing.get_context('fork')
+    tracer = Tracer()
+    tracer.share_switch(context.Value('b', 0, lock=False))
+
+    process = context.Process(target=switch_tracing, args=(tracer,))
+    process.start()
+    process.join()
+
+    assert tracer.enabled
+
+
+def test_background_callback_does_not_block_rendering():
+    registry = MetricsRegistry()
+    started, release = threading.Event(), threading.Event()
+    sizes = iter([100, 200])
+
+    def get_size():
+        started.set()
+        release.wait(5)
+        return next(sizes)
+
+    metric = registry.callback('index_memory_bytes', 'Memory of index.', get_size, cache_seconds=600, background=True)
+    assert 'index_memory_bytes' not in get_samples(registry)
+    started.wait(5)
+    release.set()
+    metric.refreshing.join(5)
+    assert get_samples(registry)['index_memory_bytes'] == '100'
+
+    # refresh after index update: the last value is rendered until it finishes
+    started.clear()
+    release.clear()
+    metric.refresh_in_background()
+    started.wait(5)
+    assert get_samples(registry)['index_memory_bytes'] == '100'
+    release.set()
+    metric.refreshing.join(5)
+    assert get_samples(registry)['index_memory_bytes'] == '200'
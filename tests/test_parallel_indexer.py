@@ -0,0 +1,34 @@
+import pytest
+from api_core import create_authority_index, create_local_bib_index
+from parallel_indexer import create_authority_index_parallel, create_local_bib_index_parallel
+from synthetic_marc import generate_dumps
+
+
+@pytest.fixture(scope='module')
+def dumps(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp('synthetic')
+    authorities_path, bibs_path = str(data_dir / 'authorities.marc'), str(data_dir / 'bibs.marc')
+    # broken records (skipped by readers) are also found at boundaries of byte ranges
+    generate_dumps(authorities_path, bibs_path, authorities_count=2000, bibs_count=1000, seed=3, broken_ratio=0.02,
+                   duplicate_ratio=0.05)
+    return authorities_path, bibs_path
+
+
+@pytest.mark.parametrize('processes', [2, 3])
+def test_parallel_authority_index_is_equal_to_serial_one(dumps, processes):
+    authorities_path, bibs_path = dumps
+    serial = create_authority_index(authorities_path)
+    parallel = create_authority_index_parallel(authorities_path, processes)
+
+    # lists of ids of headings shared by several records are compared too (their order is the order of dump)
+    assert parallel == serial
+
+
+@pytest.mark.parametrize('processes', [2, 3])
+def test_parallel_bib_index_is_equal_to_serial_one(dumps, processes):
+    authorities_path, bibs_path = dumps
+    serial = create_local_bib_index(bibs_path)
+    parallel = create_local_bib_index_parallel(bibs_path, processes)
+
+    assert parallel.locations == serial.locations
+    assert list(parallel) == list(serial)
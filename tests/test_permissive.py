@@ -0,0 +1,55 @@
+import pytest
+from indexer_config import AUTHORITY_INDEX_FIELDS
+from permissive import PermissiveMARCReader, PermissiveMARCScanner
+from synthetic_marc import generate_dumps
+
+
+class Stream(object):
+    """
+    Non-seekable stream (e.g. body of request).
+    """
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, size):
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+
+@pytest.fixture(scope='module')
+def dumps(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp('synthetic')
+    authorities_path, bibs_path = str(data_dir / 'authorities.marc'), str(data_dir / 'bibs.marc')
+    counters = generate_dumps(authorities_path, bibs_path, authorities_count=300, bibs_count=300, seed=4,
+                              broken_ratio=0.05)
+    assert counters['authorities']['broken'] and counters['bibs']['broken']
+    return {'authorities': authorities_path, 'bibs': bibs_path}
+
+
+def read_headings(data, tags):
+    headings = []
+    for rcd in PermissiveMARCReader(Stream(data), to_unicode=True, force_utf8=True, utf8_handling='ignore'):
+        headings.append((rcd['001'].value(), [(fld.tag, fld.value()) for fld in rcd.get_fields(*tags)]))
+    return headings
+
+
+def scan_headings(data, tags):
+    headings = []
+    for rcd in PermissiveMARCScanner(Stream(data), ['001'] + tags, utf8_handling='ignore'):
+        assert data[rcd.offset:rcd.offset + len(rcd.raw)] == rcd.raw
+        headings.append((rcd.value('001'), [(tag, rcd.value(tag)) for tag in tags if tag in rcd]))
+    return headings
+
+
+# tags of non-repeatable fields (scanned record gives value of the first one)
+@pytest.mark.parametrize('records_type, tags', [('authorities', AUTHORITY_INDEX_FIELDS), ('bibs', ['100', '245'])])
+def test_scanner_reads_the_same_records_as_reader(dumps, records_type, tags):
+    with open(dumps[records_type], 'rb') as fp:
+        data = fp.read()
+
+    scanned_headings = scan_headings(data, tags)
+
+    assert scanned_headings == read_headings(data, tags)
+    assert len(scanned_headings) > 250
@@ -0,0 +1,134 @@
+import os
+import time
+import pytest
+import api_core
+from api_core import (BibliographicRecordsChunk, BibliographicRecordsChunksCache, BibliographicRecordsChunksPrefetcher,
+                      create_authority_index, create_local_bib_index)
+from data_bn_client import DataBnClient
+from fake_data_bn import FakeDataBnServer
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def indexes():
+    return (create_authority_index(os.path.join(REPOSITORY_ROOT, 'authorities-test.mrc')),
+            create_local_bib_index(os.path.join(REPOSITORY_ROOT, 'bibs-test.mrc')))
+
+
+@pytest.fixture
+def fake_data_bn(monkeypatch):
+    server = FakeDataBnServer(os.path.join(REPOSITORY_ROOT, 'bibs-test.mrc'),
+                              os.path.join(REPOSITORY_ROOT, 'authorities-test.mrc'), latency=0.05)
+    server.start()
+    # pages are listed by data.bn.org.pl (no local listing index)
+    monkeypatch.setattr(api_core, 'data_bn_client', DataBnClient(base_url=server.base_url))
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def create_chunk(indexes, fake_data_bn):
+    auth_index, bib_index = indexes
+    created = []
+
+    def create_chunk(query):
+        created.append(query)
+        return BibliographicRecordsChunk(query, auth_index, bib_index)
+
+    create_chunk.created = created
+    return create_chunk
+
+
+def create_prefetcher(create_chunk, **kwargs):
+    return BibliographicRecordsChunksPrefetcher(BibliographicRecordsChunksCache(100), create_chunk, **kwargs)
+
+
+def serve(prefetcher, query):
+    """
+    Serves page like /get_bibs: prefetched or new chunk, then prefetch of next pages.
+    """
+    harvest = prefetcher.get_harvest(query)
+    bib_chunk = prefetcher.chunks_cache.get_from_cache(query) or \
+        prefetcher.wait_for_prefetched_chunk(query, 5) or \
+        prefetcher.chunks_cache.create_and_add(query, prefetcher.create_chunk)
+    prefetcher.prefetch_after(bib_chunk, harvest)
+    return bib_chunk
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_pages_are_prefetched_max_depth_ahead(create_chunk):
+    prefetcher = create_prefetcher(create_chunk, max_depth=2)
+
+    serve(prefetcher, 'limit=2')
+    wait_until(lambda: prefetcher.get_stats()['prefetched'] == 2)
+    time.sleep(0.2)
+
+    assert create_chunk.created == ['limit=2', 'limit=2&sinceId=1000002', 'limit=2&sinceId=1000004']
+    assert prefetcher.get_stats()['in_flight'] == 0
+    prefetched_chunk = prefetcher.chunks_cache.cache['limit=2&sinceId=1000004']
+    assert prefetched_chunk.rendered_outputs['xml'].count(b'<bib>') == 2
+
+    # served prefetched page moves prefetching one page further
+    assert serve(prefetcher, 'limit=2&sinceId=1000002') is prefetcher.chunks_cache.cache['limit=2&sinceId=1000002']
+    wait_until(lambda: prefetcher.get_stats()['prefetched'] == 3)
+    assert create_chunk.created[3:] == ['limit=2&sinceId=1000006']
+    prefetcher.shutdown()
+
+
+def test_cached_and_prefetched_pages_are_not_created_again(create_chunk, fake_data_bn):
+    prefetcher = create_prefetcher(create_chunk, max_depth=2)
+    prefetcher.chunks_cache.add_to_cache(create_chunk('limit=2&sinceId=1000002'))
+
+    first_chunk = serve(prefetcher, 'limit=2')
+    # the same page served again while the next one is being prefetched
+    prefetcher.prefetch_after(first_chunk, prefetcher.get_harvest('limit=2'))
+    # harvester asks for page being prefetched - it waits for it
+    requested_chunk = serve(prefetcher, 'limit=2&sinceId=1000004')
+    wait_until(lambda: prefetcher.get_stats()['prefetched'] == 3)
+    time.sleep(0.2)
+
+    assert requested_chunk is prefetcher.chunks_cache.cache['limit=2&sinceId=1000004']
+    # every page is created once
+    assert create_chunk.created == ['limit=2&sinceId=1000002', 'limit=2', 'limit=2&sinceId=1000004',
+                                    'limit=2&sinceId=1000006', 'limit=2&sinceId=1000008']
+    prefetcher.shutdown()
+
+
+def test_cancelled_and_idle_harvests_are_not_prefetched(create_chunk, fake_data_bn):
+    prefetcher = create_prefetcher(create_chunk, max_depth=3, idle_timeout=0.3)
+
+    serve(prefetcher, 'limit=2')
+    prefetcher.cancel('limit=2&sinceId=1000002')
+    wait_until(lambda: prefetcher.get_stats()['in_flight'] == 0)
+    time.sleep(0.2)
+    # page being prefetched is finished (unless it waited for thread), the next ones are not prefetched
+    assert create_chunk.created[:1] == ['limit=2'] and 'limit=2&sinceId=1000004' not in create_chunk.created
+
+    serve(prefetcher, 'limit=2&sinceId=1000004')
+    time.sleep(0.5)
+    # new harvest of the other harvester makes the idle one removed
+    prefetcher.get_harvest('limit=5')
+    assert prefetcher.get_stats()['harvests'] == 0
+    prefetcher.shutdown()
+
+
+def test_prefetching_stops_after_shutdown(create_chunk, fake_data_bn):
+    prefetcher = create_prefetcher(create_chunk, max_workers=1, max_depth=5)
+
+    first_chunk = serve(prefetcher, 'limit=2')
+    prefetcher.shutdown()
+    stats = prefetcher.get_stats()
+    requests_count = fake_data_bn.requests_count
+
+    assert (stats['in_flight'], stats['harvests']) == (0, 0)
+    assert create_chunk.created[:1] == ['limit=2'] and 'limit=2&sinceId=1000004' not in create_chunk.created
+    prefetcher.prefetch_after(first_chunk, prefetcher.get_harvest('limit=2'))
+    time.sleep(0.2)
+    assert fake_data_bn.requests_count == requests_count
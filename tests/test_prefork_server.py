@@ -0,0 +1,45 @@
+import os
+import time
+import threading
+import multiprocessing
+from prefork_server import UpdateLock
+
+
+def acquire_and_exit(update_lock):
+    update_lock.acquire()
+    os._exit(0)
+
+
+def acquire_and_wait(update_lock, acquired, release):
+    with update_lock:
+        acquired.set()
+        release.wait(10)
+
+
+def test_lock_of_dead_process_is_taken_over():
+    context = multiprocessing.get_context('fork')
+    update_lock = UpdateLock(context, check_interval=0.1)
+    process = context.Process(target=acquire_and_exit, args=(update_lock,))
+    process.start()
+    process.join()
+
+    with update_lock:
+        assert update_lock.owner.value == os.getpid()
+    assert update_lock.owner.value == 0
+    with update_lock:
+        pass
+
+
+def test_lock_of_living_process_is_waited_for():
+    context = multiprocessing.get_context('fork')
+    update_lock = UpdateLock(context, check_interval=0.1)
+    acquired, release = context.Event(), context.Event()
+    process = context.Process(target=acquire_and_wait, args=(update_lock, acquired, release))
+    process.start()
+    acquired.wait(10)
+
+    started = time.monotonic()
+    threading.Timer(0.5, release.set).start()
+    with update_lock:
+        assert time.monotonic() - started >= 0.5
+    process.join()
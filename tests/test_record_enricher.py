@@ -0,0 +1,45 @@
+import pytest
+from api_core import (create_authority_index, create_local_bib_index, get_rid_of_punctuation, process_record,
+                      process_records, read_marc_from_binary)
+from indexer_config import FIELDS_TO_CHECK
+from synthetic_marc import generate_dumps
+
+
+def process_record_by_fields_to_check(marc_record, auth_index):
+    """
+    Former processing loop (FIELDS_TO_CHECK applied entry by entry) - reference for RecordEnricher.
+    """
+    for fld, subflds in FIELDS_TO_CHECK:
+        if fld in marc_record:
+            for raw_fld in marc_record.get_fields(fld):
+                term_to_search = get_rid_of_punctuation(' '.join(subfld for subfld in raw_fld.get_subfields(*subflds)))
+
+                if auth_index.has_heading(term_to_search):
+                    identifier_001 = auth_index.get_first_id(term_to_search)
+                    marc_record.remove_field(raw_fld)
+                    raw_fld.add_subfield('0', identifier_001)
+                    marc_record.add_ordered_field(raw_fld)
+
+    return marc_record
+
+
+@pytest.fixture(scope='module')
+def indexes(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp('synthetic')
+    authorities_path, bibs_path = str(data_dir / 'authorities.marc'), str(data_dir / 'bibs.marc')
+    generate_dumps(authorities_path, bibs_path, authorities_count=300, bibs_count=500, seed=6)
+    return create_authority_index(authorities_path), create_local_bib_index(bibs_path)
+
+
+def read_records(bib_index):
+    records = (read_marc_from_binary(bib_index[record_id]) for record_id in bib_index)
+    return [rcd for rcd in records if rcd is not None]
+
+
+def test_enriched_records_are_the_same_as_processed_field_by_field(indexes):
+    auth_index, bib_index = indexes
+    expected = [process_record_by_fields_to_check(rcd, auth_index).as_marc() for rcd in read_records(bib_index)]
+
+    assert [process_record(rcd, auth_index).as_marc() for rcd in read_records(bib_index)] == expected
+    assert [rcd.as_marc() for rcd in process_records(read_records(bib_index), auth_index)] == expected
+    assert any(b'\x1f0' in raw for raw in expected)
@@ -0,0 +1,57 @@
+import random
+import pytest
+from api_core import create_local_bib_index
+from parallel_indexer import create_local_bib_index_parallel
+from reverse_index import ReverseIndex, create_reverse_index
+from synthetic_marc import generate_dumps, create_updated_record
+
+
+@pytest.fixture(scope='module')
+def bibs_path(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp('synthetic')
+    authorities_path, bibs_path = str(data_dir / 'authorities.marc'), str(data_dir / 'bibs.marc')
+    generate_dumps(authorities_path, bibs_path, authorities_count=300, bibs_count=500, seed=17)
+
+    # records repeated at the end of dump (with changed headings) replace their first versions
+    bib_index = create_local_bib_index(bibs_path)
+    rng = random.Random(17)
+    updated_records = [create_updated_record(bib_index[record_id], rng) for record_id in list(bib_index)[::25]]
+    with open(bibs_path, 'ab') as fp:
+        fp.write(b''.join(raw for raw in updated_records if raw is not None))
+    return bibs_path
+
+
+@pytest.mark.parametrize('processes', [1, 3])
+def test_reverse_index_built_with_bib_index_is_equal_to_one_built_from_bib_index(bibs_path, processes):
+    reverse_index = ReverseIndex()
+    bib_index = create_local_bib_index_parallel(bibs_path, processes, reverse_index)
+    expected = create_reverse_index(bib_index)
+
+    assert reverse_index.terms == expected.terms
+    assert reverse_index.other_ids == expected.other_ids
+
+
+def test_removing_unknown_record_does_not_add_its_id():
+    reverse_index = ReverseIndex()
+    reverse_index.add_record('xyz1', {'Kowalski Jan'})
+    reverse_index.remove_record('xyz2', {'Kowalski Jan'})
+
+    assert reverse_index.other_ids == ['xyz1']
+    assert reverse_index.get_records_ids('Kowalski Jan') == ['xyz1']
+
+
+def test_records_of_term_are_found_after_adding_and_removing_them():
+    reverse_index = ReverseIndex()
+    for record_id in ['b10000021', 'b10000010', 'xyz1']:
+        reverse_index.add_record(record_id, {'Kowalski Jan', record_id})
+    assert reverse_index.get_records_ids('Kowalski Jan') == ['xyz1', 'b10000010', 'b10000021']
+
+    reverse_index.remove_record('b10000010', {'Kowalski Jan'})
+    reverse_index.remove_record('xyz1', {'Kowalski Jan'})
+    assert reverse_index.get_records_ids('Kowalski Jan') == ['b10000021']
+    assert reverse_index.get_affected_records_ids(['Kowalski Jan', 'xyz1', 'Nowak Anna', None]) == \
+        ['b10000021', 'xyz1']
+
+    reverse_index.remove_record('b10000021', {'Kowalski Jan'})
+    assert reverse_index.get_records_ids('Kowalski Jan') == []
+    assert reverse_index.memory_report()['postings'] == 3
@@ -0,0 +1,107 @@
+import os
+import time
+import threading
+import pytest
+import api_core
+from api_core import BibliographicRecordsChunk, create_authority_index, create_local_bib_index
+from bib_listing import create_bib_listing_index
+from single_flight import SingleFlight, SingleFlightTimeout
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def indexes():
+    auth_index = create_authority_index(os.path.join(REPOSITORY_ROOT, 'authorities-test.mrc'))
+    bib_index = create_local_bib_index(os.path.join(REPOSITORY_ROOT, 'bibs-test.mrc'))
+    return auth_index, bib_index, create_bib_listing_index(bib_index)
+
+
+def create_chunk(indexes, query='limit=5'):
+    auth_index, bib_index, listing_index = indexes
+    return BibliographicRecordsChunk(query, auth_index, bib_index, listing_index=listing_index)
+
+
+def call_in_thread(function, *args):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(function(*args)))
+    thread.start()
+    return thread, results
+
+
+# single records (calls coalesced by SingleFlight)
+
+def test_concurrent_calls_of_the_same_key_share_result():
+    flight = SingleFlight('single records', timeout=5)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def create_record(record_id):
+        calls.append(record_id)
+        started.set()
+        release.wait(5)
+        return object()
+
+    leader, leader_results = call_in_thread(flight.do, 'b1', create_record, 'b1')
+    started.wait(5)
+    follower, follower_results = call_in_thread(flight.do, 'b1', create_record, 'b1')
+    while flight.get_stats()['coalesced'] == 0:
+        time.sleep(0.01)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert calls == ['b1']
+    assert leader_results[0] is follower_results[0]
+    assert flight.get_stats() == {'in_flight': 0, 'calls': 1, 'coalesced': 1, 'timeouts': 0, 'failed': 0}
+
+
+def test_waiting_for_call_of_the_same_key_times_out():
+    flight = SingleFlight('single records', timeout=0.1)
+    started, release = threading.Event(), threading.Event()
+
+    def create_record(record_id):
+        started.set()
+        release.wait(5)
+        return record_id
+
+    leader, leader_results = call_in_thread(flight.do, 'b1', create_record, 'b1')
+    started.wait(5)
+    with pytest.raises(SingleFlightTimeout):
+        flight.do('b1', create_record, 'b1')
+    release.set()
+    leader.join()
+
+    assert leader_results == ['b1']
+    assert flight.get_stats()['timeouts'] == 1
+
+
+# chunks (output rendered once for concurrent requests)
+
+def test_request_waits_for_output_rendered_for_other_request(indexes):
+    chunk = create_chunk(indexes)
+    streamed = chunk.iter_output('xml')
+    first_part = next(streamed)
+
+    waiting, waited_outputs = call_in_thread(chunk.wait_for_output, 'xml')
+    output = first_part + b''.join(streamed)
+    waiting.join()
+
+    assert waited_outputs == [output]
+    assert list(chunk.iter_output('xml')) == [output]
+    assert output.count(b'<bib>') == 5
+
+
+def test_waiting_for_output_times_out_before_response(indexes, monkeypatch):
+    monkeypatch.setattr(api_core, 'CHUNK_OUTPUT_WAIT_TIMEOUT', 0.1)
+    chunk = create_chunk(indexes)
+    streamed = chunk.iter_output('jsonl')
+    next(streamed)
+
+    with pytest.raises(SingleFlightTimeout):
+        chunk.wait_for_output('jsonl')
+    # response started before other request began rendering is not broken by timeout - output is rendered again
+    assert b''.join(chunk.iter_output('jsonl')).count(b'\n') == 6
+
+    streamed.close()
+    assert chunk.wait_for_output('jsonl') is None
@@ -0,0 +1,65 @@
+import os
+import shutil
+from datetime import datetime
+import pytest
+from api_core import Updater, UpdaterStatus, create_authority_index, create_local_bib_index
+from data_bn_client import DataBnClient
+from fake_data_bn import FakeDataBnServer
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MISSING_RECORDS_IDS = {'bibs': ['b9999999x', 'b99999981'], 'authorities': ['a9999999x', 'a99999981']}
+
+
+@pytest.fixture
+def fake_data_bn():
+    server = FakeDataBnServer(os.path.join(REPOSITORY_ROOT, 'bibs-test.mrc'),
+                              os.path.join(REPOSITORY_ROOT, 'authorities-test.mrc'), updated_count=4)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def updater(fake_data_bn):
+    return Updater(DataBnClient(base_url=fake_data_bn.base_url))
+
+
+def get_changes(fake_data_bn, records_type):
+    """
+    Returns changes (see Updater.get_changes): records updated at data.bn, not updated ones and ones missing there.
+    """
+    records = fake_data_bn.records[records_type]
+    unchanged_records_ids = [record_id for record_id in records.ids if record_id not in records.updated_records][:3]
+    return [], list(records.updated_records) + unchanged_records_ids + MISSING_RECORDS_IDS[records_type], \
+        datetime.utcnow()
+
+
+def test_bibliographic_update_counts_missing_records_separately(fake_data_bn, updater, tmp_path):
+    data = str(tmp_path / 'bibs-test.mrc')
+    shutil.copy(os.path.join(REPOSITORY_ROOT, 'bibs-test.mrc'), data)
+    bib_index = create_local_bib_index(data)
+    progress = {}
+
+    changed_records_ids = updater.update_bibliographic_index(bib_index, UpdaterStatus(datetime.utcnow()), progress,
+                                                             changes=get_changes(fake_data_bn, 'bibs'))
+
+    updated_records = fake_data_bn.records['bibs'].updated_records
+    assert sorted(changed_records_ids) == sorted(updated_records)
+    assert dict(progress, phase=None) == {'phase': None, 'deleted': 0, 'updated': len(updated_records),
+                                          'unchanged': 3, 'missing': 2}
+
+
+def test_authority_update_counts_missing_records_separately(fake_data_bn, updater):
+    auth_index = create_authority_index(os.path.join(REPOSITORY_ROOT, 'authorities-test.mrc'))
+    progress = {}
+
+    changed_records_ids = updater.update_authority_index(auth_index, UpdaterStatus(datetime.utcnow()), progress,
+                                                         changes=get_changes(fake_data_bn, 'authorities'))
+
+    updated_records = fake_data_bn.records['authorities'].updated_records
+    # records updated at data.bn with the same heading are unchanged in index
+    assert set(changed_records_ids) <= set(updated_records)
+    assert progress['updated'] == len(changed_records_ids)
+    assert progress['unchanged'] == len(updated_records) + 3 - len(changed_records_ids)
+    assert progress['missing'] == 2
@@ -25,6 +25,8 @@ def do_bib_update():
     requests.get('http://{}/update/bibs'.format(BASE_URL))
 
 # set update scheduler
+# (full updates, listing the last 3 days of changes again; needed only if continuous sync of indexes
+# in API server is disabled - see INDEX_SYNC in indexer_config)
 schedule.every().day.at("22:46").do(do_auth_update)
 schedule.every().day.at("10:30").do(do_bib_update)
 
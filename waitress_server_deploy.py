@@ -17,5 +17,7 @@ root_fh.setLevel(logging.INFO)
 root_fh.setFormatter(formatter)
 logging.root.addHandler(root_fh)
 
+if api_morepath.index_sync_loop is not None:
+    api_morepath.index_sync_loop.start()
 
 serve(api_morepath.App(), listen=BASE_URL)
\ No newline at end of file